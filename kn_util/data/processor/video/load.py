@@ -1,6 +1,17 @@
+from concurrent.futures import Future
+
 from PIL import Image
 
 
+def decode_decord_frames(path_or_buffer, width=224, height=224, stride=1, num_threads=0):
+    """Decode every stride-th frame of a video as a (T, H, W, C) array."""
+    from decord import VideoReader
+    vr = VideoReader(path_or_buffer, width=width, height=height, num_threads=num_threads)
+
+    indices = list(range(0, len(vr), stride))
+    return vr.get_batch(indices).asnumpy()
+
+
 class DecordFrameLoader:
 
     def __init__(self,
@@ -9,15 +20,54 @@ class DecordFrameLoader:
                  width=224,
                  height=224,
                  to_array=False,
-                 to_images=False) -> None:
+                 to_images=False,
+                 decode_pool=None,
+                 num_threads=0) -> None:
         # decord_args: width=224, height=224
+        # decode_pool: an optional VideoDecodePool (see kn_util.data.video) to decode on
         self.from_key = from_key
         self.width = width
         self.height = height
         self.stride = stride
         self.to_images = to_images
         self.to_array = to_array
+        self.decode_pool = decode_pool
+        self.num_threads = num_threads
 
+    def _decode_args(self, path_or_buffer):
+        return dict(path_or_buffer=path_or_buffer,
+                    width=self.width,
+                    height=self.height,
+                    stride=self.stride,
+                    num_threads=self.num_threads)
+
+    def _to_result(self, arr):
+        result = dict()
+
+        if self.to_array:
+            result["array"] = arr
+        if self.to_images:
+            result["images"] = [Image.fromarray(a) for a in arr]
+        return result
+
+    def submit(self, path_or_buffer):
+        """
+        Decode on the decode pool.
+        Returns:
+            future (Future): future of the result dict of __call__
+        """
+        assert self.decode_pool is not None, "submit requires a decode_pool"
+        future = self.decode_pool.submit(decode_decord_frames, **self._decode_args(path_or_buffer))
+        result = Future()
+
+        def _done(f):
+            try:
+                result.set_result(self._to_result(f.result()))
+            except BaseException as exn:
+                result.set_exception(exn)
+
+        future.add_done_callback(_done)
+        return result
 
     def __call__(self, path_or_buffer):
         """
@@ -27,16 +77,6 @@ class DecordFrameLoader:
             result (dict): result dict with frame array or frame images
             
         """
-        from decord import VideoReader
-        vr = VideoReader(path_or_buffer, width=self.width, height=self.height)
-
-        indices = list(range(0, len(vr), self.stride))
-        arr = vr.get_batch(indices).asnumpy()
-
-        result = dict()
-
-        if self.to_array:
-            result["array"] = arr
-        if self.to_images:
-            result["images"] = [Image.fromarray(a) for a in arr]
-        return result
\ No newline at end of file
+        if self.decode_pool is not None:
+            return self.submit(path_or_buffer).result()
+        return self._to_result(decode_decord_frames(**self._decode_args(path_or_buffer)))
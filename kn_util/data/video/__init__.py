@@ -1,14 +1,26 @@
 from .clipping import cut_video_clips, parse_timestamp_to_secs
+from .decode_pool import VideoDecodePool, get_decode_pool
+from .frame_buffer import frames_to_shared, shared_empty
 from .download import download_youtube, download_youtube_as_bytes, download_yt_meta
 from .load import (
     DecordVideoMeta,
+    decode_cost,
+    fetch_frames,
     fill_temporal_param,
     get_frame_indices,
+    get_key_indices,
+    plan_frame_fetch,
     probe_meta,
+    probe_meta_av,
+    probe_meta_cached,
     probe_meta_decord,
     probe_meta_ffprobe,
+    open_video_reader,
+    read_clips,
     read_frames_decord,
     read_frames_gif,
+    snap_frame_indices,
+    video_meta_cache,
 )
 from .save import (
     array_to_video_bytes,
@@ -0,0 +1,171 @@
+"""
+A shared pool of video decoders.
+
+Decoding inside the DataLoader worker that asked for a video serializes I/O and
+decode per worker. VideoDecodePool runs the decode calls (read_frames_decord,
+read_clips, or any function) on a fixed set of threads or processes and returns
+futures, so a worker can keep several videos in flight:
+
+    pool = get_decode_pool(num_workers=8)
+    futures = [pool.read_frames(path, num_frames=16, size=224) for path in paths]
+    clips = [future.result() for future in futures]
+
+At most `max_pending` calls are queued or running; submit blocks beyond that.
+decord releases the GIL while decoding, so threads are the default; processes
+isolate decoder crashes at the cost of pickling the frames back. `get_stats`
+reports the utilization of the decoders and the queueing delay, to size the pool:
+a utilization close to 1 with growing wait times asks for more decoders, a low
+utilization for fewer.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+
+
+def _timed_call(fn, args, kwargs):
+    start = time.time()
+    result = fn(*args, **kwargs)
+    return result, start, time.time()
+
+
+class VideoDecodePool:
+    """Run decode calls on num_workers threads (or processes) with a bounded queue.
+
+    Args:
+        num_workers: number of decoder threads or processes
+        max_pending: maximum number of queued and running calls (4 * num_workers by default)
+        use_processes: decode in processes instead of threads
+    """
+
+    def __init__(self, num_workers=4, max_pending=None, use_processes=False):
+        self.num_workers = num_workers
+        self.max_pending = max_pending or 4 * num_workers
+        self.use_processes = use_processes
+        if use_processes:
+            self.executor = ProcessPoolExecutor(num_workers)
+        else:
+            self.executor = ThreadPoolExecutor(num_workers, thread_name_prefix="video-decode")
+        self._slots = threading.BoundedSemaphore(self.max_pending)
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._lock:
+            self.start_time = time.time()
+            self.submitted = 0
+            self.completed = 0
+            self.failed = 0
+            self.pending = 0
+            self.peak_pending = 0
+            self.busy_time = 0.0
+            self.wait_time = 0.0
+            self.latency = 0.0
+
+    def submit(self, fn, *args, **kwargs):
+        """Schedule fn(*args, **kwargs) on a decoder; blocks while max_pending calls are in flight."""
+        self._slots.acquire()
+        submit_time = time.time()
+        with self._lock:
+            self.submitted += 1
+            self.pending += 1
+            self.peak_pending = max(self.peak_pending, self.pending)
+
+        future = Future()
+
+        def _done(inner):
+            self._slots.release()
+            try:
+                result, start, end = inner.result()
+            except BaseException as exn:
+                with self._lock:
+                    self.pending -= 1
+                    self.failed += 1
+                future.set_exception(exn)
+                return
+            with self._lock:
+                self.pending -= 1
+                self.completed += 1
+                self.busy_time += end - start
+                self.wait_time += start - submit_time
+                self.latency += time.time() - submit_time
+            future.set_result(result)
+
+        try:
+            inner = self.executor.submit(_timed_call, fn, args, kwargs)
+        except BaseException:
+            self._slots.release()
+            with self._lock:
+                self.pending -= 1
+            raise
+        inner.add_done_callback(_done)
+        return future
+
+    def read_frames(self, *args, **kwargs):
+        """A future of read_frames_decord(*args, **kwargs)."""
+        from .load import read_frames_decord
+
+        return self.submit(read_frames_decord, *args, **kwargs)
+
+    def read_clips(self, *args, **kwargs):
+        """A future of read_clips(*args, **kwargs)."""
+        from .load import read_clips
+
+        return self.submit(read_clips, *args, **kwargs)
+
+    def map(self, fn, iterable):
+        """Decode fn(item) for all items, keeping up to max_pending in flight; yields results in order."""
+        futures = []
+        for item in iterable:
+            futures.append(self.submit(fn, item))
+            # hand out finished results early, so submit does not block forever on our own futures
+            while len(futures) >= self.max_pending:
+                yield futures.pop(0).result()
+        for future in futures:
+            yield future.result()
+
+    def get_stats(self):
+        """Utilization of the decoders and mean wait/decode/latency (secs) since the last reset."""
+        with self._lock:
+            elapsed = max(time.time() - self.start_time, 1e-9)
+            done = max(self.completed, 1)
+            return dict(
+                num_workers=self.num_workers,
+                submitted=self.submitted,
+                completed=self.completed,
+                failed=self.failed,
+                pending=self.pending,
+                peak_pending=self.peak_pending,
+                utilization=self.busy_time / (self.num_workers * elapsed),
+                mean_wait=self.wait_time / done,
+                mean_decode=self.busy_time / done,
+                mean_latency=self.latency / done,
+                throughput=self.completed / elapsed,
+            )
+
+    def close(self, wait=True):
+        self.executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+_pools = {}
+
+
+def get_decode_pool(num_workers=None, max_pending=None, use_processes=False):
+    """The decode pool of this process, created on first use.
+
+    Pools are per process id, so DataLoader workers forked from a process with a pool
+    create their own instead of inheriting its dead threads. num_workers defaults to
+    $KN_DECODE_WORKERS or 4.
+    """
+    pid = os.getpid()
+    if pid not in _pools:
+        num_workers = num_workers or int(os.environ.get("KN_DECODE_WORKERS", 4))
+        _pools[pid] = VideoDecodePool(num_workers, max_pending=max_pending, use_processes=use_processes)
+    return _pools[pid]
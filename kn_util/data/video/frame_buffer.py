@@ -0,0 +1,58 @@
+"""
+Shared-memory output buffers for decoded frames.
+
+A clip decoded in a DataLoader worker normally goes decord buffer -> numpy
+(asnumpy) -> contiguous copy in the requested layout -> pickled through the
+result queue. With frames_to_shared, the decoded frames are instead copied once,
+straight from decord's buffer (via dlpack), into a torch tensor allocated in
+shared memory in the requested layout; sending that tensor to the main process
+only passes a handle to the shared segment (torch does not copy tensors already
+in shared memory), so the main process gets a zero-copy view.
+
+Every clip gets a fresh segment, allocated directly in shared memory as
+default_collate does in workers. Buffers are not reused: the worker cannot know
+when the consumer has released a tensor it received, and overwriting one would
+silently change data that was already delivered.
+"""
+
+import math
+
+import torch
+from einops import rearrange
+
+
+def shared_empty(shape, dtype=torch.uint8):
+    """An uninitialized tensor of the given shape in a new shared-memory segment."""
+    storage = torch.empty(0, dtype=dtype)._typed_storage()._new_shared(math.prod(shape))
+    return torch.empty(0, dtype=dtype).new(storage).resize_(*shape)
+
+
+def as_torch_frames(frames):
+    """A (T, H, W, C) torch view of decord output (NDArray, torch tensor or numpy), without copying."""
+    if isinstance(frames, torch.Tensor):
+        return frames
+    if hasattr(frames, "to_dlpack"):
+        return torch.utils.dlpack.from_dlpack(frames.to_dlpack())
+    return torch.from_numpy(frames)
+
+
+def frames_to_shared(frames, output_format="tchw", index=None):
+    """Copy (T, H, W, C) frames into a new shared-memory tensor in the output_format layout, with one copy.
+
+    Args:
+        frames: decord output (NDArray, torch tensor or numpy)
+        index: optional int64 indices of the frames to take (e.g. to repeat or reorder)
+    """
+    # a strided view in the output layout, copied once into shared memory
+    frames = rearrange(as_torch_frames(frames), "t h w c -> " + " ".join(output_format))
+    if index is None:
+        out = shared_empty(tuple(frames.shape), dtype=frames.dtype)
+        out.copy_(frames)
+        return out
+    t_dim = output_format.index("t")
+    shape = list(frames.shape)
+    shape[t_dim] = len(index)
+    out = shared_empty(tuple(shape), dtype=frames.dtype)
+    # out already has the result shape, so index_select writes into the shared segment
+    torch.index_select(frames, t_dim, torch.as_tensor(index, dtype=torch.int64), out=out)
+    return out
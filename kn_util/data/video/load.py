@@ -2,8 +2,11 @@
 Modified from https://github.com/m-bain/frozen-in-time/blob/22a91d78405ec6032fdf521ae1ff5573358e632f/base/base_dataset.py
 """
 
+import hashlib
 import io
+import os
 import random
+from collections import OrderedDict
 
 try:
     import torch
@@ -25,6 +28,7 @@ from loguru import logger
 from ...utils.download import MultiThreadDownloaderInMem
 from ...utils.system import run_cmd
 from .download import download_youtube_as_bytes
+from .frame_buffer import frames_to_shared
 
 # ======================== FFMPEG ========================
 
@@ -108,6 +112,100 @@ def probe_meta_decord(video_path):
     }
 
 
+def probe_meta_av(video_path):
+    """Read width/height/fps/duration/num_frames from the container headers, without decoding.
+
+    `video_path` is a path or a seekable file object (rewound afterwards).
+    """
+    import av
+
+    with av.open(video_path) as container:
+        stream = container.streams.video[0]
+        fps = float(stream.average_rate) if stream.average_rate else None
+        duration = float(stream.duration * stream.time_base) if stream.duration else None
+        if duration is None and container.duration is not None:
+            duration = container.duration / av.time_base
+        num_frames = stream.frames or (int(round(duration * fps)) if duration and fps else None)
+        meta = {
+            "width": stream.codec_context.width,
+            "height": stream.codec_context.height,
+            "fps": fps,
+            "duration": duration,
+            "num_frames": num_frames,
+        }
+    if hasattr(video_path, "seek"):
+        video_path.seek(0)
+    return meta
+
+
+class VideoMetaCache:
+    """An in-process LRU of video metadata, so repeated reads of a video never re-probe it.
+
+    Entries are dicts (e.g. the result of probe_meta_av) keyed by video_cache_key, i.e.
+    by (path, size, mtime) for files, so a rewritten file is probed again.
+    max_entries defaults to $KN_VIDEO_META_CACHE (65536).
+    """
+
+    def __init__(self, max_entries=None):
+        if max_entries is None:
+            max_entries = int(os.environ.get("KN_VIDEO_META_CACHE", 65536))
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        if key is None or key not in self.entries:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return self.entries[key]
+
+    def update(self, key, meta):
+        """Merge meta into the entry of key and return the entry."""
+        if key is None:
+            return dict(meta)
+        entry = self.entries.pop(key, {})
+        entry.update(meta)
+        self.entries[key] = entry
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return entry
+
+    def clear(self):
+        self.entries.clear()
+
+
+video_meta_cache = VideoMetaCache()
+
+
+def video_cache_key(video, tag=None):
+    """Cache key of a video given as a path, url or bytes; None if it cannot be identified."""
+    if isinstance(video, (bytes, bytearray, memoryview)):
+        video = memoryview(video)
+        digest = hashlib.blake2b(video[: 1 << 16], digest_size=16)
+        digest.update(video[-(1 << 16) :])
+        return ("bytes", len(video), digest.hexdigest(), tag)
+    if isinstance(video, str):
+        try:
+            st = os.stat(video)
+        except OSError:
+            # an url
+            return ("url", video, tag)
+        return ("file", os.path.abspath(video), st.st_size, st.st_mtime_ns, tag)
+    return None
+
+
+def probe_meta_cached(video_path, key=None):
+    """probe_meta_av through video_meta_cache; `key` defaults to video_cache_key(video_path)."""
+    key = video_cache_key(video_path) if key is None else key
+    meta = video_meta_cache.get(key)
+    if meta is None or "width" not in meta:
+        meta = video_meta_cache.update(key, probe_meta_av(video_path))
+    return meta
+
+
 def probe_meta(video_path):
     try:
         return probe_meta_decord(video_path)
@@ -192,6 +290,100 @@ def get_frame_indices(
     return frame_indices
 
 
+# ======================== Frame fetch planning ========================
+# Decoding frame i costs decoding from the keyframe before it (or from the decoder's
+# position, if that is in the same GOP and not past i), so the cost of a clip is set
+# by how its indices fall in GOPs, not by how many frames it has.
+
+
+def get_key_indices(video_reader, key=None):
+    """The keyframe indices of a video as an int64 array, cached in video_meta_cache under key."""
+    meta = video_meta_cache.get(key) if key is not None else None
+    if meta is not None and "key_indices" in meta:
+        return meta["key_indices"]
+    key_indices = np.asarray(video_reader.get_key_indices(), dtype=np.int64)
+    if len(key_indices) == 0 or key_indices[0] != 0:
+        key_indices = np.concatenate([[0], key_indices])
+    video_meta_cache.update(key, {"key_indices": key_indices})
+    return key_indices
+
+
+def plan_frame_fetch(frame_indices, key_indices):
+    """Group the distinct requested indices by GOP: a list of (keyframe, sorted indices)."""
+    indices = np.unique(np.asarray(frame_indices, dtype=np.int64))
+    gops = np.searchsorted(key_indices, indices, side="right") - 1
+    plan = []
+    for gop in np.unique(gops):
+        plan.append((int(key_indices[gop]), indices[gops == gop].tolist()))
+    return plan
+
+
+def decode_cost(frame_indices, key_indices):
+    """Number of frames decoded to fetch frame_indices by decoding forward within each GOP."""
+    return sum(indices[-1] - keyframe + 1 for keyframe, indices in plan_frame_fetch(frame_indices, key_indices))
+
+
+def snap_frame_indices(frame_indices, key_indices, tolerance, vlen=None):
+    """Move every index by at most tolerance frames to a frame that is cheap to decode.
+
+    Walking the distinct indices in order, each one picks among the frames within tolerance
+    the one that adds the fewest decoded frames: a keyframe, the frame right after the
+    previous pick in the same GOP, or the first frame of the window; ties go to the closest
+    frame. Picks stay increasing and below vlen; distinct indices stay distinct unless
+    there is no free frame left within tolerance, in which case the previous pick is
+    repeated. Repeated indices get the same pick, and the input order is kept.
+    """
+    key_indices = np.asarray(key_indices, dtype=np.int64)
+    vlen = vlen if vlen is not None else int(max(frame_indices)) + 1
+    picks = {}
+    pos, pos_gop = -1, -1  # last decoded frame and its GOP
+    for target in sorted(set(int(i) for i in frame_indices)):
+        lo = max(target - tolerance, pos + 1, 0)
+        hi = min(target + tolerance, vlen - 1)
+        if lo > hi:
+            # no distinct frame left within tolerance (or the target is past the end)
+            best = pos if pos >= 0 else max(hi, 0)
+        else:
+            k_lo, k_hi = np.searchsorted(key_indices, [lo, hi + 1])
+            candidates = [lo] + key_indices[k_lo:k_hi].tolist()
+
+            def _cost(c):
+                gop = int(np.searchsorted(key_indices, c, side="right")) - 1
+                if gop == pos_gop:
+                    return c - pos
+                return c - int(key_indices[gop]) + 1
+
+            best = min(candidates, key=lambda c: (_cost(c), abs(c - target)))
+        picks[target] = best
+        pos, pos_gop = best, int(np.searchsorted(key_indices, best, side="right")) - 1
+    return [picks[int(i)] for i in frame_indices]
+
+
+def decode_unique_frames(video_reader, frame_indices):
+    """Decode the distinct frame_indices in increasing order.
+
+    Returns the raw decord batch of the distinct frames and the position of every
+    requested index in it (None if the indices were already distinct and sorted).
+    """
+    indices = np.asarray(frame_indices, dtype=np.int64)
+    unique, inverse = np.unique(indices, return_inverse=True)
+    batch = video_reader.get_batch(unique.tolist())
+    if len(unique) == len(indices) and np.array_equal(unique, indices):
+        return batch, None
+    return batch, inverse
+
+
+def fetch_frames(video_reader, frame_indices):
+    """Decode frame_indices (any order, duplicates allowed) as a (T, H, W, C) array.
+
+    Every distinct frame is decoded once, in increasing order, so within a GOP the
+    decoder runs forward instead of seeking back to the keyframe for each index.
+    """
+    batch, inverse = decode_unique_frames(video_reader, frame_indices)
+    frames = batch.asnumpy()
+    return frames if inverse is None else frames[inverse]
+
+
 # def read_frames_av(video_path, num_frames, sample="rand", fix_start=None, max_num_frames=-1):
 #     reader = av.open(video_path)
 #     frames = [torch.from_numpy(f.to_rgb().to_ndarray()) for f in reader.decode(video=0)]
@@ -227,6 +419,97 @@ def read_frames_gif(
     return frames, frame_indices, None
 
 
+def youtube_download_format(size=None, max_size=None):
+    """The yt-dlp format for a video that will be resized to size/max_size."""
+    download_format = "best"
+    download_suffix = ""
+    if size is not None:
+        download_format = "worst"
+        download_suffix += f"[height>={size}][width>={size}]"
+
+    if max_size is not None:
+        download_format = "worst"
+        download_suffix += f"[height>={max_size}][width>={max_size}]"
+    return download_format + download_suffix
+
+
+def open_video_reader(
+    video_path,
+    *,
+    size=None,
+    max_size=None,
+    is_online_video=False,
+    is_youtube_video=False,
+    is_bytes=False,
+    num_threads=1,
+):
+    """Open a decord VideoReader on a path, url, youtube id or bytes, resized so the short side is size.
+
+    Returns (video_reader, meta_key), where meta_key identifies the input in video_meta_cache
+    (None if the youtube download failed, with video_reader None).
+    """
+    assert (
+        int(is_online_video) + int(is_youtube_video) + int(is_bytes) <= 1
+    ), "Only one of is_online_video, is_youtube_video, is_bytes can be True"
+
+    # key the cached metadata by the input, before it is downloaded
+    download_format = youtube_download_format(size, max_size) if is_youtube_video else None
+    meta_key = video_cache_key(video_path, tag=download_format)
+
+    # 1. read from youtube, online video, or bytes
+    if is_youtube_video:
+        video_bytes, error_code = download_youtube_as_bytes(video_path, video_format=download_format)
+        if error_code != 0:
+            logger.error(f"Error downloading youtube video: {video_path}")
+            return None, None
+        video_path = io.BytesIO(video_bytes)
+
+    if is_online_video:
+        downloader = MultiThreadDownloaderInMem(verbose=False)
+        video_path = io.BytesIO(downloader.download(video_path))
+
+    if is_bytes:
+        video_path = io.BytesIO(video_path)
+
+    # 2. maybe resize video
+    # calculate frame size according to size and max_size, [-1, -1] by default
+    frame_size = [-1, -1]
+    if size is not None:
+        # the resolution comes from the container headers (cached), nothing is decoded twice
+        try:
+            meta = probe_meta_cached(video_path, key=meta_key)
+            orig_size = (meta["height"], meta["width"])
+        except Exception:
+            orig_size = VideoReader(video_path, num_threads=1)[0].shape[:2]
+            video_meta_cache.update(meta_key, {"height": orig_size[0], "width": orig_size[1]})
+            if hasattr(video_path, "seek"):
+                video_path.seek(0)
+        argmin_size_dim = 0 if orig_size[0] < orig_size[1] else 1
+        argmax_size_dim = 1 - argmin_size_dim
+        frame_size[argmin_size_dim] = size
+        frame_size[argmax_size_dim] = int(size * orig_size[argmax_size_dim] / orig_size[argmin_size_dim])
+        if max_size is not None:
+            frame_size[argmin_size_dim] = min(frame_size[argmin_size_dim], max_size)
+
+    video_reader = VideoReader(
+        video_path,
+        num_threads=num_threads,
+        height=frame_size[0],
+        width=frame_size[1],
+    )
+    return video_reader, meta_key
+
+
+def _reader_and_key(video_path, video_reader, *, is_youtube_video=False, size=None, max_size=None, **kwargs):
+    """Open a reader unless one is given; the cache key of the input either way."""
+    if video_reader is None:
+        return open_video_reader(video_path, is_youtube_video=is_youtube_video, size=size, max_size=max_size, **kwargs)
+    if video_path is None:
+        return video_reader, None
+    download_format = youtube_download_format(size, max_size) if is_youtube_video else None
+    return video_reader, video_cache_key(video_path, tag=download_format)
+
+
 def read_frames_decord(
     video_path=None,
     # frame sampling
@@ -236,6 +519,7 @@ def read_frames_decord(
     sample_mode="round",
     offset_from_start=None,
     truncate_secs=None,
+    keyframe_snap=None,
     # ----------------
     video_reader=None,
     # decord kwargs
@@ -251,64 +535,35 @@ def read_frames_decord(
     # return
     return_reader=False,
     return_meta=False,
+    # decoding
+    num_threads=1,
+    decode_pool=None,
+    output_buffer=False,
 ):
-    assert (
-        int(is_online_video) + int(is_youtube_video) + int(is_bytes) <= 1
-    ), "Only one of is_online_video, is_youtube_video, is_bytes can be True"
+    """
+    Args:
+        num_threads: decoder threads of the VideoReader
+        decode_pool: a VideoDecodePool; if given, the read runs on the pool and a
+            Future of the result is returned
+        output_buffer: return the frames as a torch tensor in shared memory (see
+            frame_buffer), which crosses DataLoader worker boundaries without copies
+    """
+    if decode_pool is not None:
+        kwargs = dict(locals())
+        kwargs.pop("decode_pool")
+        return decode_pool.submit(read_frames_decord, **kwargs)
 
     decord.bridge.set_bridge(bridge)
-    # 1. read from youtube, online video, or bytes
-    def _prepare_vr(video_path):
-        if is_youtube_video:
-            download_format = "best"
-            download_suffix = ""
-            if size is not None:
-                download_format = "worst"
-                download_suffix += f"[height>={size}][width>={size}]"
-
-            if max_size is not None:
-                download_format = "worst"
-                download_suffix += f"[height>={max_size}][width>={max_size}]"
-            download_format += download_suffix
-
-            video_bytes, error_code = download_youtube_as_bytes(video_path, video_format=download_format)
-            if error_code != 0:
-                logger.error(f"Error downloading youtube video: {video_path}")
-                return None
-            video_path = io.BytesIO(video_bytes)
-
-        if is_online_video:
-            downloader = MultiThreadDownloaderInMem(verbose=False)
-            video_path = io.BytesIO(downloader.download(video_path))
-
-        if is_bytes:
-            video_path = io.BytesIO(video_path)
-
-
-        # 2. maybe resize video
-        # calculate frame size according to size and max_size, [-1, -1] by default
-        frame_size = [-1, -1]
-        if size is not None:
-            orig_size = VideoReader(video_path, num_threads=1)[0].shape[:2]
-            argmin_size_dim = 0 if orig_size[0] < orig_size[1] else 1
-            argmax_size_dim = 1 - argmin_size_dim
-            frame_size[argmin_size_dim] = size
-            frame_size[argmax_size_dim] = int(size * orig_size[argmax_size_dim] / orig_size[argmin_size_dim])
-            if max_size is not None:
-                frame_size[argmin_size_dim] = min(frame_size[argmin_size_dim], max_size)
-
-        if is_online_video or is_youtube_video or is_bytes:
-            video_path.seek(0)
-
-        video_reader = VideoReader(
-            video_path,
-            num_threads=1,
-            height=frame_size[0],
-            width=frame_size[1],
-        )
-        return video_reader
-    
-    video_reader = _prepare_vr(video_path) if video_reader is None else video_reader
+    video_reader, meta_key = _reader_and_key(
+        video_path,
+        video_reader,
+        size=size,
+        max_size=max_size,
+        is_online_video=is_online_video,
+        is_youtube_video=is_youtube_video,
+        is_bytes=is_bytes,
+        num_threads=num_threads,
+    )
 
     # setup params
     vlen = len(video_reader)
@@ -333,11 +588,20 @@ def read_frames_decord(
             offset_from_start=offset_from_start,
         )
 
-    frames = video_reader.get_batch(frame_indices).asnumpy()  # (T, H, W, C)
+    # nudge the indices to cheap frames, then decode each frame once, GOP by GOP
+    # (the keyframes are only needed to snap or to report the decode cost)
+    key_indices = get_key_indices(video_reader, key=meta_key) if keyframe_snap is not None or return_meta else None
+    if keyframe_snap is not None:
+        frame_indices = snap_frame_indices(frame_indices, key_indices, keyframe_snap, vlen=vlen)
+    if output_buffer:
+        # one copy from decord's buffer into shared memory, already in output_format
+        batch, inverse = decode_unique_frames(video_reader, frame_indices)
+        frames = frames_to_shared(batch, output_format, index=inverse)
+    else:
+        frames = fetch_frames(video_reader, frame_indices)  # (T, H, W, C)
 
-    # to expected output format
-    output_format = " ".join(output_format)
-    frames = rearrange(frames, f"t h w c -> {output_format}")
+        # to expected output format
+        frames = rearrange(frames, f"t h w c -> {' '.join(output_format)}")
 
     if not return_reader and not return_meta:
         return frames
@@ -350,6 +614,120 @@ def read_frames_decord(
             "vlen": vlen,
             "duration": duration,
             "frame_indices": frame_indices,
+            "decoded_frames": decode_cost(frame_indices, key_indices),
+        }
+        ret += (meta,)
+
+    if return_reader:
+        ret += (video_reader,)
+
+    return ret
+
+
+def read_clips(
+    video_path=None,
+    clips=(),
+    *,
+    sample_mode="round",
+    keyframe_snap=None,
+    video_reader=None,
+    # decord kwargs
+    size=None,
+    max_size=None,
+    bridge="native",
+    # input format
+    is_online_video=False,
+    is_youtube_video=False,
+    is_bytes=False,
+    # output format
+    output_format="tchw",
+    # return
+    return_reader=False,
+    return_meta=False,
+    output_buffer=False,
+):
+    """Read several clips of a video with a single reader, decoding frames shared by clips once.
+
+    Args:
+        clips: a list of (start, end, num_frames) tuples, or of dicts with "start", "end" (secs,
+            None for the start/end of the video) and "num_frames" or "fps" (neither for all
+            frames), and optionally "sample_mode"
+        other args: as in read_frames_decord (with output_buffer, each clip is its own shared tensor)
+    Returns:
+        a list with the frames of each clip, plus the meta and/or the reader if requested
+    """
+    decord.bridge.set_bridge(bridge)
+    video_reader, meta_key = _reader_and_key(
+        video_path,
+        video_reader,
+        size=size,
+        max_size=max_size,
+        is_online_video=is_online_video,
+        is_youtube_video=is_youtube_video,
+        is_bytes=is_bytes,
+    )
+    vlen = len(video_reader)
+    fps_orig = video_reader.get_avg_fps()
+    duration = vlen / float(fps_orig)
+
+    clip_metas = []
+    for clip in clips:
+        if not isinstance(clip, dict):
+            clip = dict(zip(["start", "end", "num_frames"], clip))
+        start = clip.get("start") or 0.0
+        end = min(clip["end"], duration) if clip.get("end") is not None else duration
+        lo = min(int(start * fps_orig), vlen - 1)
+        hi = max(min(int(math.ceil(end * fps_orig)), vlen), lo + 1)
+        num_frames, fps = clip.get("num_frames"), clip.get("fps")
+        if num_frames is None and fps is None:
+            num_frames = hi - lo
+        num_frames, fps, clip_duration = fill_temporal_param(duration=(hi - lo) / fps_orig, num_frames=num_frames, fps=fps)
+        frame_indices = get_frame_indices(num_frames, hi - lo, mode=clip.get("sample_mode", sample_mode))
+        clip_metas.append(
+            {
+                "start": start,
+                "end": end,
+                "fps": fps,
+                "duration": clip_duration,
+                "frame_indices": np.asarray(frame_indices, dtype=np.int64) + lo,
+            }
+        )
+
+    # decode the union of the indices once, in order
+    key_indices = get_key_indices(video_reader, key=meta_key) if keyframe_snap is not None or return_meta else None
+    requested = [clip_meta["frame_indices"] for clip_meta in clip_metas]
+    unique = np.unique(np.concatenate(requested)) if len(requested) > 0 else np.zeros(0, dtype=np.int64)
+    if keyframe_snap is not None and len(unique) > 0:
+        snapped = np.asarray(snap_frame_indices(unique, key_indices, keyframe_snap, vlen=vlen), dtype=np.int64)
+        for clip_meta in clip_metas:
+            clip_meta["frame_indices"] = snapped[np.searchsorted(unique, clip_meta["frame_indices"])]
+        # snapping may map neighbouring indices to the same frame
+        unique = np.unique(snapped)
+    outputs = []
+    if output_buffer and len(unique) > 0:
+        batch, _ = decode_unique_frames(video_reader, unique)
+        for clip_meta in clip_metas:
+            index = np.searchsorted(unique, clip_meta["frame_indices"])
+            outputs.append(frames_to_shared(batch, output_format, index=index))
+    else:
+        frames = fetch_frames(video_reader, unique) if len(unique) > 0 else None  # (T, H, W, C)
+        for clip_meta in clip_metas:
+            clip_frames = frames[np.searchsorted(unique, clip_meta["frame_indices"])]
+            outputs.append(rearrange(clip_frames, f"t h w c -> {' '.join(output_format)}"))
+
+    if not return_reader and not return_meta:
+        return outputs
+
+    ret = (outputs,)
+
+    if return_meta:
+        meta = {
+            "fps": fps_orig,
+            "vlen": vlen,
+            "duration": duration,
+            "clips": clip_metas,
+            "unique_frames": len(unique),
+            "decoded_frames": decode_cost(unique, key_indices) if len(unique) > 0 else 0,
         }
         ret += (meta,)
 
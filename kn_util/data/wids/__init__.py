@@ -6,4 +6,14 @@
 import torch
 
 from .wids import ShardListDataset, ShardListDatasetAnnotated
-from .wids_sampler import ChunkedSampler, ChunkedSamplerV2, DistributedChunkedSampler
+from .wids_prefetch import ShardPrefetcher
+from .wids_stream import ShardListStream
+from .wids_ztar import CompressedIndexedTar, compress_tar
+from .wids_sampler import (
+    ChunkedSampler,
+    ChunkedSamplerV2,
+    DistributedChunkedSampler,
+    MixtureChunkedSampler,
+    ShardAffineBatchSampler,
+    shard_affine_worker_init_fn,
+)
@@ -1,11 +1,13 @@
 import base64
+import bisect
 import gzip
 import hashlib
 import io
 import os
 import os.path as osp
 import re
-import sqlite3
+import resource
+import struct
 import uuid
 from functools import partial
 from glob import glob
@@ -17,22 +19,19 @@ import dill
 import numpy as np
 from loguru import logger
 
-from kn_util.utils.io import load_jsonl, load_pickle, save_pickle
-from kn_util.utils.multiproc import map_async_with_thread
-from kn_util.utils.system import get_strhash, is_valid_file
-
-from ...dist import (
-    all_gather_object,
-    get_world_size,
-    is_main_process,
-    get_rank,
-)
-from .wids_dl import download_and_open
+
+from ...dist import is_main_process
+from .wids_anno import AnnotationStore
+from .wids_cache import SharedShardCache
+from .wids_dl import connect_cache_db, download_and_open
+from .wids_keyindex import KeyIndex
 from .wids_lru import LRUCache
-from .wids_mmtar import MMIndexedTar
+from .wids_mmtar import MMIndexedTar, find_mmindex_file
+from .wids_samplecache import DecodedSampleCache
 from .wids_specs import urldir
 from .wids_tar import TarFileReader, find_index_file
-from .wids_utils import get_tarfile_keys
+from .wids_ztar import CompressedIndexedTar, compressed_codec
+from .wids_utils import get_files_hash, get_tarfile_index, scan_tar_keys
 
 try:
     from torch.utils.data import Dataset, Sampler
@@ -47,6 +46,9 @@ except ImportError:
 
 T = TypeVar("T")
 
+# per-thread page fault counters where available
+RUSAGE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
 T_co = TypeVar("T_co", covariant=True)
 
 
@@ -139,6 +141,95 @@ def group_by_key(names):
     return groups
 
 
+class MemoryViewReader(io.RawIOBase):
+    """A read-only, seekable file object over a memoryview that does not copy the buffer.
+
+    Only the bytes actually read by the consumer are copied.
+    """
+
+    def __init__(self, buffer):
+        self.buffer = memoryview(buffer).cast("B")
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self.pos = offset
+        elif whence == io.SEEK_CUR:
+            self.pos += offset
+        elif whence == io.SEEK_END:
+            self.pos = len(self.buffer) + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        self.pos = max(self.pos, 0)
+        return self.pos
+
+    def readinto(self, b):
+        chunk = self.buffer[self.pos : self.pos + len(b)]
+        n = len(chunk)
+        memoryview(b).cast("B")[:n] = chunk
+        self.pos += n
+        return n
+
+    def getbuffer(self):
+        return self.buffer
+
+
+def load_npy_buffer(buffer):
+    """Load a .npy payload as an array backed by `buffer` (read-only, no copy).
+
+    Falls back to np.load for object arrays, which cannot be viewed in place.
+    """
+    buffer = memoryview(buffer).cast("B")
+    major = buffer[6]
+    if major == 1:
+        (header_len,) = struct.unpack("<H", buffer[8:10])
+        data_offset = 10 + header_len
+    else:
+        (header_len,) = struct.unpack("<I", buffer[8:12])
+        data_offset = 12 + header_len
+    header = io.BytesIO(buffer[:data_offset])
+    version = np.lib.format.read_magic(header)
+    if version == (1, 0):
+        shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(header)
+    else:
+        shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(header)
+    if dtype.hasobject:
+        return np.load(MemoryViewReader(buffer))
+    count = int(np.prod(shape))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=data_offset)
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def detach_views(sample):
+    """Replace the zero-copy memoryviews left in a sample by BytesIO copies.
+
+    memoryviews (and MemoryViewReaders over them) cannot be pickled, so a sample
+    that still holds one could not leave a DataLoader worker or enter the decoded
+    sample cache. Lists and tuples of samples are handled too.
+    """
+    if isinstance(sample, (list, tuple)):
+        return type(sample)(detach_views(item) for item in sample)
+    if not isinstance(sample, dict):
+        return sample
+    for key, value in sample.items():
+        if isinstance(value, memoryview):
+            sample[key] = io.BytesIO(value)
+        elif isinstance(value, MemoryViewReader):
+            stream = io.BytesIO(value.getbuffer())
+            stream.seek(value.tell())
+            sample[key] = stream
+    return sample
+
+
 def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] = True):
     """A default decoder for webdataset.
 
@@ -147,6 +238,11 @@ def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] =
     These are the most common extensions used in webdataset.
     For other extensions, users can provide their own decoder.
 
+    Values may be file objects or zero-copy memoryviews (see IndexedTarSamples'
+    zero_copy mode). Arrays decoded from .npy memoryviews are read-only views
+    of the shard; copy them if they need to be modified. Files with extensions
+    that are not decoded here are returned as BytesIO copies (see detach_views).
+
     Args:
         sample: sample, modified in place
     """
@@ -156,6 +252,11 @@ def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] =
         if len(extensions) < 1:
             continue
         extension = extensions[-1]
+        if isinstance(stream, memoryview):
+            if extension == "npy":
+                sample[key] = load_npy_buffer(stream)
+                continue
+            stream = MemoryViewReader(stream)
         if extension in ["gz"]:
             decompressed = gzip.decompress(stream.read())
             stream = io.BytesIO(decompressed)
@@ -204,7 +305,7 @@ def default_decoder(sample: Dict[str, Any], format: Optional[Union[bool, str]] =
             import pickle
 
             sample[key] = pickle.load(stream)
-    return sample
+    return detach_views(sample)
 
 
 open_itfs = {}
@@ -231,8 +332,18 @@ class IndexedTarSamples:
         expected_size=None,
         use_mmap=True,
         index_file=find_index_file,
+        mmindex_file=find_mmindex_file,
+        zero_copy=False,
+        advice=None,
     ):
+        """
+        Args:
+            zero_copy: return the files of a sample as read-only memoryviews into the
+                mmapped shard instead of BytesIO copies. Only effective with use_mmap.
+            advice: madvise hint for the mmapped shard ("random", "sequential", "normal")
+        """
         assert path is not None or stream is not None
+        self.zero_copy = zero_copy and use_mmap
 
         # Create TarFileReader object to read from tar_file
         self.path = path
@@ -245,22 +356,23 @@ class IndexedTarSamples:
             assert got == md5sum, f"MD5 sum mismatch: expected {md5sum}, got {got}"
             stream.seek(0)
 
-        # use either the mmap or the stream based implementation
-        # NOTE(ligeng): https://stackoverflow.com/questions/11072705/twitter-trends-api-unicodedecodeerror-utf8-codec-cant-decode-byte-0x8b-in-po
-        # import gzip
-        # print("convert to gzip IO stream")
-        # stream = gzip.GzipFile(fileobj=stream)
-
-        if use_mmap:
-            self.reader = MMIndexedTar(stream)
+        # use either the mmap or the stream based implementation;
+        # compressed shards (.tar.gz/.tar.zst) go through their frame table
+        if compressed_codec(path or getattr(stream, "name", None)) is not None:
+            self.reader = CompressedIndexedTar(stream, index_file=mmindex_file)
+            self.samples = self.reader.sample_groups()
+        elif use_mmap:
+            self.reader = MMIndexedTar(stream, index_file=mmindex_file, advice=advice)
+            # the grouping is persisted with the binary index, no need to parse names
+            self.samples = self.reader.sample_groups()
         else:
             self.reader = TarFileReader(stream, index_file=index_file)
 
-        # Get list of all files in stream
-        all_files = self.reader.names()
+            # Get list of all files in stream
+            all_files = self.reader.names()
 
-        # Group files by key into samples
-        self.samples = group_by_key(all_files)
+            # Group files by key into samples
+            self.samples = group_by_key(all_files)
         # print("DEBUG:", list(all_files)[:20])
         # print("DEBUG:", self.samples[:20])
 
@@ -277,6 +389,16 @@ class IndexedTarSamples:
         if not self.stream.closed:
             self.stream.close()
 
+    def willneed(self, indices):
+        """Hint that the samples at the given indices will be read soon; returns the bytes advised."""
+        if not isinstance(self.reader, MMIndexedTar):
+            return 0
+        return self.reader.willneed([i for idx in indices for i in self.samples[idx]])
+
+    def dontneed(self):
+        if isinstance(self.reader, MMIndexedTar):
+            self.reader.dontneed()
+
     def __len__(self):
         return len(self.samples)
 
@@ -287,7 +409,10 @@ class IndexedTarSamples:
         key = None
         for i in indexes:
             # Get filename and data for the file at index i
-            fname, data = self.reader.get_file(i)
+            if self.zero_copy:
+                fname, data = self.reader.get_buffer(i)
+            else:
+                fname, data = self.reader.get_file(i)
             # Split filename into key and extension
             k, ext = splitname(fname)
             # Make sure all files in sample have same key
@@ -308,11 +433,8 @@ class IndexedTarSamples:
 def hash_localname(dldir="/tmp/_wids_cache"):
     os.makedirs(dldir, exist_ok=True)
 
-    connection = sqlite3.connect(os.path.join(dldir, "cache.db"))
+    connection = connect_cache_db(dldir)
     cursor = connection.cursor()
-    cursor.execute(
-        "CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)"
-    )
     connection.commit()
 
     def f(shard):
@@ -331,10 +453,10 @@ def hash_localname(dldir="/tmp/_wids_cache"):
             ].decode()
             # the cache name is the concatenation of the hex16 string and the file name component of the URL
             cachename = "data__" + hex16 + "__" + os.path.basename(urlparse(shard).path)
-            checksum = None
+            # keep the checksum recorded by a previous download
             cursor.execute(
-                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?)",
-                (shard, cachename, checksum),
+                "INSERT INTO cache VALUES (?, ?, NULL) ON CONFLICT(url) DO UPDATE SET path = excluded.path",
+                (shard, cachename),
             )
             connection.commit()
             return os.path.join(dldir, cachename)
@@ -371,11 +493,35 @@ class LRUShards:
     values. The shards are downloaded to a directory specified by dldir.
     The local name of a shard is computed by the localname function, which
     takes the shard URL as an argument. If keep is True, the downloaded files
-    are not deleted when they are no longer needed.
+    are not deleted when they are no longer needed. The binary tar indices of
+    the shards are stored in index_cache (next to the shards if None).
+    If a SharedShardCache is given, downloads go through it, so that all processes
+    on the node share one copy of each shard and its disk budget.
+    Downloaded shards are checked against the md5sum/filesize given for their
+    URL in shard_meta.
     """
 
-    def __init__(self, lru_size, keep=False, localname=default_localname()):
+    def __init__(
+        self,
+        lru_size,
+        keep=False,
+        localname=default_localname(),
+        index_cache=None,
+        zero_copy=False,
+        shared_cache=None,
+        advice=None,
+        use_mmap=True,
+        shard_meta=None,
+    ):
         self.localname = localname
+        self.shard_meta = shard_meta or {}
+        self.advice = advice
+        self.use_mmap = use_mmap
+        self.shared_cache = shared_cache
+        self.mmindex_file = partial(find_mmindex_file, index_cache=index_cache)
+        self.zero_copy = zero_copy
+        # set by ShardPrefetcher, misses wait for in-flight prefetches
+        self.prefetcher = None
         # the cache contains the local name as the key and the downloaded path as the value
         self.lru = LRUCache(lru_size, release_handler=self.release_handler)
         # keep statistics
@@ -389,6 +535,7 @@ class LRUShards:
         return len(self.lru)
 
     def release_handler(self, key, value):
+        value.dontneed()
         value.close()
 
     def clear(self):
@@ -398,9 +545,30 @@ class LRUShards:
         assert isinstance(url, str)
         self.accesses += 1
         if url not in self.lru:
+            if self.prefetcher is not None:
+                self.prefetcher.wait(url)
             local = self.localname(url)
-            with download_and_open(url, local) as stream:
-                itf = IndexedTarSamples(path=local, stream=stream)
+            if self.shared_cache is not None:
+                opener = self.shared_cache.open
+            else:
+                opener = download_and_open
+            stream = opener(url, local, **self.shard_meta.get(url, {}))
+            try:
+                itf = IndexedTarSamples(
+                    path=local,
+                    stream=stream,
+                    use_mmap=self.use_mmap,
+                    mmindex_file=self.mmindex_file,
+                    zero_copy=self.zero_copy,
+                    advice=self.advice,
+                )
+            except Exception:
+                stream.close()
+                raise
+            if isinstance(itf.reader, MMIndexedTar):
+                # the mmap outlives the stream, the other readers keep reading from it;
+                # it holds a duplicate of the descriptor, and with it the shared cache lock
+                stream.close()
             self.lru[url] = itf
             self.misses += 1
             self.last_missed = True
@@ -408,6 +576,17 @@ class LRUShards:
             self.last_missed = False
         return self.lru[url]
 
+    def scan_keys(self, url, **kwargs):
+        """scan_tar_keys of a shard, downloading it first (through the shared cache) if it is remote."""
+        if os.path.exists(url):
+            return scan_tar_keys(url, **kwargs)
+        opener = download_and_open if self.shared_cache is None else self.shared_cache.open
+        stream = opener(url, self.localname(url), **self.shard_meta.get(url, {}))
+        try:
+            return scan_tar_keys(stream.name, **kwargs)
+        finally:
+            stream.close()
+
 
 def interpret_transformations(transformations):
     """Interpret the transformations argument.
@@ -470,7 +649,17 @@ class ShardListDataset(Dataset[T]):
         localname=None,
         # other args
         transformations="PIL",
+        shard_meta=None,
         keep=False,
+        use_mmap=True,
+        zero_copy=False,
+        mmap_advice=None,
+        willneed=False,
+        count_faults=False,
+        decoded_cache_size=0,
+        decoded_cache_dir=None,
+        decoded_cache_disk_size=int(1e11),
+        decoded_cache_prefix=1,
         base=None,
         options=None,
         verbose=False,
@@ -479,24 +668,77 @@ class ShardListDataset(Dataset[T]):
 
         Args:
             shards: a list of (url, nsamples) pairs
-            cache_size: the number of shards to keep in the cache
+            cache_size: the disk budget in bytes of the shared shard cache
+            cache_dir: if given, remote shards (any url that is not a local path,
+                e.g. http:// or file://) are downloaded into this node-level
+                SharedShardCache, shared by all ranks and workers on the node; this
+                already happens when their keys are scanned for the index
             lru_size: the number of shards to keep in the LRU cache
             localname: a function that maps URLs to local filenames
+            shard_meta: optional list of dicts aligned with tar_files with the expected
+                "md5sum" and "filesize" of the shards (e.g. the shardlist written by
+                wids_index); downloaded shards are verified against them
+            use_mmap: read the shards through mmap (MMIndexedTar) instead of TarFileReader
+            zero_copy: hand memoryviews into the mmapped shards to the transformations
+                instead of BytesIO copies; the transformations should decode them
+                (the default "PIL"/"numpy" decoders do). Files they leave undecoded are
+                copied into BytesIO before the sample is returned, so samples can still
+                be sent from DataLoader workers
+            mmap_advice: madvise hint for the mmapped shards, "random" suits shuffled
+                access within chunks (ChunkedSampler) and avoids useless readahead
+            willneed: before reading a batch (__getitems__), madvise(MADV_WILLNEED)
+                the byte ranges of all its samples so the kernel fetches them together
+            count_faults: count the page faults taken while reading and transforming
+                samples (see get_io_stats); costs two getrusage calls per item or batch
+            decoded_cache_size: byte budget of an in-memory (per process) cache of
+                decoded samples, keyed by (shard, inner_idx, cached transformations)
+            decoded_cache_dir: directory of an on-disk cache of decoded samples,
+                shared by the processes on the node
+            decoded_cache_disk_size: byte budget of the on-disk cache of decoded samples
+            decoded_cache_prefix: number of leading per-sample transformations whose
+                output is cached (by default the first one, i.e. the decoder). They
+                must be deterministic; the remaining ones (e.g. random augmentations,
+                or anything added with add_transform) run on every access, after
+                the cache lookup
 
         Note that there are two caches: an on-disk directory, and an in-memory LRU cache.
+        The optional decoded sample cache sits on top of them and skips reading and
+        decoding samples seen before (only the decoded_cache_prefix transformations
+        are cached, batch transformations are not).
 
         """
         os.makedirs(index_cache, exist_ok=True)
         assert isinstance(tar_files, List) and isinstance(
             tar_files[0], str
         ), "tar_files must be a list of paths."
-        # load/create file index
-        keys_by_shard: Dict[str, List[str]] = get_tarfile_keys(
-            tar_files, cache_dir=index_cache
+        meta_by_url = {url: {} for url in tar_files}
+        if shard_meta is not None:
+            assert len(shard_meta) == len(tar_files), "shard_meta must be aligned with tar_files"
+            for url, meta in zip(tar_files, shard_meta):
+                meta_by_url[url] = {k: meta[k] for k in ["md5sum", "filesize"] if meta.get(k) is not None}
+
+        shared_cache = None
+        if cache_dir is not None:
+            shared_cache = SharedShardCache(cache_dir, max_bytes=cache_size)
+            localname = localname or default_localname(cache_dir)
+        self.cache = LRUShards(
+            lru_size,
+            keep=keep,
+            localname=localname or default_localname(),
+            index_cache=index_cache,
+            zero_copy=zero_copy,
+            shared_cache=shared_cache,
+            advice=mmap_advice,
+            use_mmap=use_mmap,
+            shard_meta=meta_by_url,
         )
+        self.zero_copy = self.cache.zero_copy
+
+        # load/create the consolidated key index of all shards; remote shards
+        # are downloaded (into the shared cache, if any) to scan them
+        tar_index = get_tarfile_index(tar_files, cache_dir=index_cache, scan_keys=self.cache.scan_keys)
         print("Indexing complete")
-        self.keys_by_shard = keys_by_shard
-        shards = [(url, len(keys_by_shard[url])) for url in tar_files]
+        shards = [(url, int(nsamples)) for url, nsamples in zip(tar_files, tar_index.lengths)]
 
         super(ShardListDataset, self).__init__()
 
@@ -508,24 +750,25 @@ class ShardListDataset(Dataset[T]):
         self.spec = {
             "shardlist": [{"url": url, "nsamples": nsample} for url, nsample in shards]
         }
+        for shard in self.spec["shardlist"]:
+            shard.update(meta_by_url[shard["url"]])
         if dataset_name is not None:
             self.spec["name"] = dataset_name
         self.shards = self.spec.get("shardlist", [])
         self.dataset_name = dataset_name or hash_dataset_name(str(shards))
+        self.cache_dir = cache_dir
 
         self.lengths = [shard["nsamples"] for shard in self.shards]
         self.cum_lengths = np.cumsum(self.lengths)
+        self.shard_starts = self.cum_lengths - self.lengths
+        self._cum_lengths = self.cum_lengths.tolist()
         self.total_length = self.cum_lengths[-1]
 
-        ## build key2taridx: key -> (shard_idx, inner_idx)
+        ## key_index: key -> (shard_idx, inner_idx), memory-mapped from index_cache
         ## note here inner_idx in the index for tar files
-        key2taridx = {}
-        for shard_idx in range(len(tar_files)):
-            tar_file = tar_files[shard_idx]
-            keys = self.keys_by_shard[tar_file]
-            for inner_idx, key in enumerate(keys):
-                key2taridx[key] = (shard_idx, inner_idx)
-        self.key2taridx = key2taridx
+        key_index_dir = osp.join(index_cache, "keyindex_" + get_files_hash(tar_files))
+        self.key_index = KeyIndex.load_or_build(key_index_dir, tar_index.keys_by_shard)
+        del tar_index
 
         if verbose or int(os.environ.get("WIDS_VERBOSE", 0)):
             nbytes = sum(shard.get("filesize", 0) for shard in self.shards)
@@ -546,21 +789,78 @@ class ShardListDataset(Dataset[T]):
                 )
             )
         self.transformations = interpret_transformations(transformations)
-
-        self.cache = LRUShards(lru_size, keep=keep)
+        self.batch_transformations = []
+
+        self.willneed = willneed
+        self.count_faults = count_faults
+        self.reset_io_stats()
+
+        self.sample_cache = None
+        self.decoded_cache_prefix = decoded_cache_prefix
+        if decoded_cache_size > 0 or decoded_cache_dir is not None:
+            self.sample_cache = DecodedSampleCache(
+                mem_bytes=decoded_cache_size,
+                cache_dir=decoded_cache_dir,
+                disk_bytes=decoded_cache_disk_size,
+                transform_hash=get_funchash(self.transformations[:decoded_cache_prefix]),
+            )
 
     def add_transform(self, transform):
         """Add a transformation to the dataset."""
         self.transformations.append(transform)
+        if self.sample_cache is not None:
+            # cached samples no longer match if the transformation joins the cached prefix
+            self.sample_cache.transform_hash = get_funchash(self.transformations[: self.decoded_cache_prefix])
+        return self
+
+    def add_batch_transform(self, transform):
+        """Add a transformation that maps a list of samples to a list of samples.
+
+        Batch transformations run after the per-sample ones; __getitem__ applies
+        them to a batch of one.
+        """
+        self.batch_transformations.append(transform)
         return self
 
     def __len__(self):
         """Return the total number of samples in the dataset."""
         return self.total_length
 
-    def get_stats(self):
-        """Return the number of cache accesses and misses."""
-        return self.cache.accesses, self.cache.misses
+    def get_stats(self, detail=False):
+        """Return the number of cache accesses and misses.
+
+        With detail=True, return a dict that also holds the stats of the decoded
+        sample cache (if enabled).
+        """
+        if not detail:
+            return self.cache.accesses, self.cache.misses
+        stats = dict(accesses=self.cache.accesses, misses=self.cache.misses)
+        if self.sample_cache is not None:
+            stats.update({"decoded_" + k: v for k, v in self.sample_cache.get_stats().items()})
+        return stats
+
+    def reset_io_stats(self):
+        self.io_stats = dict(major_faults=0, minor_faults=0, willneed_bytes=0)
+
+    def get_io_stats(self):
+        """Return the page faults taken while reading and transforming samples and the bytes hinted with MADV_WILLNEED.
+
+        Faults are only counted with count_faults=True. They cover the transformations,
+        where zero_copy samples first touch the mapped pages, so they include the
+        decoders' own allocations too: compare runs with the same transformations,
+        with and without mmap_advice/willneed/zero_copy, to see the savings.
+        """
+        return dict(self.io_stats)
+
+    def _usage(self):
+        return resource.getrusage(RUSAGE) if self.count_faults else None
+
+    def _count_faults(self, usage_before):
+        if usage_before is None:
+            return
+        usage = resource.getrusage(RUSAGE)
+        self.io_stats["major_faults"] += usage.ru_majflt - usage_before.ru_majflt
+        self.io_stats["minor_faults"] += usage.ru_minflt - usage_before.ru_minflt
 
     def check_cache_misses(self):
         """Check if the cache miss rate is too high."""
@@ -574,14 +874,26 @@ class ShardListDataset(Dataset[T]):
                 )
             )
 
+    def locate(self, indices):
+        """Vectorized version of the index -> (shard_idx, inner_idx) mapping."""
+        indices = np.asarray(indices, dtype=np.int64)
+        shard_idx = np.searchsorted(self.cum_lengths, indices, side="right")
+        inner_idx = indices - self.shard_starts[shard_idx]
+        return shard_idx, inner_idx
+
+    def lookup(self, keys):
+        """Batched key -> (shard_idx, inner_idx) lookup, -1 for missing keys."""
+        return self.key_index.lookup(keys)
+
     def get_shard(self, index):
         """Get the shard and index within the shard corresponding to the given index."""
         # Find the shard corresponding to the given index.
-        shard_idx = np.searchsorted(self.cum_lengths, index, side="right")
+        # NOTE: bisect on a list avoids the numpy call overhead for a single index
+        shard_idx = bisect.bisect_right(self._cum_lengths, index)
 
         # Figure out which index within the shard corresponds to the
         # given index.
-        inner_idx = index - self.cum_lengths[shard_idx - 1] if shard_idx > 0 else index
+        inner_idx = index - self._cum_lengths[shard_idx - 1] if shard_idx > 0 else index
 
         # Get the shard and return the corresponding element.
         desc = self.shards[shard_idx]
@@ -596,8 +908,11 @@ class ShardListDataset(Dataset[T]):
 
     def __getitem__(self, index):
         """Return the sample corresponding to the given index."""
+        if self.sample_cache is not None:
+            return self.__getitems__([index])[0]
         shard, inner_idx, desc = self.get_shard(index)
 
+        usage_before = self._usage()
         sample = shard[inner_idx]
 
         # Check if we're missing the cache too often.
@@ -609,11 +924,94 @@ class ShardListDataset(Dataset[T]):
         sample["__shardindex__"] = inner_idx
 
         # Apply transformations
-        for transform in self.transformations:
-            sample = transform(sample)
+        sample = self.apply_transformations(sample)
+        self._count_faults(usage_before)
+
+        if self.batch_transformations:
+            sample = self.apply_batch_transformations([sample])[0]
 
         return sample
 
+    def apply_transformations(self, sample, transformations=None):
+        for transform in self.transformations if transformations is None else transformations:
+            sample = transform(sample)
+        if self.zero_copy:
+            # memoryviews the transformations did not decode cannot be pickled
+            sample = detach_views(sample)
+        return sample
+
+    def apply_batch_transformations(self, samples):
+        for transform in self.batch_transformations:
+            samples = transform(samples)
+        return samples
+
+    def read_batch(self, shard_ids, inner_ids, indices):
+        """Read raw samples (before transformations), returned in input order.
+
+        Reads are grouped by shard, so each shard is looked up in the cache once,
+        and within a shard samples are read in tar order for sequential mmap access.
+        """
+        shard_ids = np.asarray(shard_ids)
+        inner_ids = np.asarray(inner_ids)
+        samples = [None] * len(shard_ids)
+        order = np.lexsort((inner_ids, shard_ids))
+        boundaries = np.flatnonzero(np.diff(shard_ids[order])) + 1
+        for group in np.split(order, boundaries):
+            if len(group) == 0:
+                continue
+            desc = self.shards[shard_ids[group[0]]]
+            shard = self.cache.get_shard(desc["url"])
+            # account for every sample, like per-item access does
+            self.cache.accesses += len(group) - 1
+            if self.willneed:
+                self.io_stats["willneed_bytes"] += shard.willneed(inner_ids[group].tolist())
+            for pos in group:
+                inner_idx = int(inner_ids[pos])
+                sample = shard[inner_idx]
+                sample["__dataset__"] = desc.get("dataset")
+                sample["__index__"] = indices[pos]
+                sample["__shard__"] = desc["url"]
+                sample["__shardindex__"] = inner_idx
+                samples[pos] = sample
+
+        # Check if we're missing the cache too often.
+        self.check_cache_misses()
+        return samples
+
+    def __getitems__(self, indices):
+        """Return the samples for a batch of indices (used by DataLoader with batching)."""
+        indices = list(indices)
+        shard_ids, inner_ids = self.locate(indices)
+        usage_before = self._usage()
+        samples = self.read_transformed(shard_ids, inner_ids, indices)
+        self._count_faults(usage_before)
+        return self.apply_batch_transformations(samples)
+
+    def read_transformed(self, shard_ids, inner_ids, indices):
+        """Like read_batch, with the per-sample transformations applied (through the decoded sample cache)."""
+        shard_ids = np.asarray(shard_ids)
+        inner_ids = np.asarray(inner_ids)
+        if self.sample_cache is None:
+            samples = self.read_batch(shard_ids, inner_ids, indices)
+            return [self.apply_transformations(sample) for sample in samples]
+
+        # only read and decode the samples that are not cached
+        cached = self.transformations[: self.decoded_cache_prefix]
+        keys = [self.sample_cache.key(self.shards[s]["url"], i) for s, i in zip(shard_ids.tolist(), inner_ids.tolist())]
+        samples = self.sample_cache.get_many(keys)
+        missing = [pos for pos, sample in enumerate(samples) if sample is None]
+        if len(missing) > 0:
+            loaded = self.read_batch(shard_ids[missing], inner_ids[missing], [indices[pos] for pos in missing])
+            loaded = [self.apply_transformations(sample, cached) for sample in loaded]
+            self.sample_cache.put_many([keys[pos] for pos in missing], loaded)
+            for pos, sample in zip(missing, loaded):
+                samples[pos] = sample
+        # the rest (e.g. random augmentations) runs on every access
+        rest = self.transformations[self.decoded_cache_prefix :]
+        if len(rest) > 0:
+            samples = [self.apply_transformations(sample, rest) for sample in samples]
+        return samples
+
     def close(self):
         """Close the dataset."""
         self.cache.clear()
@@ -627,37 +1025,9 @@ def get_funchash(func):
     return sha256(func_str).hexdigest()[:16]
 
 
-def _load_indices_by_jsonl(
-    jsonl_file,
-    cache_dir="/tmp/jsonl_index/",
-    sample_filter=None,
-):
-    os.makedirs(cache_dir, exist_ok=True)
-    filehash = get_strhash(jsonl_file)
-    sample_filter_hash = get_funchash(sample_filter)
-    cache_file = osp.join(cache_dir, filehash + sample_filter_hash + ".pkl")
-    if is_valid_file(cache_file):
-        return load_pickle(cache_file)
-
-    jsonl_content = load_jsonl(jsonl_file)
-
-    if sample_filter is None:
-        jsonl_index = list(range(len(jsonl_content)))
-    else:
-        jsonl_index = [
-            idx
-            for idx in range(len(jsonl_content))
-            if sample_filter(jsonl_content[idx])
-        ]
-
-    save_pickle(jsonl_index, cache_file)
-
-    return jsonl_index
-
-
 class ShardListDatasetAnnotated(ShardListDataset):
     """
-    1. build key2taridx: key -> (shard_idx, inner_idx)
+    1. build key_index: key -> (shard_idx, inner_idx)
     2. index -> all valid keys -> key -> (shard_idx, inner_idx) -> sample
     """
 
@@ -709,40 +1079,15 @@ class ShardListDatasetAnnotated(ShardListDataset):
         tar_files = [osp.join(tar_root, shard + ".tar") for shard in shards]
         jsonl_files = [osp.join(jsonl_root, shard + ".jsonl") for shard in shards]
 
-        ## load keys from jsonl files
-        num_partitions = min(len(jsonl_files), get_world_size())
-        partition_idx = get_rank()
-        jsonl_files_at_rank = (
-            np.array_split(jsonl_files, num_partitions)[partition_idx]
-            if partition_idx < num_partitions
-            else []
-        )
-        indices_groupby_jsonl_at_rank = map_async_with_thread(
-            iterable=jsonl_files_at_rank,
-            func=lambda f: _load_indices_by_jsonl(
-                f,
-                cache_dir=anno_index_cache,
-                sample_filter=sample_filter,
-            ),
-            verbose=True,
-            desc="Gathering keys from json files",
-            num_thread=64,
-        )
-        indices_groupby_jsonl = all_gather_object(indices_groupby_jsonl_at_rank)
-        indices_groupby_jsonl = [
-            indices for sublist in indices_groupby_jsonl for indices in sublist
-        ]
-        # jsonl_files[i] -> indices_groupby_jsonl[i]
-
-        self.cum_lengths_jsonl = np.cumsum(
-            [len(indices) for indices in indices_groupby_jsonl]
+        ## index the jsonl rows into a memory-mapped store, decoded one row at a time
+        # jsonl_files[i] -> anno_store.shard_idx == i
+        self.anno_store = AnnotationStore(
+            jsonl_files,
+            cache_dir=anno_index_cache,
+            sample_filter=sample_filter,
+            filter_hash=get_funchash(sample_filter),
         )
-
-        self.indexing_pairs = [
-            (shards[i], idx)
-            for i in range(len(jsonl_files))
-            for idx in indices_groupby_jsonl[i]
-        ]  # all (shardname, inner_idx_in_jsonl) pairs after filtering
+        self.cum_lengths_jsonl = np.cumsum(self.anno_store.counts())
 
         super().__init__(
             tar_files=tar_files,
@@ -751,23 +1096,17 @@ class ShardListDatasetAnnotated(ShardListDataset):
         )
 
         self.jsonl_files = jsonl_files
-        self.jsonl_cache = LRUCache(capacity=self.cache.lru.capacity)
         self.anno_key_column = anno_key_column
 
     def get_jsonl(self, index):
-        shard, inner_idx_in_jsonl = self.indexing_pairs[index]
-
-        if shard not in self.jsonl_cache:
-            jsonl_dir = osp.dirname(self.jsonl_files[0])
-            jsonl_filename = osp.join(jsonl_dir, shard + ".jsonl")
-            self.jsonl_cache[shard] = load_jsonl(jsonl_filename)
-        return self.jsonl_cache[shard][inner_idx_in_jsonl]
+        return self.anno_store[index]
 
     def get_by_key(self, key):
-        shard_idx, inner_idx_in_tar = self.key2taridx[key]
+        shard_idx, inner_idx_in_tar = self.key_index[key]
         desc = self.shards[shard_idx]
         shard = self.cache.get_shard(desc["url"])
 
+        usage_before = self._usage()
         sample = shard[inner_idx_in_tar]
         index = (
             self.cum_lengths_jsonl[shard_idx - 1] + inner_idx_in_tar
@@ -784,16 +1123,34 @@ class ShardListDatasetAnnotated(ShardListDataset):
         sample["__shardindex__"] = inner_idx_in_tar
 
         # Apply transformations
-        for transform in self.transformations:
-            sample = transform(sample)
+        sample = self.apply_transformations(sample)
+        self._count_faults(usage_before)
+
+        if self.batch_transformations:
+            sample = self.apply_batch_transformations([sample])[0]
 
         return sample
 
     def __getitem__(self, index):
+        if self.sample_cache is not None:
+            return self.__getitems__([index])[0]
         anno_item = self.get_jsonl(index)
         item = self.get_by_key(anno_item[self.anno_key_column])
 
         return item, anno_item
 
+    def __getitems__(self, indices):
+        anno_items = [self.get_jsonl(index) for index in indices]
+        shard_ids, inner_ids = self.lookup([anno_item[self.anno_key_column] for anno_item in anno_items])
+        if (shard_ids < 0).any():
+            missing = [anno_items[i][self.anno_key_column] for i in np.flatnonzero(shard_ids < 0)]
+            raise KeyError(missing)
+        shard_starts = np.concatenate([[0], self.cum_lengths_jsonl[:-1]])
+        usage_before = self._usage()
+        items = self.read_transformed(shard_ids, inner_ids, (shard_starts[shard_ids] + inner_ids).tolist())
+        self._count_faults(usage_before)
+        items = self.apply_batch_transformations(items)
+        return list(zip(items, anno_items))
+
     def __len__(self):
-        return len(self.indexing_pairs)
+        return len(self.anno_store)
@@ -0,0 +1,165 @@
+"""
+A bounded-memory, memory-mapped annotation store for ShardListDatasetAnnotated.
+
+Instead of keeping parsed JSONL files and a Python list of (shard, row) pairs,
+the annotations are indexed once into flat arrays:
+
+    shard_idx     int32[n]           jsonl file of each (filtered) annotation
+    row_idx       int32[n]           line of each annotation in its jsonl file
+    line_offsets  int64[nlines + f]  byte offsets of the lines of all files, one
+                                     trailing end offset per file
+    line_starts   int64[f + 1]       start of each file's offsets in line_offsets
+
+The arrays are saved as .npy files and memory-mapped, so they are shared across
+DataLoader workers, and reading an annotation decodes a single JSONL line.
+"""
+
+import json
+import mmap
+import os
+import os.path as osp
+import shutil
+import uuid
+
+import numpy as np
+
+from kn_util.utils.multiproc import map_async_with_thread
+from kn_util.utils.system import get_strhash
+
+from ...dist import all_gather_object, get_rank, get_world_size
+from .wids_lru import LRUCache
+
+
+def scan_jsonl_lines(jsonl_file, sample_filter=None):
+    """Return the byte offsets of the lines of a jsonl file (plus the end offset)
+    and the indices of the lines that pass sample_filter."""
+    line_offsets = [0]
+    indices = []
+    with open(jsonl_file, "rb") as f:
+        for idx, line in enumerate(f):
+            line_offsets.append(line_offsets[-1] + len(line))
+            if sample_filter is None or sample_filter(json.loads(line)):
+                indices.append(idx)
+    return np.array(line_offsets, dtype=np.int64), np.array(indices, dtype=np.int32)
+
+
+def _load_jsonl_lines(jsonl_file, cache_dir, sample_filter=None, filter_hash=""):
+    os.makedirs(cache_dir, exist_ok=True)
+    cache_file = osp.join(cache_dir, get_strhash(jsonl_file) + filter_hash + ".npz")
+    if osp.exists(cache_file):
+        with np.load(cache_file) as data:
+            return data["line_offsets"], data["indices"]
+    line_offsets, indices = scan_jsonl_lines(jsonl_file, sample_filter=sample_filter)
+    temp_file = f"{cache_file}.{uuid.uuid4().hex}.temp.npz"
+    np.savez(temp_file, line_offsets=line_offsets, indices=indices)
+    os.replace(temp_file, cache_file)
+    return line_offsets, indices
+
+
+class AnnotationStore:
+    """Random access to the (filtered) rows of a list of jsonl files.
+
+    Args:
+        jsonl_files: list of jsonl paths, the shard_idx of a row indexes this list
+        cache_dir: where the per-file line indices and the consolidated arrays are cached
+        sample_filter: optional predicate on the decoded rows
+        filter_hash: fingerprint of sample_filter used in the cache names
+        max_open_files: number of jsonl files kept mmapped per process
+    """
+
+    FILES = ["shard_idx", "row_idx", "line_offsets", "line_starts"]
+
+    def __init__(self, jsonl_files, cache_dir="/tmp/anno_index/", sample_filter=None, filter_hash="", max_open_files=20):
+        self.jsonl_files = list(jsonl_files)
+        index_dir = osp.join(cache_dir, "annoindex_" + get_strhash("\n".join(self.jsonl_files) + filter_hash))
+        cached = all(osp.exists(osp.join(index_dir, name + ".npy")) for name in self.FILES)
+        # building is collective: with node-local cache dirs, only a hit on every rank may skip it
+        if not all(all_gather_object(cached)):
+            self._build(index_dir, cache_dir, sample_filter, filter_hash)
+        for name in self.FILES:
+            setattr(self, name, np.load(osp.join(index_dir, name + ".npy"), mmap_mode="r"))
+        self.max_open_files = max_open_files
+        self.handles = LRUCache(max_open_files, release_handler=self._release)
+
+    def _build(self, index_dir, cache_dir, sample_filter, filter_hash):
+        ## load line indices from jsonl files, partitioned over ranks
+        num_partitions = min(len(self.jsonl_files), get_world_size())
+        partition_idx = get_rank()
+        jsonl_files_at_rank = (
+            np.array_split(self.jsonl_files, num_partitions)[partition_idx]
+            if partition_idx < num_partitions
+            else []
+        )
+        lines_at_rank = map_async_with_thread(
+            iterable=jsonl_files_at_rank,
+            func=lambda f: _load_jsonl_lines(
+                f,
+                cache_dir=cache_dir,
+                sample_filter=sample_filter,
+                filter_hash=filter_hash,
+            ),
+            verbose=True,
+            desc="Indexing jsonl files",
+            num_thread=64,
+        )
+        lines = [x for sublist in all_gather_object(lines_at_rank) for x in sublist]
+
+        counts = [len(indices) for line_offsets, indices in lines]
+        arrays = dict(
+            shard_idx=np.repeat(np.arange(len(lines), dtype=np.int32), counts),
+            row_idx=np.concatenate([indices for line_offsets, indices in lines] or [np.zeros(0)]).astype(np.int32),
+            line_offsets=np.concatenate([line_offsets for line_offsets, indices in lines] or [np.zeros(0)]).astype(
+                np.int64
+            ),
+            line_starts=np.concatenate([[0], np.cumsum([len(line_offsets) for line_offsets, indices in lines])]).astype(
+                np.int64
+            ),
+        )
+
+        temp_dir = f"{index_dir}.{uuid.uuid4().hex}.temp"
+        os.makedirs(temp_dir, exist_ok=True)
+        for name, array in arrays.items():
+            np.save(osp.join(temp_dir, name + ".npy"), array)
+        try:
+            os.rename(temp_dir, index_dir)
+        except OSError:
+            # another process saved the same index first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @staticmethod
+    def _release(key, value):
+        value.close()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["handles"] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.handles = LRUCache(self.max_open_files, release_handler=self._release)
+
+    def __len__(self):
+        return len(self.shard_idx)
+
+    def counts(self):
+        """Number of rows per jsonl file."""
+        return np.bincount(self.shard_idx, minlength=len(self.jsonl_files))
+
+    def locate(self, index):
+        """Return (shard_idx, row_idx) of an annotation."""
+        return int(self.shard_idx[index]), int(self.row_idx[index])
+
+    def _get_handle(self, shard_idx):
+        handle = self.handles[shard_idx]
+        if handle is None:
+            with open(self.jsonl_files[shard_idx], "rb") as f:
+                handle = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self.handles[shard_idx] = handle
+        return handle
+
+    def __getitem__(self, index):
+        shard_idx, row_idx = self.locate(index)
+        pos = self.line_starts[shard_idx] + row_idx
+        start, end = self.line_offsets[pos], self.line_offsets[pos + 1]
+        return json.loads(self._get_handle(shard_idx)[start:end])
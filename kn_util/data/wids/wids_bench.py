@@ -1,47 +1,267 @@
+"""
+Throughput benchmark for ShardListDataset on synthetic WebDataset shards.
+
+    # generate shards with jpg/npy/mp4 blobs
+    python -m kn_util.data.wids.wids_bench generate /tmp/wids_bench --num-shards 16 --samples-per-shard 500
+
+    # sweep lru_size / reader / sampler / num_workers and append the results to a JSON file
+    python -m kn_util.data.wids.wids_bench run /tmp/wids_bench -o results.json \
+        --lru-size 2 8 --reader mmap tarfile --sampler ShardListSampler ChunkedSampler --num-workers 0 4
+
+Each result records the configuration, samples/sec, bytes/sec and the LRU cache
+hit rate (from `get_stats`, summed over DataLoader workers), so runs can be
+compared over time.
+"""
+
 import argparse
+import glob
+import io
+import itertools
 import json
+import os
+import os.path as osp
+import platform
+import shutil
+import tarfile
+import tempfile
+import time
+
+import numpy as np
+from torch.utils.data import DataLoader, get_worker_info
 
 from . import wids
-from .compat import WebDataset
+from .wids_sampler import ChunkedSampler, ChunkedSamplerV2, ShardListSampler
+
+DEFAULT_BLOBS = {"jpg": 100_000, "npy": 40_000, "mp4": 1_000_000}
+
+
+def make_blob(kind, size, rng):
+    """Return a payload of roughly `size` bytes for the given extension."""
+    if kind == "npy":
+        stream = io.BytesIO()
+        np.save(stream, rng.integers(0, 255, size=max(size - 128, 1), dtype=np.uint8))
+        return stream.getvalue()
+    if kind == "jpg":
+        from PIL import Image
+
+        side = max(int((size / 3) ** 0.5), 8)
+        image = Image.fromarray(rng.integers(0, 255, size=(side, side, 3), dtype=np.uint8))
+        stream = io.BytesIO()
+        image.save(stream, format="JPEG", quality=95)
+        return stream.getvalue()
+    if kind in ["txt", "cls"]:
+        return str(int(rng.integers(0, 1000))).encode()
+    # mp4 and anything else: opaque random bytes
+    return rng.bytes(size)
+
+
+def make_synthetic_shards(outdir, num_shards=8, samples_per_shard=200, blobs=DEFAULT_BLOBS, size_jitter=0.2, seed=0):
+    """Write `num_shards` WebDataset tars with one member per entry of `blobs` ({ext: nbytes}) per sample."""
+    os.makedirs(outdir, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    files = []
+    for shard_idx in range(num_shards):
+        fname = osp.join(outdir, f"shard-{shard_idx:06d}.tar")
+        with tarfile.open(fname + ".temp", "w") as tar:
+            for sample_idx in range(samples_per_shard):
+                key = f"{shard_idx:06d}{sample_idx:06d}"
+                for ext, size in blobs.items():
+                    size = int(size * (1 + size_jitter * rng.uniform(-1, 1)))
+                    data = make_blob(ext, size, rng)
+                    info = tarfile.TarInfo(f"{key}.{ext}")
+                    info.size = len(data)
+                    tar.addfile(info, io.BytesIO(data))
+        os.rename(fname + ".temp", fname)
+        files.append(fname)
+    return files
+
+
+class _Measure:
+    """Transformation that replaces a sample by its raw byte count and the cache stats of the loading process."""
+
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    def __call__(self, sample):
+        nbytes = 0
+        for key, value in sample.items():
+            if isinstance(value, io.BytesIO):
+                nbytes += value.getbuffer().nbytes
+            elif isinstance(value, memoryview):
+                nbytes += value.nbytes
+        worker_info = get_worker_info()
+        accesses, misses = self.dataset.get_stats()
+        return dict(
+            nbytes=nbytes,
+            worker=worker_info.id if worker_info is not None else -1,
+            accesses=accesses,
+            misses=misses,
+        )
+
+
+READERS = ("mmap", "tarfile")
+
+
+def build_sampler(name, dataset, seed=0):
+    if name == "ShardListSampler":
+        return ShardListSampler(dataset, seed=seed, shufflefirst=True)
+    if name == "ChunkedSampler":
+        chunksize = int(dataset.cache.lru.capacity * np.mean(dataset.lengths))
+        return ChunkedSampler(dataset, chunksize=chunksize, seed=seed, shuffle=True, shufflefirst=True)
+    if name == "ChunkedSamplerV2":
+        return ChunkedSamplerV2(dataset, seed=seed, shuffle=True)
+    raise ValueError(f"Unknown sampler: {name}")
+
+
+def bench_config(
+    files, *, lru_size, reader, sampler, num_workers, batch_size=32, max_samples=None, index_cache="/tmp/tar_index/"
+):
+    """Run one configuration and return its metrics.
+
+    index_cache=None indexes the shards into a fresh temporary directory, removed afterwards.
+    """
+    if reader not in READERS:
+        raise ValueError(f"Unknown reader: {reader}")
+    tmp_index = None
+    if index_cache is None:
+        index_cache = tmp_index = tempfile.mkdtemp(prefix="wids_bench_index_")
+    try:
+        dataset = wids.ShardListDataset(
+            files,
+            lru_size=lru_size,
+            use_mmap=(reader == "mmap"),
+            index_cache=index_cache,
+            transformations=[],
+        )
+        dataset.add_transform(_Measure(dataset))
+        loader = DataLoader(
+            dataset,
+            batch_size=batch_size,
+            sampler=build_sampler(sampler, dataset),
+            num_workers=num_workers,
+            collate_fn=lambda batch: batch,
+        )
+
+        nsamples, nbytes = 0, 0
+        stats = {}
+        start = time.time()
+        for batch in loader:
+            for item in batch:
+                nsamples += 1
+                nbytes += item["nbytes"]
+                # stats are cumulative per process, keep the latest
+                stats[item["worker"]] = (item["accesses"], item["misses"])
+            if max_samples is not None and nsamples >= max_samples:
+                break
+        elapsed = time.time() - start
+        dataset.close()
+    finally:
+        if tmp_index is not None:
+            shutil.rmtree(tmp_index, ignore_errors=True)
+
+    accesses = sum(a for a, m in stats.values())
+    misses = sum(m for a, m in stats.values())
+    return dict(
+        samples=nsamples,
+        bytes=nbytes,
+        seconds=elapsed,
+        samples_per_sec=nsamples / elapsed,
+        bytes_per_sec=nbytes / elapsed,
+        cache_accesses=accesses,
+        cache_misses=misses,
+        cache_hit_rate=1.0 - misses / max(accesses, 1),
+    )
+
 
+def main_generate(args):
+    blobs = dict(DEFAULT_BLOBS)
+    for spec in args.blob or []:
+        ext, size = spec.split("=")
+        blobs[ext] = int(float(size))
+    if args.only:
+        blobs = {ext: blobs[ext] for ext in args.only}
+    files = make_synthetic_shards(
+        args.outdir,
+        num_shards=args.num_shards,
+        samples_per_shard=args.samples_per_shard,
+        blobs=blobs,
+        seed=args.seed,
+    )
+    print(f"wrote {len(files)} shards to {args.outdir}")
 
-def main_wids(args):
-    desc = json.load(open(args.dataset))
-    files = desc["files"]
-    dataset = wids.ShardListDataset(files, cache_size=4)
-    print(len(dataset))
-    for i in range(len(dataset)):
-        print(i, dataset[i]["__key__"])
-    dataset.close()
 
+def main_run(args):
+    files = sorted(glob.glob(osp.join(args.shard_dir, "*.tar")))
+    assert len(files) > 0, f"no shards in {args.shard_dir}"
+    results = []
+    for lru_size, reader, sampler, num_workers in itertools.product(
+        args.lru_size, args.reader, args.sampler, args.num_workers
+    ):
+        config = dict(lru_size=lru_size, reader=reader, sampler=sampler, num_workers=num_workers, batch_size=args.batch_size)
+        metrics = bench_config(
+            files,
+            max_samples=args.max_samples,
+            index_cache=args.index_cache,
+            **config,
+        )
+        print(json.dumps(dict(config, **metrics)))
+        results.append(dict(config=config, metrics=metrics))
 
-def main_wds(args):
-    desc = json.load(open(args.dataset))
-    files = desc["files"]
-    urls = [f["url"] for f in files]
-    dataset = WebDataset(urls)
-    for i, sample in enumerate(dataset):
-        print(i, sample["__key__"])
+    report = dict(
+        time=time.strftime("%Y-%m-%d %H:%M:%S"),
+        host=platform.node(),
+        shard_dir=args.shard_dir,
+        num_shards=len(files),
+        shard_bytes=sum(os.path.getsize(f) for f in files),
+        results=results,
+    )
+    if args.output is not None:
+        # append to the history of runs
+        history = []
+        if osp.exists(args.output):
+            with open(args.output) as f:
+                history = json.load(f)
+        history.append(report)
+        with open(args.output + ".temp", "w") as f:
+            json.dump(history, f, indent=2)
+        os.rename(args.output + ".temp", args.output)
 
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser()
-    # there are two subcommands: wids and wds
+    parser = argparse.ArgumentParser(description="wids throughput benchmark")
     subparsers = parser.add_subparsers(dest="command")
-    wids_parser = subparsers.add_parser("wids")
-    wds_parser = subparsers.add_parser("wds")
+    generate_parser = subparsers.add_parser("generate", help="generate synthetic shards")
+    run_parser = subparsers.add_parser("run", help="benchmark ShardListDataset")
 
-    # wids subcommand
-    wids_parser.add_argument("dataset", help="dataset name")
+    # generate subcommand
+    generate_parser.add_argument("outdir", help="output directory")
+    generate_parser.add_argument("--num-shards", type=int, default=8)
+    generate_parser.add_argument("--samples-per-shard", type=int, default=200)
+    generate_parser.add_argument("--blob", nargs="*", help="ext=nbytes, e.g. mp4=2e6")
+    generate_parser.add_argument("--only", nargs="*", help="only generate these extensions")
+    generate_parser.add_argument("--seed", type=int, default=0)
 
-    # wds subcommand
-    wds_parser.add_argument("dataset", help="dataset name")
+    # run subcommand
+    run_parser.add_argument("shard_dir", help="directory with .tar shards")
+    run_parser.add_argument("--output", "-o", default=None, help="JSON file the results are appended to")
+    run_parser.add_argument("--lru-size", type=int, nargs="+", default=[4])
+    run_parser.add_argument("--reader", nargs="+", default=["mmap"], choices=READERS)
+    run_parser.add_argument(
+        "--sampler",
+        nargs="+",
+        default=["ChunkedSampler"],
+        choices=["ShardListSampler", "ChunkedSampler", "ChunkedSamplerV2"],
+    )
+    run_parser.add_argument("--num-workers", type=int, nargs="+", default=[0])
+    run_parser.add_argument("--batch-size", type=int, default=32)
+    run_parser.add_argument("--max-samples", type=int, default=None)
+    run_parser.add_argument("--index-cache", default="/tmp/tar_index/")
 
     args = parser.parse_args()
 
-    if args.command == "wids":
-        main_wids(args)
-    elif args.command == "wds":
-        main_wds(args)
+    if args.command == "generate":
+        main_generate(args)
+    elif args.command == "run":
+        main_run(args)
     else:
         raise ValueError(f"Unknown command: {args.command}")
@@ -0,0 +1,91 @@
+"""
+A node-level shard cache shared by all processes (ranks and DataLoader workers).
+
+Shards are downloaded once into `cache_dir`; concurrent downloads of the same
+shard are serialized by the lock in `download_and_open`, so later processes find
+the finished file. Every reader holds a shared flock on the shard file while it
+has it open, which the kernel releases even if the reader crashes. Eviction
+removes least-recently-used shards (by atime, which is refreshed on every
+open) until the directory is under a byte budget, skipping shards that are
+still locked by readers.
+
+ShardListDataset(cache_dir=...) routes every shard url that is not a local path
+through this cache, starting with the scan of its keys for the dataset index;
+local paths are opened in place and not managed.
+"""
+
+import fcntl
+import os
+import time
+
+from .wids_cleanup import ExclusiveLock, evict_least_recently_used
+from .wids_dl import download_and_open
+
+
+class SharedShardCache:
+    """Hand out open, reader-locked streams of cached shards with LRU eviction under a byte budget.
+
+    Args:
+        cache_dir: directory holding the downloaded shards
+        max_bytes: disk budget for the shards in cache_dir
+    """
+
+    def __init__(self, cache_dir="/tmp/_wids_cache", max_bytes=int(1e12)):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.opens = 0
+        self.downloads = 0
+        self.evictions = 0
+
+    def is_cached(self, local):
+        return os.path.dirname(os.path.abspath(local)) == os.path.abspath(self.cache_dir)
+
+    def open(self, url, local, md5sum=None, filesize=None):
+        """Open the shard `url` cached at `local`, downloading (and verifying) it if needed.
+
+        The returned stream holds a shared lock on the file, so it will not be
+        evicted until the stream (and any mmap of it) is closed.
+        """
+        while True:
+            existed = os.path.exists(local)
+            stream = download_and_open(url, local, md5sum=md5sum, filesize=filesize)
+            if not self.is_cached(stream.name):
+                # opened in place (local path), nothing to manage
+                return stream
+            fcntl.flock(stream.fileno(), fcntl.LOCK_SH)
+            if os.fstat(stream.fileno()).st_nlink == 0:
+                # evicted between open and lock, try again
+                stream.close()
+                continue
+            break
+
+        self.opens += 1
+        # refresh the LRU timestamp; mtime is kept since it validates the tar index
+        st = os.fstat(stream.fileno())
+        os.utime(stream.fileno(), ns=(time.time_ns(), st.st_mtime_ns))
+        if not existed:
+            self.downloads += 1
+            self.evict()
+        return stream
+
+    def evict(self):
+        """Evict unused shards until the cache is under max_bytes; only one process evicts at a time."""
+        lock = ExclusiveLock(os.path.join(self.cache_dir, ".evict.lock"))
+        if not lock.try_lock():
+            return
+        try:
+            self.evictions += evict_least_recently_used(
+                self.cache_dir,
+                maxsize=self.max_bytes,
+                sidecars=[".mmidx", ".index"],
+            )
+        finally:
+            lock.release_lock()
+
+    def get_stats(self):
+        """Return the number of opens, downloads and evictions done by this process."""
+        return self.opens, self.downloads, self.evictions
@@ -3,11 +3,13 @@ This module provides utilities for managing files in a directory.
 
 It includes a function `keep_most_recent_files` that keeps the most recent 
 files in a directory, deleting the rest based on the maximum size of the directory 
-in bytes and the maximum number of files to keep.
+in bytes and the maximum number of files to keep, and `evict_least_recently_used`,
+which does the same by access time while sparing files that are still being read.
 
 The cleanup job can be run in the background using `create_cleanup_background_process`.
 """
 
+import errno
 import fcntl
 import glob
 import os
@@ -51,6 +53,52 @@ def keep_most_recent_files(pattern, maxsize=int(1e12), maxfiles=1000, debug=Fals
             pass
 
 
+def evict_least_recently_used(directory, maxsize=int(1e12), sidecars=()):
+    """Delete the least recently accessed files in a directory until it is below maxsize bytes.
+
+    Files that are locked by readers (shared flock, see SharedShardCache) or that
+    are being downloaded (a ".lock" file exists next to them) are skipped.
+    For every deleted file, `fname + ext` is deleted as well for each ext in sidecars.
+    Returns the number of deleted files."""
+    skipped_exts = (".lock", ".temp", ".db") + tuple(sidecars)
+    files = []
+    for entry in os.scandir(directory):
+        if entry.name.startswith(".") or entry.name.endswith(skipped_exts):
+            continue
+        try:
+            s = entry.stat()
+        except FileNotFoundError:
+            continue
+        if entry.is_file():
+            files.append((s.st_atime, entry.path, s.st_size))
+    # sort the list by atime, most recent first
+    files.sort(reverse=True)
+    sizes = np.cumsum([size for atime, fname, size in files])
+    cutoff = np.searchsorted(sizes, maxsize, side="right")
+    total = sizes[-1] if len(files) > 0 else 0
+    nevicted = 0
+    # delete the least recently used files first, until we are below maxsize
+    for atime, fname, size in files[cutoff:][::-1]:
+        if total <= maxsize:
+            break
+        if os.path.exists(fname + ".lock"):
+            continue
+        try:
+            with open(fname, "rb") as stream:
+                fcntl.flock(stream.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+                os.unlink(fname)
+        except (FileNotFoundError, BlockingIOError):
+            continue
+        for ext in sidecars:
+            try:
+                os.unlink(fname + ext)
+            except FileNotFoundError:
+                pass
+        total -= size
+        nevicted += 1
+    return nevicted
+
+
 class ExclusiveLock:
     """A simple non-blocking exclusive lock using fcntl."""
 
@@ -58,11 +106,12 @@ class ExclusiveLock:
         self.lockfile = lockfile
 
     def try_lock(self):
+        self.lock = open(self.lockfile, "w")
         try:
-            self.lock = open(self.lockfile, "w")
             fcntl.flock(self.lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
             return True
         except OSError as e:
+            self.lock.close()
             if e.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
                 return False
             else:
@@ -70,7 +119,11 @@ class ExclusiveLock:
 
     def release_lock(self):
         self.lock.close()
-        os.unlink(self.lockfile)
+        try:
+            os.unlink(self.lockfile)
+        except FileNotFoundError:
+            # a concurrent holder (of a lock file unlinked meanwhile) removed it already
+            pass
 
 
 def create_cleanup_background_process(
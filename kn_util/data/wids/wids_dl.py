@@ -1,6 +1,8 @@
 import fcntl
 import os
 import shutil
+import sqlite3
+import subprocess
 import sys
 import time
 from collections import deque
@@ -60,6 +62,31 @@ def copy_file(remote, local):
     shutil.copyfile(remote, local)
 
 
+def http_download(remote, local, chunk_size=1 << 20):
+    """Stream an http(s) download into local; raises on any http error.
+
+    If local already holds the start of the file (an interrupted earlier attempt),
+    only the rest is requested, falling back to a full download if the server
+    ignores the range.
+    """
+    import httpx
+
+    offset = os.path.getsize(local) if os.path.exists(local) else 0
+    headers = {"Range": f"bytes={offset}-"} if offset > 0 else {}
+    with httpx.stream("GET", remote, headers=headers, follow_redirects=True, timeout=60) as response:
+        restart = response.status_code == 416
+        if not restart:
+            response.raise_for_status()
+            mode = "ab" if response.status_code == 206 else "wb"
+            with open(local, mode) as f:
+                for chunk in response.iter_bytes(chunk_size):
+                    f.write(chunk)
+    if restart:
+        # local does not match the start of the remote file, start over
+        os.unlink(local)
+        http_download(remote, local, chunk_size=chunk_size)
+
+
 verbose_cmd = int(os.environ.get("WIDS_VERBOSE_CMD", "0"))
 
 
@@ -71,20 +98,137 @@ default_cmds = {
     "posixpath": copy_file,
     "file": copy_file,
     "pipe": pipe_download,
-    "http": "curl " + vcmd("-s") + " -L {url} -o {local}",
-    "https": "curl " + vcmd("-s") + " -L {url} -o {local}",
+    "http": http_download,
+    "https": http_download,
     "ftp": "curl " + vcmd("-s") + " -L {url} -o {local}",
     "ftps": "curl " + vcmd("-s") + " -L {url} -o {local}",
     "gs": "gsutil " + vcmd("-q") + " cp {url} {local}",
     "s3": "aws s3 cp {url} {local}",
 }
 
-#TODO(ligeng): change HTTPS download to python requests library
 
-def download_file_no_log(remote, local, handlers=default_cmds):
+stream_cmds = {
+    "http": "curl " + vcmd("-s") + " -f -L {url}",
+    "https": "curl " + vcmd("-s") + " -f -L {url}",
+    "ftp": "curl " + vcmd("-s") + " -f -L {url}",
+    "ftps": "curl " + vcmd("-s") + " -f -L {url}",
+    "gs": "gsutil " + vcmd("-q") + " cat {url}",
+    "s3": "aws s3 cp {url} -",
+}
+
+
+class PipeStream:
+    """The stdout of a shell command as a read-only binary stream; close() checks the exit status."""
+
+    def __init__(self, cmd, bufsize=1 << 22):
+        self.cmd = cmd
+        self.proc = subprocess.Popen(cmd, shell=True, stdout=subprocess.PIPE, bufsize=bufsize)
+        self.stream = self.proc.stdout
+
+    def read(self, *args):
+        return self.stream.read(*args)
+
+    def readinto(self, buffer):
+        return self.stream.readinto(buffer)
+
+    @property
+    def closed(self):
+        return self.stream.closed
+
+    def close(self):
+        if self.stream.closed:
+            return
+        complete = self.stream.read(1) == b""
+        self.stream.close()
+        if not complete:
+            # stopped reading early, the command may block on a full pipe
+            self.proc.terminate()
+        status = self.proc.wait()
+        assert not complete or status == 0, "Command failed: %s" % self.cmd
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def open_stream(remote, handlers=stream_cmds):
+    """Open remote for sequential reading without downloading it first.
+
+    Local files are opened directly, pipe: urls and remote urls (through the
+    commands in handlers) are read from the stdout of a subprocess.
+    """
+    if remote.startswith("pipe:"):
+        return PipeStream(remote[5:])
+    schema = urlparse(remote).scheme
+    if schema in ["", "file"]:
+        return open(urlparse(remote).path, "rb")
+    handler = handlers.get(schema)
+    if handler is None:
+        raise ValueError("Unknown schema: %s" % schema)
+    return PipeStream(handler.format(url=remote))
+
+
+def connect_cache_db(dldir):
+    """Open the sqlite database of a download directory (shared with hash_localname)."""
+    connection = sqlite3.connect(os.path.join(dldir, "cache.db"), timeout=60)
+    connection.execute("CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, path TEXT, checksum TEXT)")
+    connection.execute(
+        "CREATE TABLE IF NOT EXISTS checksums (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, checksum TEXT)"
+    )
+    return connection
+
+
+def file_checksum(local, remote=None):
+    """Return the md5sum of a downloaded file.
+
+    The result is recorded in the cache.db next to the file, keyed by its size
+    and mtime, so validating an unchanged cached file again is free.
+    """
+    from .wids import compute_file_md5sum
+
+    st = os.stat(local)
+    connection = connect_cache_db(os.path.dirname(os.path.abspath(local)))
+    try:
+        row = connection.execute(
+            "SELECT checksum FROM checksums WHERE path = ? AND size = ? AND mtime_ns = ?",
+            (os.path.basename(local), st.st_size, st.st_mtime_ns),
+        ).fetchone()
+        if row is not None:
+            return row[0]
+        checksum = compute_file_md5sum(local)
+        with connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?)",
+                (os.path.basename(local), st.st_size, st.st_mtime_ns, checksum),
+            )
+            if remote is not None:
+                connection.execute("UPDATE cache SET checksum = ? WHERE url = ?", (checksum, remote))
+        return checksum
+    finally:
+        connection.close()
+
+
+def verify_file(local, remote=None, md5sum=None, filesize=None):
+    """Check a downloaded file against the expected size and md5sum; raises ValueError on mismatch."""
+    if filesize is not None and os.path.getsize(local) != filesize:
+        raise ValueError(f"Size mismatch for {local}: expected {filesize}, got {os.path.getsize(local)}")
+    if md5sum is not None:
+        got = file_checksum(local, remote=remote)
+        if got != md5sum:
+            raise ValueError(f"MD5 sum mismatch for {local}: expected {md5sum}, got {got}")
+
+
+def download_file_no_log(remote, local, handlers=default_cmds, md5sum=None, filesize=None):
     """Download a file from a remote url to a local path.
     The remote url can be a pipe: url, in which case the remainder of
     the url is treated as a command template that is executed to perform the download.
+
+    The file is downloaded to a temporary name and renamed into place, so `local`
+    never holds a partial file. The download is checked against filesize and
+    md5sum if given; in the latter case its checksum is recorded in the cache.db
+    next to it, so later validations of the cached file are free.
     """
 
     if remote.startswith("pipe:"):
@@ -97,20 +241,36 @@ def download_file_no_log(remote, local, handlers=default_cmds):
     handler = handlers.get(schema)
     if handler is None:
         raise ValueError("Unknown schema: %s" % schema)
+    # only one process downloads a file at a time (see download_and_open), so a fixed
+    # temporary name lets an interrupted ranged download resume
+    temp = local + ".temp"
     # call the handler
     if callable(handler):
-        handler(remote, local)
+        handler(remote, temp)
     else:
         assert isinstance(handler, str)
-        cmd = handler.format(url=remote, local=local)
+        cmd = handler.format(url=remote, local=temp)
         assert os.system(cmd) == 0, "Command failed: %s" % cmd
+    if not os.path.exists(temp):
+        # the handler found the file in place
+        return local
+    if filesize is not None and os.path.getsize(temp) != filesize:
+        os.unlink(temp)
+        raise ValueError(f"Size mismatch for {remote}: expected {filesize}, got {os.path.getsize(temp)}")
+    os.replace(temp, local)
+    if md5sum is not None:
+        # the file is still in the page cache, record its checksum now
+        checksum = file_checksum(local, remote=remote)
+        if checksum != md5sum:
+            os.unlink(local)
+            raise ValueError(f"MD5 sum mismatch for {remote}: expected {md5sum}, got {checksum}")
     return local
 
 
-def download_file(remote, local, handlers=default_cmds, verbose=False):
+def download_file(remote, local, handlers=default_cmds, verbose=False, md5sum=None, filesize=None):
     start = time.time()
     try:
-        return download_file_no_log(remote, local, handlers=handlers)
+        return download_file_no_log(remote, local, handlers=handlers, md5sum=md5sum, filesize=filesize)
     finally:
         recent_downloads.append((remote, local, time.time(), time.time() - start))
         if verbose:
@@ -126,26 +286,30 @@ def download_file(remote, local, handlers=default_cmds, verbose=False):
             )
 
 
-def download_and_open(remote, local, mode="rb", handlers=default_cmds, verbose=False):
+def download_and_open(remote, local, mode="rb", handlers=default_cmds, verbose=False, md5sum=None, filesize=None):
+    """Open remote, downloading it to local first if it is not a local file.
+
+    A cached copy is validated against md5sum/filesize (free after the first time,
+    see file_checksum) and downloaded again if it does not match.
+    """
     with ULockFile(local + ".lock"):
         if os.path.exists(remote):
-            # print("enter1", remote, local, mode)
             result = open(remote, mode)
         else:
-            # print("enter2", remote, local, mode)
+            if os.path.exists(local):
+                try:
+                    verify_file(local, remote=remote, md5sum=md5sum, filesize=filesize)
+                    if verbose:
+                        print("using cached", local, file=sys.stderr)
+                except ValueError as e:
+                    print(f"{e}, downloading again", file=sys.stderr)
+                    os.unlink(local)
             if not os.path.exists(local):
                 if verbose:
                     print("downloading", remote, "to", local, file=sys.stderr)
-                download_file(remote, local, handlers=handlers)
-                # downloader = MultiThreadDownloader(num_threads=8, verbose=False)
-                # downloader.download(remote, local)
-            else:
-                if verbose:
-                    print("using cached", local, file=sys.stderr)
+                download_file(remote, local, handlers=handlers, md5sum=md5sum, filesize=filesize)
             result = open(local, mode)
-        
-        # input()
-        
+
         if open_objects is not None:
             for k, v in list(open_objects.items()):
                 if v.closed:
@@ -1,14 +1,21 @@
 import argparse
 import json
+import mmap
 import os
 import re
 import sys
+import tarfile
+from functools import partial
 from urllib.parse import urlparse, urlunparse
 
 import braceexpand
 
+from ...utils.multiproc import map_async
 from . import wids, wids_dl
+from .wids_mmtar import next_header, parse_member, parse_tar_header, sample_key
 from .wids_specs import load_remote_dsdesc_raw
+from .wids_utils import scan_tar_members, tar_header_ok
+from .wids_ztar import compressed_codec
 
 
 def format_with_suffix(num):
@@ -157,6 +164,238 @@ def main_create(args):
         json.dump(result, f, indent=2)
 
 
+def validate_shard(path, md5=True, read_size=1 << 22):
+    """Check a local shard with a header-only scan (compressed shards are decompressed).
+
+    Returns a dict with the filesize, mtime_ns, nsamples and md5sum of the shard, and
+    the problems found: "errors" (corrupt or truncated tar) and "duplicates" (keys
+    whose members are not contiguous, or member names that occur twice; both break
+    the grouping of members into samples).
+    """
+    st = os.stat(path)
+    result = dict(
+        path=path,
+        filesize=st.st_size,
+        mtime_ns=st.st_mtime_ns,
+        nsamples=0,
+        md5sum=None,
+        errors=[],
+        duplicates=[],
+    )
+    names, keys = set(), set()
+    last_key = None
+    try:
+        for name, offset, size in scan_tar_members(path, read_size=read_size, strict=True):
+            key = sample_key(name)
+            if name in names or (key != last_key and key in keys):
+                result["duplicates"].append(name)
+            names.add(name)
+            if key is not None:
+                keys.add(key)
+                last_key = key
+    except (ValueError, UnicodeDecodeError, AssertionError) as exn:
+        result["errors"].append(str(exn))
+    result["nsamples"] = len(keys)
+    if md5:
+        result["md5sum"] = wids.compute_file_md5sum(path)
+    return result
+
+
+def scan_damaged_shard(path):
+    """Scan all readable members of a possibly damaged shard.
+
+    Unlike scan_tar_members, scanning continues past a corrupt header at the next
+    512-byte block that holds a valid header, so the members after it are still
+    counted. Returns (members, damage): members is a list of (name, offset, size,
+    complete) and damage a list of (kind, offset, nbytes) for each problem, where
+    kind is "corrupt" (nbytes unreadable bytes up to the next valid header),
+    "truncated" (a member runs past the end of the file) or "eof" (no
+    end-of-archive block).
+    """
+    with open(path, "rb") as stream:
+        if os.fstat(stream.fileno()).st_size == 0:
+            return [], [("eof", 0, 0)]
+        buf = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+    zeros = bytes(512)
+
+    def parse(offset):
+        """(member, end of the member) of a valid header at offset, else None."""
+        block = buf[offset : offset + 512]
+        if block == zeros or not tar_header_ok(block):
+            return None
+        header = parse_tar_header(block[:500])
+        try:
+            member, end = parse_member(header), next_header(offset, header)
+        except (ValueError, UnicodeDecodeError):
+            return None
+        return (member, end) if end > offset else None
+
+    members, damage = [], []
+    offset = 0
+    with buf:
+        while True:
+            if offset + 512 > len(buf):
+                damage.append(("eof", offset, 0))
+                break
+            if buf[offset : offset + 512] == zeros:
+                break
+            parsed = parse(offset)
+            if parsed is None:
+                start = offset
+                offset += 512
+                while offset + 512 <= len(buf) and parse(offset) is None:
+                    offset += 512
+                offset = min(offset, len(buf))
+                damage.append(("corrupt", start, offset - start))
+                continue
+            member, end = parsed
+            complete = end <= len(buf)
+            if member is not None:
+                members.append((member[0], offset, member[1], complete))
+            if not complete:
+                damage.append(("truncated", offset, 0))
+                break
+            offset = end
+    return members, damage
+
+
+def repair_shard(path, backup=True):
+    """Rewrite a shard without the members that make it invalid.
+
+    Keeps the members before the first damage (a corrupt header, a member running
+    past the end of the file, or a missing end-of-archive block), except for the
+    last sample before it if that sample continues after the damage (a truncated
+    member or members following a corrupt header) or if the file simply ends (the
+    sample may be missing members). Members of keys or names seen before are
+    dropped. The original is kept as `path + ".bak"` if `backup` is set.
+
+    Returns the number of members and bytes of the original shard that are not in
+    the repaired one: the dropped members and their payloads, plus one member and
+    the unreadable bytes for each corrupt header.
+    """
+    members, damage = scan_damaged_shard(path)
+    good = members
+    if len(damage) > 0:
+        kind, offset, nbytes = damage[0]
+        good = [m for m in members if m[1] < offset and m[3]]
+        if len(good) > 0:
+            last = sample_key(good[-1][0])
+            split = any(sample_key(m[0]) == last for m in members[len(good) :])
+            if kind == "eof" or split:
+                good = [m for m in good if sample_key(m[0]) != last]
+
+    kept, names, keys = [], set(), set()
+    last_key = None
+    for name, offset, size, complete in good:
+        key = sample_key(name)
+        if name in names or (key != last_key and key in keys):
+            continue
+        names.add(name)
+        keys.add(key)
+        last_key = key
+        kept.append((name, offset, size))
+
+    temp = path + ".temp"
+    with open(path, "rb") as src, tarfile.open(temp, "w", format=tarfile.GNU_FORMAT) as tar:
+        for name, offset, size in kept:
+            src.seek(offset + 512)
+            info = tarfile.TarInfo(name)
+            info.size = size
+            tar.addfile(info, src)
+    if backup:
+        os.replace(path, path + ".bak")
+    os.replace(temp, path)
+
+    kept_offsets = {offset for name, offset, size in kept}
+    dropped = [m for m in members if m[1] not in kept_offsets]
+    dropped_bytes = sum(size for name, offset, size, complete in dropped)
+    corrupt = [nbytes for kind, offset, nbytes in damage if kind == "corrupt"]
+    return len(dropped) + len(corrupt), dropped_bytes + sum(corrupt)
+
+
+def main_validate(args):
+    """Validate shards in parallel, optionally repair them, and write a shard index."""
+    if args.output is None:
+        args.output = "shardindex.json"
+
+    if len(args.files) == 1 and args.files[0] == "-":
+        args.files = [line.strip() for line in sys.stdin]
+    fnames = []
+    for f in args.files:
+        fnames.extend(braceexpand.braceexpand(f))
+
+    # results of earlier runs, reused for shards whose size and mtime did not change
+    state_file = args.output + ".validate.json"
+    previous = {}
+    if os.path.exists(state_file) and not args.force:
+        with open(state_file) as f:
+            previous = json.load(f)
+
+    def is_fresh(fname):
+        entry = previous.get(fname)
+        if entry is None or (not args.no_md5 and entry["md5sum"] is None):
+            return False
+        st = os.stat(fname)
+        return entry["filesize"] == st.st_size and entry["mtime_ns"] == st.st_mtime_ns
+
+    validate = partial(validate_shard, md5=not args.no_md5)
+    todo = [fname for fname in fnames if not is_fresh(fname)]
+    print(f"validating {len(todo)} shards, {len(fnames) - len(todo)} unchanged")
+    results = {fname: previous[fname] for fname in fnames if fname not in todo}
+    if len(todo) > 0:
+        results.update(
+            zip(todo, map_async(iterable=todo, func=validate, num_process=args.workers, desc="Validating shards"))
+        )
+
+    bad = [fname for fname in fnames if results[fname]["errors"] or results[fname]["duplicates"]]
+    if args.repair and len(bad) > 0:
+        for fname in bad:
+            if compressed_codec(fname) is not None:
+                print(f"cannot repair compressed shard {fname}")
+                continue
+            members, nbytes = repair_shard(fname, backup=not args.no_backup)
+            print(f"repaired {fname}: dropped {members} members, {format_with_suffix(nbytes)} bytes")
+        results.update(zip(bad, map_async(iterable=bad, func=validate, num_process=args.workers, desc="Revalidating")))
+        bad = [fname for fname in fnames if results[fname]["errors"] or results[fname]["duplicates"]]
+
+    for fname in bad:
+        result = results[fname]
+        for problem in result["errors"]:
+            print("ERROR", problem)
+        if result["duplicates"]:
+            print(f"DUPLICATE {fname}: {len(result['duplicates'])} members, e.g. {result['duplicates'][:3]}")
+
+    with open(state_file + ".temp", "w") as f:
+        json.dump(results, f, indent=2)
+    os.replace(state_file + ".temp", state_file)
+
+    files = []
+    for fname in fnames:
+        result = results[fname]
+        if fname in bad or result["nsamples"] == 0:
+            continue
+        shard = dict(url=fname, nsamples=result["nsamples"], filesize=result["filesize"])
+        if result["md5sum"] is not None:
+            shard["md5sum"] = result["md5sum"]
+        files.append(shard)
+    files = sorted(files, key=lambda x: x["url"])
+
+    result = dict(
+        __kind__="wids-shard-index-v1",
+        wids_version=1,
+        shardlist=files,
+    )
+    if args.name is not None:
+        result["name"] = args.name
+    if args.base is not None:
+        result["base"] = args.base
+    with open(args.output + ".temp", "w") as f:
+        json.dump(result, f, indent=2)
+    os.replace(args.output + ".temp", args.output)
+    print(f"{len(files)} valid shards, {len(bad)} invalid, written to {args.output}")
+    return 1 if len(bad) > 0 else 0
+
+
 def main_update(args):
     """Update an existing file."""
     with AtomicJsonUpdate(args.filename) as data:
@@ -288,6 +527,18 @@ def main():
     )
     create_parser.add_argument("--base", "-b", help="base path", default=None)
 
+    # Create the parser for the "validate" command
+    validate_parser = subparsers.add_parser("validate", help="Validate local shards and write an index")
+    validate_parser.add_argument("files", nargs="+", help="local shards to validate")
+    validate_parser.add_argument("--output", "-o", help="output file name")
+    validate_parser.add_argument("--name", "-n", help="name for dataset", default=None)
+    validate_parser.add_argument("--base", "-b", help="base path", default=None)
+    validate_parser.add_argument("--workers", "-j", type=int, default=8, help="number of processes")
+    validate_parser.add_argument("--no-md5", action="store_true", help="skip the md5 sums")
+    validate_parser.add_argument("--force", "-f", action="store_true", help="revalidate unchanged shards")
+    validate_parser.add_argument("--repair", action="store_true", help="rewrite truncated/duplicate-key shards")
+    validate_parser.add_argument("--no-backup", action="store_true", help="do not keep the originals of repaired shards")
+
     # Create the parser for the "update" command
     update_parser = subparsers.add_parser("update", help="Update an existing file")
     update_parser.add_argument("filename", type=str, help="Name of the file to update")
@@ -350,7 +601,7 @@ def main():
     except AttributeError:
         parser.print_help()
 
-    func(args)
+    sys.exit(func(args))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,154 @@
+"""
+A compact key -> (shard_idx, inner_idx) index for ShardListDataset.
+
+Keys are stored as sorted 64-bit FNV-1a hashes next to int32 shard and inner
+indices, plus the packed utf-8 keys in the same order (a hash match is confirmed
+by comparing the key itself), i.e. 24 bytes and the key per sample instead of
+a Python dict entry. The arrays are saved as .npy files and memory-mapped on
+load, so the pages are shared between ranks on a node and between forked
+DataLoader workers.
+"""
+
+import os
+import os.path as osp
+import shutil
+import uuid
+
+import numpy as np
+
+FNV_OFFSET = np.uint64(0xCBF29CE484222325)
+FNV_PRIME = np.uint64(0x100000001B3)
+
+
+def hash_keys(keys, chunk_size=1 << 16):
+    """Vectorized 64-bit FNV-1a hash of a list of str keys.
+
+    Keys are hashed chunk_size at a time, which bounds the padded byte matrix
+    (chunk_size x longest key in the chunk).
+    """
+    if len(keys) <= chunk_size:
+        return _hash_chunk(keys)
+    return np.concatenate([_hash_chunk(keys[i : i + chunk_size]) for i in range(0, len(keys), chunk_size)])
+
+
+def _hash_chunk(keys):
+    if len(keys) == 0:
+        return np.zeros(0, dtype=np.uint64)
+    encoded = np.array([key.encode("utf-8") for key in keys], dtype=bytes)
+    width = encoded.dtype.itemsize
+    codes = encoded.view(np.uint8).reshape(len(encoded), width)
+    hashes = np.full(len(encoded), FNV_OFFSET, dtype=np.uint64)
+    for j in range(width):
+        # fixed-width bytes are NUL padded, padding must not change the hash
+        c = codes[:, j].astype(np.uint64)
+        hashes = np.where(c != 0, (hashes ^ c) * FNV_PRIME, hashes)
+    return hashes
+
+
+class KeyIndex:
+    """Map sample keys to (shard_idx, inner_idx) with a batched, vectorized lookup.
+
+    If the same key occurs in several shards, the last occurrence wins (like
+    filling a dict in shard order).
+    """
+
+    FILES = ["hashes", "shard_idx", "inner_idx", "key_blob", "key_ptr"]
+
+    def __init__(self, hashes, shard_idx, inner_idx, key_blob, key_ptr):
+        self.hashes = hashes
+        self.shard_idx = shard_idx
+        self.inner_idx = inner_idx
+        self.key_blob = key_blob
+        self.key_ptr = key_ptr
+
+    @classmethod
+    def build(cls, keys_by_shard):
+        """Build the index from a list with the list of keys of each shard."""
+        lengths = [len(keys) for keys in keys_by_shard]
+        keys = [key for keys in keys_by_shard for key in keys]
+        hashes = hash_keys(keys)
+        shard_idx = np.repeat(np.arange(len(lengths), dtype=np.int32), lengths)
+        inner_idx = np.concatenate([np.arange(n, dtype=np.int32) for n in lengths] or [np.zeros(0, dtype=np.int32)])
+        # stable sort keeps duplicates in shard order, so the last one wins in lookup
+        order = np.argsort(hashes, kind="stable")
+        encoded = [keys[i].encode("utf-8") for i in order]
+        key_ptr = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=key_ptr[1:])
+        key_blob = np.frombuffer(b"".join(encoded), dtype=np.uint8)
+        return cls(hashes[order], shard_idx[order], inner_idx[order], key_blob, key_ptr)
+
+    def save(self, index_dir):
+        """Atomically save the index as a directory of .npy files."""
+        temp_dir = f"{index_dir}.{uuid.uuid4().hex}.temp"
+        os.makedirs(temp_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(osp.join(temp_dir, name + ".npy"), getattr(self, name))
+        try:
+            os.rename(temp_dir, index_dir)
+        except OSError:
+            # another process saved the same index first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir):
+        """Memory-map a saved index, or return None if there is none."""
+        if not all(osp.exists(osp.join(index_dir, name + ".npy")) for name in cls.FILES):
+            return None
+        return cls(*[np.load(osp.join(index_dir, name + ".npy"), mmap_mode="r") for name in cls.FILES])
+
+    @classmethod
+    def load_or_build(cls, index_dir, keys_by_shard_fn):
+        """Load the index from index_dir, building and saving it from keys_by_shard_fn() if needed."""
+        index = cls.load(index_dir)
+        if index is not None:
+            return index
+        cls.build(keys_by_shard_fn()).save(index_dir)
+        return cls.load(index_dir)
+
+    def __len__(self):
+        return len(self.hashes)
+
+    def lookup(self, keys):
+        """Look up a batch of keys.
+
+        Returns:
+            shard_idx, inner_idx: int arrays aligned with keys, -1 for missing keys
+        """
+        keys = list(keys)
+        hashes = hash_keys(keys)
+        pos = np.searchsorted(self.hashes, hashes, side="right") - 1
+        found = pos >= 0
+        found[found] = self.hashes[pos[found]] == hashes[found]
+        # confirm hash matches on the key itself, walking back over colliding entries
+        for i in np.flatnonzero(found):
+            key = keys[i].encode("utf-8")
+            p = pos[i]
+            while p >= 0 and self.hashes[p] == hashes[i] and self._key_at(p) != key:
+                p -= 1
+            if p >= 0 and self.hashes[p] == hashes[i]:
+                pos[i] = p
+            else:
+                found[i] = False
+        shard_idx = np.full(len(hashes), -1, dtype=np.int64)
+        inner_idx = np.full(len(hashes), -1, dtype=np.int64)
+        shard_idx[found] = self.shard_idx[pos[found]]
+        inner_idx[found] = self.inner_idx[pos[found]]
+        return shard_idx, inner_idx
+
+    def _key_at(self, pos):
+        return self.key_blob[self.key_ptr[pos] : self.key_ptr[pos + 1]].tobytes()
+
+    def __getitem__(self, key):
+        shard_idx, inner_idx = self.lookup([key])
+        if shard_idx[0] < 0:
+            raise KeyError(key)
+        return int(shard_idx[0]), int(inner_idx[0])
+
+    def __contains__(self, key):
+        return self.lookup([key])[0][0] >= 0
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -1,10 +1,14 @@
 import collections
 import fcntl
+import hashlib
 import io
 import mmap
 import os
+import re
 import struct
 
+import numpy as np
+
 TarHeader = collections.namedtuple(
     "TarHeader",
     [
@@ -44,9 +48,255 @@ def next_header(offset, header):
     return offset + block_size + padded_file_size
 
 
-# TODO(ligeng): support gzip stream
+def parse_member(header):
+    """Return (name, size) if the header describes a regular file, else None."""
+    name = header.name.decode("utf-8").strip("\x00")
+    typeflag = header.typeflag.decode("utf-8").strip("\x00")
+    if name != "" and name != "././@PaxHeader" and typeflag in ["0", ""]:
+        try:
+            size = int(header.size.decode("utf-8")[:-1], 8)
+        except ValueError as exn:
+            print(header)
+            raise exn
+        return name, size
+    return None
+
+
+def iter_tar_members(buf):
+    """Yield (name, offset, size) for every regular file in a tar buffer.
+
+    `offset` is the offset of the 512-byte header; the payload starts at `offset + 512`.
+    """
+    offset = 0
+    while offset >= 0 and offset < len(buf):
+        header = parse_tar_header(buf[offset : offset + 500])
+        member = parse_member(header)
+        if member is not None:
+            yield member[0], offset, member[1]
+        offset = next_header(offset, header)
+
+
+def sample_key(name):
+    """Return the WebDataset sample key of a member name, or None if it has no extension.
+
+    This mirrors `wids.splitname` / `wids.group_by_key`.
+    """
+    if "." not in name or name == ".":
+        return None
+    return re.match(r"^((?:.*/)?.*?)(\..*)$", name).group(1)
+
+
+def name_hash(names):
+    """Stable 64-bit hashes of member names."""
+    return np.array(
+        [int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little") for name in names],
+        dtype=np.uint64,
+    )
+
+
+def find_mmindex_file(file, index_cache=None):
+    """Return the path of the binary MMIndexedTar index for `file`.
+
+    The index is stored next to the shard unless `index_cache` is given, in which case
+    it is stored there under a hash of the absolute shard path.
+    """
+    if index_cache is None:
+        return file + ".mmidx"
+    filehash = hashlib.sha256(os.path.abspath(file).encode()).hexdigest()[:16]
+    return os.path.join(index_cache, filehash + ".mmidx")
+
+
+class TarIndex:
+    """A compact, memory-mappable index of the members of a tar file.
+
+    On disk the index is a 64-byte header followed by flat little-endian arrays:
+
+        offsets      int64[n]    header offset of each member
+        sizes        int64[n]    payload size of each member
+        name_hash    uint64[n]   blake2b-64 of each member name
+        hash_order   int64[n]    argsort of name_hash
+        sample_ids   int64[n]    sample (key group) of each member, -1 if it has no key
+        name_ptr     int64[n+1]  offsets of each name in the name table
+        names        uint8[m]    packed utf-8 member names
+
+    The header records the size and mtime of the tar file the index was built from,
+    so that stale indices are detected on open.
+    """
+
+    MAGIC = b"WIDSMMIX"
+    VERSION = 1
+    HEADER = struct.Struct("<8sIIqqqqq8x")
+
+    def __init__(self, offsets, sizes, name_hash, hash_order, sample_ids, name_ptr, names, nsamples):
+        self.offsets = offsets
+        self.sizes = sizes
+        self.name_hash = name_hash
+        self.hash_order = hash_order
+        self.sample_ids = sample_ids
+        self.name_ptr = name_ptr
+        self.names_table = names
+        self.nsamples = nsamples
+        self._names = None
+
+    @classmethod
+    def build(cls, buf):
+        names, offsets, sizes = [], [], []
+        for name, offset, size in iter_tar_members(buf):
+            names.append(name)
+            offsets.append(offset)
+            sizes.append(size)
+
+        # assign sample ids in order of first appearance, like group_by_key
+        kmaps = {}
+        sample_ids = []
+        for name in names:
+            key = sample_key(name)
+            if key is None:
+                sample_ids.append(-1)
+                continue
+            sample_ids.append(kmaps.setdefault(key, len(kmaps)))
+
+        encoded = [name.encode("utf-8") for name in names]
+        name_ptr = np.zeros(len(names) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=name_ptr[1:])
+        hashes = name_hash(names)
+        return cls(
+            offsets=np.array(offsets, dtype=np.int64),
+            sizes=np.array(sizes, dtype=np.int64),
+            name_hash=hashes,
+            hash_order=np.argsort(hashes, kind="stable").astype(np.int64),
+            sample_ids=np.array(sample_ids, dtype=np.int64),
+            name_ptr=name_ptr,
+            names=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            nsamples=len(kmaps),
+        )
+
+    def save(self, index_file, st):
+        """Atomically write the index, tagged with the stat result `st` of the tar file."""
+        n = len(self.offsets)
+        header = self.HEADER.pack(
+            self.MAGIC, self.VERSION, 0, st.st_size, st.st_mtime_ns, n, self.nsamples, len(self.names_table)
+        )
+        temp_file = f"{index_file}.{os.getpid()}.temp"
+        with open(temp_file, "wb") as stream:
+            stream.write(header)
+            for array in [self.offsets, self.sizes, self.name_hash, self.hash_order, self.sample_ids, self.name_ptr]:
+                stream.write(np.ascontiguousarray(array, dtype=array.dtype.newbyteorder("<")).tobytes())
+            stream.write(self.names_table.tobytes())
+        os.replace(temp_file, index_file)
+
+    @classmethod
+    def load(cls, index_file, st):
+        """Memory-map an index; returns None if it is missing, corrupt or stale w.r.t. `st`."""
+        if not os.path.exists(index_file):
+            return None
+        try:
+            raw = np.memmap(index_file, dtype=np.uint8, mode="r")
+        except (ValueError, OSError):
+            return None
+        if len(raw) < cls.HEADER.size:
+            return None
+        magic, version, _, size, mtime_ns, n, nsamples, nnames = cls.HEADER.unpack(raw[: cls.HEADER.size].tobytes())
+        if magic != cls.MAGIC or version != cls.VERSION:
+            return None
+        if size != st.st_size or mtime_ns != st.st_mtime_ns:
+            return None
+        if len(raw) != cls.HEADER.size + 8 * (6 * n + 1) + nnames:
+            return None
+
+        pos = cls.HEADER.size
+
+        def _take(dtype, count):
+            nonlocal pos
+            array = raw[pos : pos + 8 * count].view(dtype)
+            pos += 8 * count
+            return array
+
+        offsets = _take("<i8", n)
+        sizes = _take("<i8", n)
+        hashes = _take("<u8", n)
+        hash_order = _take("<i8", n)
+        sample_ids = _take("<i8", n)
+        name_ptr = _take("<i8", n + 1)
+        names = raw[pos : pos + nnames]
+        return cls(offsets, sizes, hashes, hash_order, sample_ids, name_ptr, names, nsamples)
+
+    def __len__(self):
+        return len(self.offsets)
+
+    def name(self, i):
+        return self.names_table[self.name_ptr[i] : self.name_ptr[i + 1]].tobytes().decode("utf-8")
+
+    def names(self):
+        if self._names is None:
+            self._names = [self.name(i) for i in range(len(self))]
+        return self._names
+
+    def find(self, name):
+        """Return the member index of `name`, or -1."""
+        h = name_hash([name])[0]
+        lo = np.searchsorted(self.name_hash, h, side="left", sorter=self.hash_order)
+        while lo < len(self) and self.name_hash[self.hash_order[lo]] == h:
+            i = int(self.hash_order[lo])
+            if self.name(i) == name:
+                return i
+            lo += 1
+        return -1
+
+    def sample_groups(self):
+        """Return the member indices grouped by sample key, as a SampleGroups sequence."""
+        order = np.argsort(self.sample_ids, kind="stable")
+        order = order[self.sample_ids[order] >= 0]
+        counts = np.bincount(self.sample_ids[order], minlength=self.nsamples)
+        ptr = np.zeros(self.nsamples + 1, dtype=np.int64)
+        np.cumsum(counts, out=ptr[1:])
+        return SampleGroups(ptr, order)
+
+
+class SampleGroups:
+    """A list-like view of member indices grouped by sample (CSR layout)."""
+
+    def __init__(self, ptr, members):
+        self.ptr = ptr
+        self.members = members
+
+    def __len__(self):
+        return len(self.ptr) - 1
+
+    def __getitem__(self, idx):
+        if idx < 0:
+            idx += len(self)
+        if idx < 0 or idx >= len(self):
+            raise IndexError(idx)
+        return self.members[self.ptr[idx] : self.ptr[idx + 1]].tolist()
+
+
+MMAP_ADVICE = {
+    name: getattr(mmap, flag)
+    for name, flag in [
+        ("normal", "MADV_NORMAL"),
+        ("random", "MADV_RANDOM"),
+        ("sequential", "MADV_SEQUENTIAL"),
+        ("willneed", "MADV_WILLNEED"),
+        ("dontneed", "MADV_DONTNEED"),
+    ]
+    if hasattr(mmap, flag)
+}
+
+
 class MMIndexedTar:
-    def __init__(self, fname, index_file=None, verbose=True, cleanup_callback=None):
+    """Memory-mapped random access to the members of a tar file.
+
+    If `index_file` is given (a path, or a callable mapping the tar path to one),
+    the member index is loaded from / saved to a binary TarIndex, so that reopening
+    a shard does not rescan its headers. The index is validated against the size
+    and mtime of the tar file and rebuilt when stale.
+
+    `advice` ("random", "sequential" or "normal") is passed to madvise for the whole
+    mapping; use "random" for shuffled access so the kernel does not read ahead.
+    """
+
+    def __init__(self, fname, index_file=None, verbose=True, cleanup_callback=None, advice=None):
         self.verbose = verbose
         self.cleanup_callback = cleanup_callback
         if isinstance(fname, str):
@@ -54,38 +304,71 @@ class MMIndexedTar:
             self.fname = fname
         elif isinstance(fname, io.IOBase):
             self.stream = fname
-            self.fname = None
+            self.fname = getattr(fname, "name", None)
+            if not isinstance(self.fname, str):
+                self.fname = None
         self.mmapped_file = mmap.mmap(self.stream.fileno(), 0, access=mmap.ACCESS_READ)
         if cleanup_callback:
             cleanup_callback(fname, self.stream.fileno(), "start")
+        if callable(index_file):
+            index_file = index_file(self.fname) if self.fname is not None else None
+        self.index_file = index_file
         self._build_index()
+        if advice is not None:
+            self.advise(advice)
 
     def close(self, dispose=False):
         if self.cleanup_callback:
             self.cleanup_callback(self.fname, self.stream.fileno(), "end")
-        self.mmapped_file.close()
+        self.index = None
+        try:
+            self.mmapped_file.close()
+        except BufferError:
+            # zero-copy buffers handed out by get_buffer are still alive;
+            # the mapping is released once the last of them is garbage collected
+            pass
         self.stream.close()
 
     def _build_index(self):
-        self.by_name = {}
-        self.by_index = []
-        offset = 0
-        while offset >= 0 and offset < len(self.mmapped_file):
-            header = parse_tar_header(self.mmapped_file[offset : offset + 500])
-            name = header.name.decode("utf-8").strip("\x00")
-            typeflag = header.typeflag.decode("utf-8").strip("\x00")
-            if name != "" and name != "././@PaxHeader" and typeflag in ["0", ""]:
-                try:
-                    size = int(header.size.decode("utf-8")[:-1], 8)
-                except ValueError as exn:
-                    print(header)
-                    raise exn
-                self.by_name[name] = offset
-                self.by_index.append((name, offset, size))
-            offset = next_header(offset, header)
+        st = os.fstat(self.stream.fileno())
+        if self.index_file is not None:
+            self.index = TarIndex.load(self.index_file, st)
+            if self.index is not None:
+                return
+        self.index = TarIndex.build(self.mmapped_file)
+        if self.index_file is not None:
+            try:
+                os.makedirs(os.path.dirname(os.path.abspath(self.index_file)), exist_ok=True)
+                self.index.save(self.index_file, st)
+            except OSError as exn:
+                if self.verbose:
+                    print("Could not save tar index to", self.index_file, exn)
+
+    def advise(self, advice, start=0, length=None):
+        """madvise a byte range of the mapping (page aligned); no-op where unsupported."""
+        if advice not in MMAP_ADVICE or self.mmapped_file.closed or len(self.mmapped_file) == 0:
+            return 0
+        end = len(self.mmapped_file) if length is None else min(start + length, len(self.mmapped_file))
+        start -= start % mmap.PAGESIZE
+        self.mmapped_file.madvise(MMAP_ADVICE[advice], start, end - start)
+        return end - start
+
+    def willneed(self, indices):
+        """Ask the kernel to read the given members ahead; returns the number of bytes advised."""
+        nbytes = 0
+        for index in indices:
+            nbytes += self.advise("willneed", int(self.index.offsets[index]), 512 + int(self.index.sizes[index]))
+        return nbytes
+
+    def dontneed(self):
+        """Drop the pages of the mapping from this process (the page cache is kept)."""
+        self.advise("dontneed")
 
     def names(self):
-        return self.by_name.keys()
+        return self.index.names()
+
+    def sample_groups(self):
+        return self.index.sample_groups()
 
     def get_at_offset(self, offset):
         header = parse_tar_header(self.mmapped_file[offset : offset + 500])
@@ -95,25 +378,36 @@ class MMIndexedTar:
         return name, self.mmapped_file[start:end]
 
     def get_at_index(self, index):
-        name, offset, size = self.by_index[index]
-        return self.get_at_offset(offset)
+        offset = int(self.index.offsets[index])
+        size = int(self.index.sizes[index])
+        start = offset + 512
+        return self.index.name(index), self.mmapped_file[start : start + size]
+
+    def get_buffer(self, index):
+        """Like get_at_index, but return a read-only memoryview into the mmap instead of a copy."""
+        offset = int(self.index.offsets[index])
+        size = int(self.index.sizes[index])
+        start = offset + 512
+        return self.index.name(index), memoryview(self.mmapped_file)[start : start + size]
 
     def get_by_name(self, name):
-        offset = self.by_name[name]
-        return self.get_at_offset(offset)
+        index = self.index.find(name)
+        if index < 0:
+            raise KeyError(name)
+        return self.get_at_index(index)
 
     def __iter__(self):
-        for name, offset, size in self.by_index:
-            yield name, self.mmapped_file[offset + 512 : offset + 512 + size]
+        for i in range(len(self)):
+            yield self.get_at_index(i)
 
     def __getitem__(self, key):
-        if isinstance(key, int):
+        if isinstance(key, (int, np.integer)):
             return self.get_at_index(key)
         else:
             return self.get_by_name(key)
 
     def __len__(self):
-        return len(self.by_index)
+        return len(self.index)
 
     def get_file(self, i):
         fname, data = self.get_at_index(i)
@@ -0,0 +1,153 @@
+"""
+Background prefetching of shards for ShardListDataset.
+
+A ShardPrefetcher downloads and indexes the shards that a sampler is about to
+visit in a thread pool, so that a cache miss in LRUShards waits on an already
+in-flight transfer instead of starting it. Samplers drive it by calling
+`prefetch(urls)` with the upcoming shards in visiting order (see
+`ChunkedSampler.upcoming_shards`).
+
+The prefetcher lives in the process that owns the sampler. With DataLoader
+workers that is the main process: the DataLoader iterates the sampler there and
+only sends indices to the workers, so the prefetcher must be created in the main
+process (before the workers start) and it never runs inside a worker (its copy
+in a worker, pickled or forked with the dataset, is inert). Workers do not share
+its futures; for them the download lock held by `download_and_open` makes a
+miss on an in-flight shard wait for the transfer, and the binary tar index
+written by the prefetcher makes the open O(1). This requires a cache_dir on a
+filesystem the workers share with the main process, which is the default.
+"""
+
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from loguru import logger
+
+from .wids_dl import download_and_open
+from .wids_mmtar import MMIndexedTar
+from .wids_ztar import CompressedIndexedTar, compressed_codec
+
+
+class ShardPrefetcher:
+    """Download and index upcoming shards of a ShardListDataset in background threads.
+
+    Args:
+        dataset: the ShardListDataset whose shard cache is fed; the prefetcher attaches
+            itself to `dataset.cache`
+        num_threads: number of concurrent downloads
+        max_bytes: byte budget for prefetched shards that the sampler has not reached yet
+        num_shards: number of upcoming shards samplers should announce
+    """
+
+    def __init__(self, dataset, *, num_threads=4, max_bytes=int(1e10), num_shards=4, verbose=False):
+        self.localname = dataset.cache.localname
+        self.mmindex_file = dataset.cache.mmindex_file
+        self.shard_meta = dataset.cache.shard_meta
+        self.filesizes = {shard["url"]: shard.get("filesize") for shard in dataset.shards}
+        self.num_threads = num_threads
+        self.max_bytes = max_bytes
+        self.num_shards = num_shards
+        self.verbose = verbose
+
+        self.pid = os.getpid()
+        self.lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(num_threads, thread_name_prefix="wids_prefetch")
+        self.futures = {}
+        self.sizes = {}
+        self.reset_stats()
+
+        dataset.cache.prefetcher = self
+
+    def reset_stats(self):
+        self.submitted = 0
+        self.hits = 0
+        self.waits = 0
+
+    def __getstate__(self):
+        # threads and futures do not cross process boundaries
+        state = self.__dict__.copy()
+        state.update(lock=None, executor=None, futures={})
+        return state
+
+    def _fetch(self, url):
+        local = self.localname(url)
+        with download_and_open(url, local, **self.shard_meta.get(url, {})) as stream:
+            if hasattr(os, "posix_fadvise"):
+                # already local (e.g. network filesystem): pull the file into the page cache
+                os.posix_fadvise(stream.fileno(), 0, 0, os.POSIX_FADV_WILLNEED)
+            size = os.fstat(stream.fileno()).st_size
+            # building the index persists it, so the consumer only memory-maps it;
+            # compressed shards also get their frame table
+            if compressed_codec(local) is not None:
+                reader = CompressedIndexedTar
+            else:
+                reader = MMIndexedTar
+            reader(stream, index_file=self.mmindex_file, verbose=self.verbose).close()
+        self.sizes[url] = size
+        if self.verbose:
+            logger.info(f"[ShardPrefetcher] prefetched {url} ({size} bytes)")
+        return size
+
+    def _expected_size(self, url):
+        if self.sizes.get(url) is not None:
+            return self.sizes[url]
+        if self.filesizes.get(url) is not None:
+            return self.filesizes[url]
+        if len(self.sizes) > 0:
+            return sum(self.sizes.values()) / len(self.sizes)
+        return 0
+
+    def prefetch(self, urls):
+        """Announce the upcoming shards, in the order they will be visited.
+
+        Finished prefetches that are no longer upcoming are forgotten (the sampler
+        has moved past them), then new downloads are submitted in order while
+        the byte budget allows.
+        """
+        if self.executor is None or os.getpid() != self.pid:
+            return
+        urls = list(urls)
+        upcoming = set(urls)
+        with self.lock:
+            for url in list(self.futures.keys()):
+                if url not in upcoming and self.futures[url].done():
+                    del self.futures[url]
+            used = sum(self._expected_size(url) for url in self.futures)
+            for url in urls:
+                if url in self.futures:
+                    continue
+                if used >= self.max_bytes:
+                    break
+                self.futures[url] = self.executor.submit(self._fetch, url)
+                self.submitted += 1
+                used += self._expected_size(url)
+
+    def wait(self, url):
+        """Wait for an in-flight prefetch of url; return False if it was not prefetched here."""
+        if self.executor is None or os.getpid() != self.pid:
+            return False
+        with self.lock:
+            future = self.futures.get(url)
+        if future is None:
+            return False
+        if future.done():
+            self.hits += 1
+        else:
+            self.waits += 1
+        try:
+            future.result()
+        except Exception as e:
+            logger.warning(f"[ShardPrefetcher] prefetching {url} failed: {e}")
+            return False
+        return True
+
+    def get_stats(self):
+        """Return the number of submitted prefetches, misses served by finished ones and misses that waited."""
+        return self.submitted, self.hits, self.waits
+
+    def close(self):
+        if self.executor is not None and os.getpid() == self.pid:
+            self.executor.shutdown(wait=True, cancel_futures=True)
+            self.executor = None
+            self.futures = {}
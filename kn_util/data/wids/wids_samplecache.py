@@ -0,0 +1,181 @@
+"""
+A cache of transformed samples for ShardListDataset.
+
+Decoding (PIL/npy) is usually the most expensive part of reading a sample,
+and multi-epoch training decodes the same samples again every epoch. The
+DecodedSampleCache keeps the output of the leading, deterministic per-sample
+transformations (the decoder by default, see ShardListDataset's
+decoded_cache_prefix; random augmentations run after the lookup), keyed by
+(shard url, inner_idx, hash of those transformations), in two tiers:
+
+    memory  an LRU of pickled samples with a byte budget, private to each process
+    disk    a sqlite database of pickled samples with a byte budget, shared by all
+            processes on the node; the oldest entries are evicted first (a ring)
+
+Samples are pickled with protocol 5, so numpy arrays and PIL images are stored
+as raw buffers and unpickling them is a memcpy. Samples that cannot be pickled
+(e.g. open file handles) are not cached.
+"""
+
+import os
+import pickle
+import sqlite3
+from collections import OrderedDict
+
+from loguru import logger
+
+
+class DecodedSampleCache:
+    """Two-tier (memory, disk) cache of transformed samples.
+
+    Args:
+        mem_bytes: byte budget of the in-memory tier of each process (0 disables it)
+        cache_dir: directory of the on-disk tier (None disables it)
+        disk_bytes: byte budget of the on-disk tier
+        transform_hash: fingerprint of the cached transformations, part of every key
+    """
+
+    def __init__(self, mem_bytes=int(1e9), cache_dir=None, disk_bytes=int(1e11), transform_hash=""):
+        self.mem_bytes = mem_bytes
+        self.cache_dir = cache_dir
+        self.disk_bytes = disk_bytes
+        self.transform_hash = transform_hash
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.connection = None
+        self.pid = None
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._connect().close()
+            self.connection = None
+        self.reset_stats()
+
+    def reset_stats(self):
+        self.mem_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.uncacheable = 0
+
+    def __getstate__(self):
+        # sqlite connections do not cross process boundaries
+        state = self.__dict__.copy()
+        state.update(connection=None, pid=None)
+        return state
+
+    def _connect(self):
+        connection = sqlite3.connect(os.path.join(self.cache_dir, "samples.db"), timeout=60)
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS samples (id INTEGER PRIMARY KEY AUTOINCREMENT, key TEXT UNIQUE, data BLOB)"
+        )
+        connection.commit()
+        return connection
+
+    def _db(self):
+        if self.cache_dir is None:
+            return None
+        if self.connection is None or self.pid != os.getpid():
+            self.connection = self._connect()
+            self.pid = os.getpid()
+        return self.connection
+
+    def key(self, url, inner_idx):
+        return f"{self.transform_hash}:{inner_idx}:{url}"
+
+    def _remember(self, key, data):
+        if len(data) > self.mem_bytes:
+            return
+        if key in self.memory:
+            self.memory_size -= len(self.memory.pop(key))
+        self.memory[key] = data
+        self.memory_size += len(data)
+        while self.memory_size > self.mem_bytes:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_size -= len(evicted)
+
+    def get_many(self, keys):
+        """Return the cached samples for keys, None for misses."""
+        result = [None] * len(keys)
+        missing = []
+        for i, key in enumerate(keys):
+            data = self.memory.get(key)
+            if data is not None:
+                self.memory.move_to_end(key)
+                self.mem_hits += 1
+                result[i] = pickle.loads(data)
+            else:
+                missing.append(i)
+
+        db = self._db()
+        if db is not None and len(missing) > 0:
+            found = {}
+            # stay below sqlite's limit on the number of parameters
+            for start in range(0, len(missing), 500):
+                batch = [keys[i] for i in missing[start : start + 500]]
+                query = "SELECT key, data FROM samples WHERE key IN (%s)" % ",".join("?" * len(batch))
+                found.update(db.execute(query, batch).fetchall())
+            for i in missing:
+                data = found.get(keys[i])
+                if data is not None:
+                    self.disk_hits += 1
+                    self._remember(keys[i], data)
+                    result[i] = pickle.loads(data)
+
+        self.misses += sum(1 for sample in result if sample is None)
+        return result
+
+    def put_many(self, keys, samples):
+        """Cache the samples under keys."""
+        rows = []
+        for key, sample in zip(keys, samples):
+            try:
+                data = pickle.dumps(sample, protocol=5)
+            except (TypeError, pickle.PicklingError):
+                self.uncacheable += 1
+                continue
+            self._remember(key, data)
+            rows.append((key, data))
+
+        db = self._db()
+        if db is None or len(rows) == 0:
+            return
+        try:
+            with db:
+                db.executemany("INSERT OR REPLACE INTO samples (key, data) VALUES (?, ?)", rows)
+            self._evict(db)
+        except sqlite3.OperationalError as e:
+            # the disk tier is best effort, e.g. when the database is busy
+            logger.warning(f"[DecodedSampleCache] could not write to {self.cache_dir}: {e}")
+
+    def disk_size(self):
+        """Bytes used by the on-disk tier (allocated pages, free pages excluded)."""
+        db = self._db()
+        if db is None:
+            return 0
+        page_size = db.execute("PRAGMA page_size").fetchone()[0]
+        page_count = db.execute("PRAGMA page_count").fetchone()[0]
+        freelist_count = db.execute("PRAGMA freelist_count").fetchone()[0]
+        return (page_count - freelist_count) * page_size
+
+    def _evict(self, db):
+        # delete the oldest tenth of the entries until under budget; freed pages are reused
+        while self.disk_size() > self.disk_bytes:
+            count = db.execute("SELECT COUNT(*) FROM samples").fetchone()[0]
+            if count == 0:
+                break
+            with db:
+                db.execute(
+                    "DELETE FROM samples WHERE id IN (SELECT id FROM samples ORDER BY id LIMIT ?)",
+                    (max(count // 10, 1),),
+                )
+
+    def get_stats(self):
+        """Return a dict with the hits of each tier, the misses, and the uncacheable samples."""
+        return dict(
+            mem_hits=self.mem_hits,
+            disk_hits=self.disk_hits,
+            misses=self.misses,
+            uncacheable=self.uncacheable,
+            mem_size=self.memory_size,
+        )
@@ -1,12 +1,17 @@
+import itertools
+import math
 import random
 import warnings
+from collections import OrderedDict
 from typing import Optional
 
 import numpy as np
+import torch
 import torch.distributed as dist
 from torch.utils.data import Dataset, Sampler
+from torch.utils.data.distributed import DistributedSampler
 
-from ...dist import get_world_size
+from ...dist import all_gather_object, get_rank, get_world_size
 
 
 def lengths_to_ranges(lengths, start_offset=0):
@@ -58,6 +63,143 @@ def iterate_lengths(lengths, rng, start_offset=0, indexshuffle=True, shardshuffl
         yield from sample_indexes
 
 
+class ChunkedPermutation:
+    """A lazily generated permutation of consecutive chunks of indices.
+
+    Equivalent in structure to iterate_lengths: the chunks are visited in a
+    random order and the indices within each chunk are shuffled. The chunk
+    order is an int64 array with one entry per chunk, and the permutation of a
+    chunk is computed on demand from (seed, chunk_id), so at most one chunk of
+    indices is materialized and any position can be reached without
+    generating the ones before it.
+
+    Args:
+        lengths: the lengths of the consecutive chunks
+        seed: seed of the chunk order and of the per-chunk permutations
+        start_offset: the first index of the first chunk
+        indexshuffle: shuffle the indices within each chunk
+        shardshuffle: shuffle the order of the chunks
+        total_size: indices >= total_size are wrapped around (to support drop_last=False)
+    """
+
+    def __init__(self, lengths, seed, start_offset=0, indexshuffle=True, shardshuffle=True, total_size=None):
+        self.lengths = np.asarray(lengths, dtype=np.int64)
+        self.seed = seed
+        self.indexshuffle = indexshuffle
+        self.total_size = total_size
+        self.chunk_starts = start_offset + np.cumsum(self.lengths) - self.lengths
+        if shardshuffle:
+            self.order = np.random.default_rng([seed]).permutation(len(self.lengths))
+        else:
+            self.order = np.arange(len(self.lengths))
+        self.visit_ends = np.cumsum(self.lengths[self.order])
+
+    def __len__(self):
+        return int(self.visit_ends[-1]) if len(self.visit_ends) > 0 else 0
+
+    def locate(self, pos):
+        """Return (k, offset): position pos is the offset-th index of the k-th visited chunk."""
+        k = int(np.searchsorted(self.visit_ends, pos, side="right"))
+        return k, pos - int(self.visit_ends[k] - self.lengths[self.order[k]])
+
+    def chunk(self, k):
+        """The indices of the k-th visited chunk, as an int64 array."""
+        chunk_id = int(self.order[k])
+        length = int(self.lengths[chunk_id])
+        if self.indexshuffle:
+            indices = np.random.default_rng([self.seed, chunk_id]).permutation(length)
+        else:
+            indices = np.arange(length)
+        indices += self.chunk_starts[chunk_id]
+        if self.total_size is not None:
+            np.remainder(indices, self.total_size, out=indices)
+        return indices
+
+    def slice(self, start, stop):
+        """The indices at positions [start, stop), as an int64 array."""
+        stop = min(stop, len(self))
+        if start >= stop:
+            return np.zeros(0, dtype=np.int64)
+        parts = []
+        k, offset = self.locate(start)
+        while start < stop:
+            indices = self.chunk(k)[offset : offset + stop - start]
+            parts.append(indices)
+            start += len(indices)
+            k, offset = k + 1, 0
+        return np.concatenate(parts)
+
+    def iter_from(self, pos=0):
+        """Iterate over the indices from position pos on, one chunk in memory at a time."""
+        if pos >= len(self):
+            return
+        k, offset = self.locate(pos)
+        for k in range(k, len(self.order)):
+            yield from self.chunk(k)[offset:].tolist()
+            offset = 0
+
+
+def split_segments(segments, start, stop):
+    """Return the segments covering positions [start, stop) of the concatenation of segments.
+
+    A segment is a dict describing the positions [start, stop) of the
+    ChunkedPermutation of a span (see ChunkedSampler.epoch_segment). Positions
+    past the end wrap around to the beginning.
+    """
+    total = sum(seg["stop"] - seg["start"] for seg in segments)
+    result = []
+    while start < stop and total > 0:
+        pos = 0
+        for seg in segments:
+            length = seg["stop"] - seg["start"]
+            lo, hi = max(start - pos, 0), min(stop - pos, length)
+            if lo < hi:
+                result.append(dict(seg, start=seg["start"] + lo, stop=seg["start"] + hi))
+            pos += length
+        # wrap around to pad to the requested size
+        start, stop = max(start - total, 0), stop - total
+    return result
+
+
+class SegmentedPermutation:
+    """The concatenation of position ranges of ChunkedPermutations, with the interface of ChunkedPermutation."""
+
+    def __init__(self, segments):
+        self.segments = segments
+        self.perms = [
+            ChunkedPermutation(
+                [min(seg["chunksize"], seg["span"][1] - i) for i in range(*seg["span"], seg["chunksize"])],
+                seed=seg["seed"],
+                start_offset=seg["span"][0],
+                indexshuffle=seg["indexshuffle"],
+                shardshuffle=seg["shardshuffle"],
+                total_size=seg["total_size"],
+            )
+            for seg in segments
+        ]
+        self.ends = np.cumsum([seg["stop"] - seg["start"] for seg in segments], dtype=np.int64)
+
+    def __len__(self):
+        return int(self.ends[-1]) if len(self.ends) > 0 else 0
+
+    def slice(self, start, stop):
+        parts = [np.zeros(0, dtype=np.int64)]
+        for seg, perm, end in zip(self.segments, self.perms, self.ends.tolist()):
+            begin = end - (seg["stop"] - seg["start"])
+            lo, hi = max(start, begin), min(stop, end)
+            if lo < hi:
+                parts.append(perm.slice(seg["start"] + lo - begin, seg["start"] + hi - begin))
+        return np.concatenate(parts)
+
+    def iter_from(self, pos=0):
+        for seg, perm, end in zip(self.segments, self.perms, self.ends.tolist()):
+            begin = end - (seg["stop"] - seg["start"])
+            if pos >= end:
+                continue
+            it = perm.iter_from(seg["start"] + max(pos - begin, 0))
+            yield from itertools.islice(it, end - max(pos, begin))
+
+
 class ShardListSampler(Sampler):
     """A sampler that samples consistent with a ShardListDataset.
 
@@ -110,7 +252,16 @@ class ChunkedSampler(Sampler):
         seed=0,
         shuffle=False,
         shufflefirst=False,
+        prefetcher=None,
     ):
+        """
+        Args:
+            prefetcher: an optional ShardPrefetcher, which is told about the upcoming
+                shards of the sampling order as the iteration progresses. It runs in
+                the process iterating the sampler (the main process under a DataLoader,
+                which draws indices there); workers only see the shards it has already
+                downloaded and indexed into the local cache.
+        """
 
         if isinstance(num_samples, int):
             lo, hi = 0, num_samples
@@ -121,13 +272,20 @@ class ChunkedSampler(Sampler):
         self.span = (lo, hi)
         # self.ranges = [(i, min(i + chunksize, hi)) for i in range(lo, hi, chunksize)]
         self.lengths = [min(chunksize, hi - i) for i in range(lo, hi, chunksize)]
+        self.chunksize = chunksize
         self._len = hi - lo
         self.dataset_size = len(dataset)
+        self.shard_cum_lengths = np.cumsum(dataset.lengths) if hasattr(dataset, "lengths") else None
+        self.shard_urls = [shard["url"] for shard in dataset.shards] if hasattr(dataset, "shards") else None
         self.seed = seed
         self.shuffle = shuffle
         self.shufflefirst = shufflefirst
         self.epoch = 0
         self.gen_pnt = -1
+        self.prefetcher = prefetcher
+        # remaining samples of a resumed epoch, see load_elastic_state_dict
+        self.segments = None
+        self._indices = None
 
     def set_epoch(self, epoch):
         self.epoch = epoch
@@ -142,6 +300,7 @@ class ChunkedSampler(Sampler):
         _safe_overwrite("epoch", ignore_diff=True)
         _safe_overwrite("gen_pnt", ignore_diff=True)
         _safe_overwrite("seed", ignore_diff=True)
+        _safe_overwrite("segments", ignore_diff=True)
         for variable_name in state_dict.keys():
             _safe_overwrite(variable_name, ignore_diff=not strict)
 
@@ -154,62 +313,314 @@ class ChunkedSampler(Sampler):
             "shufflefirst": self.shufflefirst,
             "span": self.span,
             "lengths": self.lengths,
+            "segments": self.segments,
         }
 
-    def __iter__(self):
-        self.rng = random.Random(self.seed + 1289738273 * self.epoch)
-        shardshuffle = self.shufflefirst or self.epoch > 0
-        indices = list(
-            iterate_lengths(
-                self.lengths,
-                self.rng,
-                indexshuffle=self.shuffle,
-                shardshuffle=(self.shuffle and shardshuffle),
-                total_size=self.dataset_size,
-                start_offset=self.span[0],
-            )
+    def epoch_segment(self, epoch=None):
+        """Describe the sampling order of an epoch as a segment (see split_segments)."""
+        epoch = self.epoch if epoch is None else epoch
+        shardshuffle = self.shufflefirst or epoch > 0
+        return dict(
+            span=list(self.span),
+            chunksize=self.chunksize,
+            seed=self.seed + 1289738273 * epoch,
+            indexshuffle=self.shuffle,
+            shardshuffle=(self.shuffle and shardshuffle),
+            total_size=self.dataset_size,
+            start=0,
+            stop=self._len,
         )
 
-        for i in range(self.gen_pnt + 1, len(indices)):
+    def remaining_segments(self):
+        """The samples of the current epoch that have not been yielded yet, as segments."""
+        segments = self.segments if self.segments is not None else [self.epoch_segment()]
+        total = sum(seg["stop"] - seg["start"] for seg in segments)
+        return split_segments(segments, self.gen_pnt + 1, total)
+
+    def elastic_state_dict(self):
+        """Gather the global consumption of the current epoch over all ranks.
+
+        Must be called on all ranks. The result does not depend on the world size
+        and can be loaded with load_elastic_state_dict by any number of ranks.
+        """
+        return {
+            "epoch": self.epoch,
+            "seed": self.seed,
+            "segments": [seg for segments in all_gather_object(self.remaining_segments()) for seg in segments],
+        }
+
+    def load_elastic_state_dict(self, state_dict, *, rank=None, num_replicas=None, drop_last=False):
+        """Resume from an elastic_state_dict, possibly saved with another world size.
+
+        The remaining samples of the epoch are split evenly over the ranks (padded by
+        wrapping around unless drop_last). The next epochs use this sampler's own span.
+        """
+        rank = get_rank() if rank is None else rank
+        num_replicas = get_world_size() if num_replicas is None else num_replicas
+        segments = state_dict["segments"]
+        total = sum(seg["stop"] - seg["start"] for seg in segments)
+        per_rank = total // num_replicas if drop_last else (total + num_replicas - 1) // num_replicas
+        self.epoch = state_dict["epoch"]
+        self.seed = state_dict["seed"]
+        self.segments = split_segments(segments, rank * per_rank, (rank + 1) * per_rank)
+        self.gen_pnt = -1
+
+    def peek(self, n):
+        """Return the next n indices the running iteration will yield."""
+        if self._indices is None:
+            return []
+        return self._indices.slice(self.gen_pnt + 1, self.gen_pnt + 1 + n).tolist()
+
+    def upcoming_shards(self, n):
+        """Return the ids of the next n distinct shards the running iteration will visit, in order."""
+        assert self.shard_cum_lengths is not None, "upcoming_shards requires a ShardListDataset"
+        if self._indices is None:
+            return []
+        window = max(self.chunksize, 1)
+        while True:
+            indices = self._indices.slice(self.gen_pnt + 1, self.gen_pnt + 1 + window)
+            shard_ids, first = np.unique(
+                np.searchsorted(self.shard_cum_lengths, indices, side="right"),
+                return_index=True,
+            )
+            if len(shard_ids) >= n or self.gen_pnt + 1 + window >= len(self._indices):
+                break
+            window *= 2
+        return shard_ids[np.argsort(first)][:n].tolist()
+
+    def _prefetch(self):
+        shard_ids = self.upcoming_shards(self.prefetcher.num_shards)
+        self.prefetcher.prefetch([self.shard_urls[i] for i in shard_ids])
+
+    def permutation(self, epoch=None):
+        """The (lazy) sampling order of an epoch, or the rest of a resumed one."""
+        if epoch is None and self.segments is not None:
+            return SegmentedPermutation(self.segments)
+        return SegmentedPermutation([self.epoch_segment(epoch)])
+
+    def __iter__(self):
+        indices = self._indices = self.permutation()
+        # re-announce the upcoming shards a few times per chunk
+        prefetch_every = max(self.chunksize // 4, 1)
+
+        # resuming from gen_pnt seeks directly into its chunk
+        start = self.gen_pnt + 1
+        for i, index in enumerate(indices.iter_from(start), start=start):
+            if self.prefetcher is not None and (i - start) % prefetch_every == 0:
+                self._prefetch()
             self.gen_pnt = i
-            yield indices[i]
+            yield index
 
         self.epoch += 1
         self.gen_pnt = -1
+        self.segments = None
+        self._indices = None
 
     def __len__(self):
+        if self.segments is not None:
+            return sum(seg["stop"] - seg["start"] for seg in self.segments)
         return self._len
 
 
+def predict_shard_opens(shard_ids, lru_size):
+    """Number of shard opens of an LRU cache of lru_size shards for a sequence of shard accesses."""
+    shard_ids = np.asarray(shard_ids)
+    if len(shard_ids) == 0:
+        return 0
+    # consecutive accesses to the same shard always hit
+    runs = shard_ids[np.r_[True, shard_ids[1:] != shard_ids[:-1]]].tolist()
+    lru = OrderedDict()
+    opens = 0
+    for shard_id in runs:
+        if shard_id in lru:
+            lru.move_to_end(shard_id)
+            continue
+        opens += 1
+        lru[shard_id] = True
+        if len(lru) > lru_size:
+            lru.popitem(last=False)
+    return opens
+
+
+def shuffle_quality(indices, shard_cum_lengths, *, labels=None, batch_size=256, max_lag=10, lru_size=20):
+    """Measure the shuffle quality and the I/O cost of a sampling order.
+
+    Args:
+        indices: the sampling order (dataset indices)
+        shard_cum_lengths: cumulative shard lengths of the dataset
+        labels: optional per-sample labels (aligned with dataset indices), the shard
+            id of each sample is used if not given
+        batch_size: batch size for the per-batch entropy
+        max_lag: largest lag of the label autocorrelation
+        lru_size: number of open shards of the reader
+
+    Returns:
+        a dict with
+            shard_opens: predicted shard opens of an LRU of lru_size shards
+            opens_per_shard: shard_opens / number of shards (1.0 is optimal)
+            batch_shard_entropy: mean entropy (bits) of the shard ids within a batch
+            batch_shard_entropy_max: its value for a perfect shuffle, log2(min(batch_size, #shards))
+            label_autocorrelation: for lags 1..max_lag, P(label[t] == label[t + lag]) minus its
+                value for a perfect shuffle (0.0 is optimal)
+    """
+    indices = np.asarray(indices, dtype=np.int64)
+    shard_cum_lengths = np.asarray(shard_cum_lengths)
+    num_shards = len(shard_cum_lengths)
+    shard_ids = np.searchsorted(shard_cum_lengths, indices, side="right")
+
+    # entropy of the shard distribution within each batch
+    num_batches = len(shard_ids) // batch_size
+    entropy = 0.0
+    if num_batches > 0:
+        batches = np.sort(shard_ids[: num_batches * batch_size].reshape(num_batches, batch_size), axis=1)
+        flat = batches.ravel()
+        starts = np.ones(len(flat), dtype=bool)
+        starts[1:] = flat[1:] != flat[:-1]
+        starts[::batch_size] = True
+        run_ids = np.cumsum(starts) - 1
+        p = np.bincount(run_ids) / batch_size
+        run_batch = np.flatnonzero(starts) // batch_size
+        entropy = float(np.bincount(run_batch, weights=-p * np.log2(p), minlength=num_batches).mean())
+
+    # excess probability that samples at distance lag share a label
+    seq = shard_ids if labels is None else np.asarray(labels)[indices]
+    _, seq = np.unique(seq, return_inverse=True)
+    baseline = float(np.sum((np.bincount(seq) / max(len(seq), 1)) ** 2))
+    autocorrelation = [
+        float(np.mean(seq[lag:] == seq[:-lag]) - baseline) if lag < len(seq) else 0.0 for lag in range(1, max_lag + 1)
+    ]
+
+    shard_opens = predict_shard_opens(shard_ids, lru_size)
+    return dict(
+        num_samples=len(indices),
+        shard_opens=shard_opens,
+        opens_per_shard=shard_opens / max(num_shards, 1),
+        batch_shard_entropy=entropy,
+        batch_shard_entropy_max=float(np.log2(min(batch_size, num_shards))),
+        label_autocorrelation=autocorrelation,
+    )
+
+
 class ChunkedSamplerV2(Sampler):
-    def __init__(self, dataset, *, shuffle=False, seed=0, num_shard_in_chunk="max"):
+    def __init__(
+        self,
+        dataset,
+        *,
+        shuffle=False,
+        seed=0,
+        num_shard_in_chunk="max",
+        group_shards="consecutive",
+        window_chunks=1,
+    ):
         """
         shuffling is slightly different from ChunkedSampler, here each chunk is a tar file,
         instead of a fixed number of samples.
+
+        Multi-level shuffle (when shuffle=True):
+            group_shards: "consecutive" groups neighbouring shards into a chunk, "random"
+                regroups the shards randomly every epoch
+            window_chunks: interleave a sliding window of this many chunks; each sample of the
+                k-th chunk is emitted at a random time in [k, k + window_chunks) (in units of chunks)
+
+        About window_chunks * num_shard_in_chunk shards are read at the same time, the LRU
+        should hold that many. Use `shuffle_stats` to compare settings before a run.
         """
+        assert group_shards in ["consecutive", "random"]
         self.dataset = dataset
         self.seed = seed
         self.shuffle = shuffle
         self.dataset_size = len(dataset)
         self.epoch = 0
+        self.group_shards = group_shards
+        self.window_chunks = window_chunks
 
         capacity = dataset.cache.lru.capacity if num_shard_in_chunk == "max" else num_shard_in_chunk
+        self.num_shard_in_chunk = capacity
         self.lengths = [np.sum(dataset.lengths[i : i + capacity]) for i in range(0, len(dataset.lengths), capacity)]
+        self.shard_lengths = np.asarray(dataset.lengths, dtype=np.int64)
+        self.shard_starts = np.cumsum(self.shard_lengths) - self.shard_lengths
 
     def set_epoch(self, epoch):
         self.epoch = epoch
 
+    def _chunk_indices(self, shards, rng):
+        indices = np.concatenate([np.arange(self.shard_starts[s], self.shard_starts[s] + self.shard_lengths[s]) for s in shards])
+        if self.shuffle:
+            rng.shuffle(indices)
+        return indices
+
+    def _iterate_window(self, epoch):
+        rng = np.random.default_rng([self.seed, epoch])
+        num_shards = len(self.shard_lengths)
+        shard_order = np.arange(num_shards)
+        if self.shuffle and self.group_shards == "random":
+            shard_order = rng.permutation(num_shards)
+        chunks = [shard_order[i : i + self.num_shard_in_chunk] for i in range(0, num_shards, self.num_shard_in_chunk)]
+        if self.shuffle:
+            chunks = [chunks[i] for i in rng.permutation(len(chunks))]
+
+        window = self.window_chunks if self.shuffle else 1
+        active = []
+        for t in range(len(chunks) + window - 1):
+            if t < len(chunks):
+                indices = self._chunk_indices(chunks[t], rng)
+                if self.shuffle:
+                    times = t + window * rng.random(len(indices))
+                else:
+                    times = t + np.arange(len(indices)) / len(indices)
+                active.append((indices, times))
+            # emit the samples scheduled in [t, t + 1)
+            emit_indices, emit_times, remaining = [], [], []
+            for indices, times in active:
+                mask = times < t + 1
+                emit_indices.append(indices[mask])
+                emit_times.append(times[mask])
+                if not mask.all():
+                    remaining.append((indices[~mask], times[~mask]))
+            active = remaining
+            if len(emit_indices) > 0:
+                indices, times = np.concatenate(emit_indices), np.concatenate(emit_times)
+                yield from indices[np.argsort(times, kind="stable")].tolist()
+
+    def iterate_epoch(self, epoch):
+        """Iterate over the sampling order of an epoch."""
+        if self.group_shards == "consecutive" and self.window_chunks == 1:
+            rng = random.Random(self.seed + 1289738273 * epoch)
+            yield from iterate_lengths(
+                self.lengths,
+                rng,
+                indexshuffle=self.shuffle,
+                shardshuffle=self.shuffle,
+                total_size=self.dataset_size,
+            )
+        else:
+            yield from self._iterate_window(epoch)
+
     def __iter__(self):
-        self.rng = random.Random(self.seed + 1289738273 * self.epoch)
-        yield from iterate_lengths(
-            self.lengths,
-            self.rng,
-            indexshuffle=self.shuffle,
-            shardshuffle=self.shuffle,
-            total_size=self.dataset_size,
-        )
+        yield from self.iterate_epoch(self.epoch)
         self.epoch += 1
 
+    def shuffle_stats(self, *, epoch=None, labels=None, batch_size=256, max_lag=10, lru_size=None, num_samples=None):
+        """Measure the shuffle quality and predicted shard opens of an epoch (see shuffle_quality).
+
+        Args:
+            lru_size: the LRU size to simulate, dataset.cache.lru.capacity by default
+            num_samples: only measure the first num_samples samples of the epoch
+        """
+        epoch = self.epoch if epoch is None else epoch
+        num_samples = len(self) if num_samples is None else min(num_samples, len(self))
+        indices = np.fromiter(
+            itertools.islice(self.iterate_epoch(epoch), num_samples), dtype=np.int64, count=num_samples
+        )
+        return shuffle_quality(
+            indices,
+            np.cumsum(self.shard_lengths),
+            labels=labels,
+            batch_size=batch_size,
+            max_lag=max_lag,
+            lru_size=lru_size or self.dataset.cache.lru.capacity,
+        )
+
     def __len__(self):
         return len(self.dataset)
 
@@ -233,6 +644,7 @@ def DistributedChunkedSampler(
     seed: int = 0,
     drop_last: bool = False,
     chunksize: int = "max",
+    prefetcher=None,
 ) -> ChunkedSampler:
     """
     Return a ChunkedSampler for the current worker in distributed training.
@@ -243,6 +655,10 @@ def DistributedChunkedSampler(
     workers end up with a fixed set of shards they need to download. The
     more workers, the fewer shards are used by each worker.
 
+    The per-rank state_dict only resumes with the same world size. To resume
+    a checkpoint with another world size, save `sampler.elastic_state_dict()`
+    (on all ranks) and restore it with `sampler.load_elastic_state_dict(state)`.
+
     Args:
         dataset: The dataset to sample from
         num_replicas: The number of workers
@@ -252,6 +668,8 @@ def DistributedChunkedSampler(
         seed: The seed for the random number generator
         drop_last: Whether to drop the last incomplete chunk
         chunksize: The size of each chunk
+        prefetcher: An optional ShardPrefetcher fed with the upcoming shards of this rank
+            (from the main process when used with DataLoader workers)
 
     """
 
@@ -284,15 +702,301 @@ def DistributedChunkedSampler(
         seed=seed,
         shuffle=shuffle,
         shufflefirst=shuffle,
+        prefetcher=prefetcher,
     )
 
     return sampler
 
 
-import math
+def window_quotas(weights, window):
+    """Split window samples over the sources in proportion to weights (largest remainder)."""
+    raw = np.asarray(weights, dtype=np.float64) * window
+    quotas = np.floor(raw).astype(np.int64)
+    # stable sort, so ties go to the first sources
+    extra = np.argsort(-(raw - quotas), kind="stable")[: window - int(quotas.sum())]
+    quotas[extra] += 1
+    return quotas
+
+
+class MixtureChunkedSampler(Sampler):
+    """A weighted mixture of several ShardListDatasets that keeps the chunk locality of ChunkedSampler.
+
+    The dataset is a torch ConcatDataset of the sources. Each source is read through
+    its own stream of ChunkedPermutations over this rank's part of the source (a new
+    permutation every time the source is exhausted, so small sources are repeated), so
+    at any time one chunk per source is open and each source's LRUShards only sees its
+    chunk. The sources are interleaved within windows of `window` samples; every full
+    window holds exactly round(window * weight) samples of each source, in a random
+    order. All randomness derives from (seed, epoch, source, ...), so the position in
+    the epoch (gen_pnt) is enough to resume.
+
+    Args:
+        dataset: a ConcatDataset of the sources
+        weights: the mixing weights of the sources (normalized)
+        num_samples: samples per epoch on this rank (len(dataset) / num_replicas by default)
+        chunksize: chunk size of every source, a list of them, or "max" for the LRU
+            capacity of each source (see estimate_chunksize)
+        window: number of samples over which the mixing ratios are exact
+        seed: seed shared by all ranks
+        shuffle: shuffle the chunks, the samples within chunks and the sources within windows
+        rank, num_replicas: the distributed split; each rank reads its own contiguous part
+            of every source, as in DistributedChunkedSampler
+    """
+
+    def __init__(
+        self,
+        dataset,
+        weights,
+        *,
+        num_samples=None,
+        chunksize="max",
+        window=1000,
+        seed=0,
+        shuffle=True,
+        rank=None,
+        num_replicas=None,
+    ):
+        assert hasattr(dataset, "cumulative_sizes"), f"The dataset must be a ConcatDataset, but got {dataset}"
+        sources = dataset.datasets
+        assert len(weights) == len(sources), "one weight per source"
+        assert all(len(source) > 0 for source in sources), "empty source"
+        self.rank = get_rank() if rank is None else rank
+        self.num_replicas = get_world_size() if num_replicas is None else num_replicas
+        self.weights = np.asarray(weights, dtype=np.float64) / np.sum(weights)
+        self.window = window
+        self.seed = seed
+        self.shuffle = shuffle
+        self.offsets = [0] + list(dataset.cumulative_sizes[:-1])
+        self.source_sizes = [len(source) for source in sources]
+
+        if not isinstance(chunksize, (list, tuple)):
+            chunksize = [chunksize] * len(sources)
+        self.chunksize = [
+            (estimate_chunksize(source) if hasattr(source, "cache") else 2000) if c == "max" else c
+            for c, source in zip(chunksize, sources)
+        ]
+        # this rank's part of every source, padded by wrapping around
+        self.spans = []
+        for size in self.source_sizes:
+            per_rank = (size + self.num_replicas - 1) // self.num_replicas
+            self.spans.append((self.rank * per_rank, (self.rank + 1) * per_rank))
+
+        self._len = num_samples or (len(dataset) + self.num_replicas - 1) // self.num_replicas
+        self.quotas = window_quotas(self.weights, window)
+        self.epoch = 0
+        self.gen_pnt = -1
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def load_state_dict(self, state_dict, strict=True):
+        def _safe_overwrite(variable_name, ignore_diff=False):
+            if variable_name in state_dict:
+                if not ignore_diff:
+                    assert np.all(np.asarray(getattr(self, variable_name)) == np.asarray(state_dict[variable_name]))
+                setattr(self, variable_name, state_dict[variable_name])
+
+        _safe_overwrite("epoch", ignore_diff=True)
+        _safe_overwrite("gen_pnt", ignore_diff=True)
+        _safe_overwrite("seed", ignore_diff=True)
+        for variable_name in ["weights", "window", "chunksize", "spans", "shuffle"]:
+            if variable_name in state_dict:
+                _safe_overwrite(variable_name, ignore_diff=not strict)
+        self.weights = np.asarray(self.weights, dtype=np.float64)
+        self.quotas = window_quotas(self.weights, self.window)
+
+    def state_dict(self):
+        return {
+            "epoch": self.epoch,
+            "gen_pnt": self.gen_pnt,
+            "seed": self.seed,
+            "shuffle": self.shuffle,
+            "weights": self.weights.tolist(),
+            "window": self.window,
+            "chunksize": self.chunksize,
+            "spans": self.spans,
+        }
+
+    def source_permutation(self, source, epoch, repeat):
+        """The repeat-th pass of the epoch over this rank's part of a source."""
+        lo, hi = self.spans[source]
+        chunksize = self.chunksize[source]
+        seed = int(np.random.SeedSequence([self.seed, epoch, source, repeat]).generate_state(1)[0])
+        return ChunkedPermutation(
+            [min(chunksize, hi - i) for i in range(lo, hi, chunksize)],
+            seed,
+            start_offset=lo,
+            indexshuffle=self.shuffle,
+            shardshuffle=self.shuffle,
+            total_size=self.source_sizes[source],
+        )
+
+    def _source_stream(self, source, epoch, pos):
+        """Iterate over the (global) indices of a source from its pos-th sample of the epoch on."""
+        length = self.spans[source][1] - self.spans[source][0]
+        repeat, pos = divmod(pos, length)
+        offset = self.offsets[source]
+        while True:
+            for index in self.source_permutation(source, epoch, repeat).iter_from(pos):
+                yield index + offset
+            repeat, pos = repeat + 1, 0
+
+    def window_sources(self, epoch, k):
+        """The source of every position of the k-th window of an epoch."""
+        size = min(self.window, self._len - k * self.window)
+        quotas = self.quotas if size == self.window else window_quotas(self.weights, size)
+        sources = np.repeat(np.arange(len(quotas)), quotas)
+        if self.shuffle:
+            sources = np.random.default_rng([self.seed, epoch, k]).permutation(sources)
+        return sources
+
+    def source_counts(self, pos, epoch=None):
+        """The number of samples taken from each source before position pos of an epoch."""
+        epoch = self.epoch if epoch is None else epoch
+        k, offset = divmod(pos, self.window)
+        counts = self.quotas * k
+        if offset > 0:
+            counts = counts + np.bincount(self.window_sources(epoch, k)[:offset], minlength=len(self.quotas))
+        return counts
+
+    def __iter__(self):
+        epoch = self.epoch
+        start = self.gen_pnt + 1
+        streams = [
+            self._source_stream(source, epoch, int(count)) for source, count in enumerate(self.source_counts(start))
+        ]
+        k, offset = divmod(start, self.window)
+        pos = start
+        while pos < self._len:
+            for source in self.window_sources(epoch, k)[offset:].tolist():
+                self.gen_pnt = pos
+                pos += 1
+                yield next(streams[source])
+            k, offset = k + 1, 0
+
+        self.epoch += 1
+        self.gen_pnt = -1
+
+    def __len__(self):
+        return self._len
+
+
+class ShardAffineBatchSampler(Sampler):
+    """A batch sampler that gives each DataLoader worker its own shards.
+
+    The DataLoader hands batch i to worker i % num_workers. This batch sampler
+    takes the indices of `sampler` in windows (a chunk of a ChunkedSampler by
+    default), assigns the shards of each window to workers balanced by their
+    number of samples, and emits the batches of worker w at the positions
+    w, w + num_workers, ..., so every worker only opens the shards assigned to
+    it. Samples are kept in sampler order within each worker, and the batch
+    order only depends on the sampler order, i.e. it is deterministic.
+
+    Use it with `batch_sampler=` and `worker_init_fn=shard_affine_worker_init_fn`,
+    and with the same num_workers as the DataLoader:
+
+        batch_sampler = ShardAffineBatchSampler(dataset, sampler, batch_size=32, num_workers=8)
+        loader = DataLoader(dataset, batch_sampler=batch_sampler, num_workers=8,
+                            worker_init_fn=shard_affine_worker_init_fn)
+
+    Args:
+        dataset: the ShardListDataset
+        sampler: the sampler of the indices, e.g. a ChunkedSampler
+        batch_size: the batch size
+        num_workers: the num_workers of the DataLoader
+        drop_last: drop the last incomplete batch
+        window: number of indices whose shards are assigned together
+            (sampler.chunksize if available)
+    """
+
+    def __init__(self, dataset, sampler, *, batch_size, num_workers, drop_last=False, window=None):
+        self.dataset = dataset
+        self.sampler = sampler
+        self.batch_size = batch_size
+        self.num_workers = max(num_workers, 1)
+        self.drop_last = drop_last
+        if window is None:
+            window = getattr(sampler, "chunksize", batch_size * self.num_workers)
+        self.window = max(window, batch_size)
+
+    def set_epoch(self, epoch):
+        if hasattr(self.sampler, "set_epoch"):
+            self.sampler.set_epoch(epoch)
+
+    def state_dict(self):
+        return self.sampler.state_dict()
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.sampler.load_state_dict(state_dict, strict=strict)
+
+    def assign(self, indices):
+        """Return the worker of each index, assigning whole shards to the least loaded worker."""
+        shard_ids, _ = self.dataset.locate(indices)
+        shards, inverse, counts = np.unique(shard_ids, return_inverse=True, return_counts=True)
+        load = np.zeros(self.num_workers, dtype=np.int64)
+        shard_worker = np.zeros(len(shards), dtype=np.int64)
+        # largest shards first; ties broken by shard id, so the assignment is deterministic
+        for i in np.lexsort((shards, -counts)):
+            shard_worker[i] = np.argmin(load)
+            load[shard_worker[i]] += counts[i]
+        return shard_worker[inverse]
+
+    def __iter__(self):
+        queues = [[] for _ in range(self.num_workers)]
+        num_batches = 0
+
+        def _emit():
+            # the batch at position num_batches is loaded by worker num_batches % num_workers
+            nonlocal num_batches
+            while len(queues[num_batches % self.num_workers]) >= self.batch_size:
+                queue = queues[num_batches % self.num_workers]
+                batch = queue[: self.batch_size]
+                del queue[: self.batch_size]
+                num_batches += 1
+                yield batch
+
+        def _flush():
+            # the workers ran out of own samples, batch the leftovers together
+            leftover = [index for queue in queues for index in queue]
+            for i in range(0, len(leftover), self.batch_size):
+                batch = leftover[i : i + self.batch_size]
+                if self.drop_last and len(batch) < self.batch_size:
+                    return
+                yield batch
+
+        window = []
+        for index in self.sampler:
+            window.append(index)
+            if len(window) < self.window:
+                continue
+            for index, worker in zip(window, self.assign(window).tolist()):
+                queues[worker].append(index)
+            window = []
+            yield from _emit()
+
+        if len(window) > 0:
+            for index, worker in zip(window, self.assign(window).tolist()):
+                queues[worker].append(index)
+        yield from _emit()
+        yield from _flush()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.sampler) // self.batch_size
+        return (len(self.sampler) + self.batch_size - 1) // self.batch_size
+
+
+def shard_affine_worker_init_fn(worker_id):
+    """worker_init_fn for ShardAffineBatchSampler: shrink the per-worker shard LRU.
+
+    Each worker only sees about 1/num_workers of the shards of a window, so its
+    LRUShards needs proportionally fewer open shards (at least 2, to hold the
+    shards of the current and the previous window).
+    """
+    worker_info = torch.utils.data.get_worker_info()
+    lru = worker_info.dataset.cache.lru
+    lru.capacity = max(math.ceil(lru.capacity / worker_info.num_workers), 2)
 
-import torch
-from torch.utils.data.distributed import DistributedSampler
 
 
 class DistributedLocalSampler(DistributedSampler):
@@ -0,0 +1,155 @@
+"""
+A streaming counterpart of ShardListDataset.
+
+ShardListStream reads each shard front to back with tarfile's streaming mode,
+straight from the stdout of the download command (see `wids_dl.open_stream`),
+so no shard has to be downloaded or indexed before its first sample. This
+suits storage that is only fast when read sequentially (object stores, HDD
+arrays). Samples have the same layout as in ShardListDataset ({".ext": stream},
+"__key__", "__shard__", "__shardindex__", "__index__"), so the same
+transformations apply and results stay comparable with the indexed mode.
+
+Shards are shuffled per epoch with a seed shared by all ranks, then split over
+ranks and DataLoader workers; samples are shuffled within a bounded buffer.
+Ranks may get different numbers of samples; with DataLoader workers, call
+set_epoch at every epoch, since the workers iterate over copies of the dataset.
+"""
+
+import io
+import random
+import tarfile
+
+import numpy as np
+
+from ...dist import get_rank, get_world_size
+from .wids import interpret_transformations
+from .wids_dl import open_stream
+from .wids_mmtar import sample_key
+
+try:
+    from torch.utils.data import IterableDataset, get_worker_info
+except ImportError:
+
+    class IterableDataset:
+        pass
+
+    def get_worker_info():
+        return None
+
+
+def iterate_tar_samples(stream):
+    """Yield (key, {".ext": BytesIO}) for consecutive members with the same key, in tar order."""
+    key, sample = None, None
+    with tarfile.open(fileobj=stream, mode="r|") as tar:
+        for member in tar:
+            if not member.isfile():
+                continue
+            k = sample_key(member.name)
+            if k is None:
+                continue
+            if k != key:
+                if sample is not None:
+                    yield key, sample
+                key, sample = k, {}
+            sample[member.name[len(k) :]] = io.BytesIO(tar.extractfile(member).read())
+    if sample is not None:
+        yield key, sample
+
+
+class ShardListStream(IterableDataset):
+    """An iterable dataset that streams the samples of a list of shards.
+
+    Args:
+        shards: a list of urls, or of dicts with "url" and optionally "nsamples" (e.g. the
+            shardlist of a ShardListDataset spec); "__index__" is only set if all shards
+            have nsamples
+        transformations: like ShardListDataset
+        shuffle_buffer: number of samples in the shuffle buffer (0 or 1 disables shuffling)
+        shuffle_shards: shuffle the order of the shards every epoch
+        seed: seed of the shard and sample shuffling
+        split_by_rank: split the shards over the ranks of the distributed job
+    """
+
+    def __init__(
+        self,
+        shards,
+        *,
+        transformations="PIL",
+        shuffle_buffer=1000,
+        shuffle_shards=True,
+        seed=0,
+        split_by_rank=True,
+    ):
+        super().__init__()
+        self.shards = [{"url": shard} if isinstance(shard, str) else dict(shard) for shard in shards]
+        self.shard_starts = None
+        if all("nsamples" in shard for shard in self.shards):
+            lengths = [shard["nsamples"] for shard in self.shards]
+            self.shard_starts = (np.cumsum(lengths) - lengths).tolist()
+        self.transformations = interpret_transformations(transformations)
+        self.shuffle_buffer = shuffle_buffer
+        self.shuffle_shards = shuffle_shards
+        self.seed = seed
+        self.split_by_rank = split_by_rank
+        self.epoch = 0
+
+    def add_transform(self, transform):
+        """Add a transformation to the dataset."""
+        self.transformations.append(transform)
+        return self
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def shard_ids(self):
+        """The ids of the shards read by this rank and worker in the current epoch."""
+        shard_ids = list(range(len(self.shards)))
+        if self.shuffle_shards:
+            # same order on all ranks, so the split below is a partition
+            random.Random(self.seed + 1289738273 * self.epoch).shuffle(shard_ids)
+        if self.split_by_rank:
+            shard_ids = shard_ids[get_rank() :: get_world_size()]
+        worker_info = get_worker_info()
+        if worker_info is not None:
+            shard_ids = shard_ids[worker_info.id :: worker_info.num_workers]
+        return shard_ids
+
+    def iterate_raw(self, shard_ids):
+        """Yield the raw samples of the given shards, in order."""
+        for shard_id in shard_ids:
+            desc = self.shards[shard_id]
+            with open_stream(desc["url"]) as stream:
+                for inner_idx, (key, sample) in enumerate(iterate_tar_samples(stream)):
+                    sample["__key__"] = key
+                    sample["__dataset__"] = desc.get("dataset")
+                    sample["__index__"] = self.shard_starts[shard_id] + inner_idx if self.shard_starts else None
+                    sample["__shard__"] = desc["url"]
+                    sample["__shardindex__"] = inner_idx
+                    yield sample
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        rng = random.Random(
+            hash((self.seed, self.epoch, get_rank(), worker_info.id if worker_info is not None else -1))
+        )
+        buffer = []
+        for sample in self.iterate_raw(self.shard_ids()):
+            if self.shuffle_buffer <= 1:
+                yield self.transform(sample)
+                continue
+            buffer.append(sample)
+            if len(buffer) < self.shuffle_buffer:
+                continue
+            # swap a random sample to the end and emit it
+            i = rng.randrange(len(buffer))
+            buffer[i], buffer[-1] = buffer[-1], buffer[i]
+            yield self.transform(buffer.pop())
+        rng.shuffle(buffer)
+        for sample in buffer:
+            yield self.transform(sample)
+        self.epoch += 1
+
+    def transform(self, sample):
+        for transform in self.transformations:
+            sample = transform(sample)
+        return sample
@@ -20,7 +20,7 @@ class TarFileReader:
     def __init__(self, file, index_file=find_index_file, verbose=True):
         self.verbose = verbose
         if callable(index_file):
-            index_file = index_file(file)
+            index_file = index_file(file if isinstance(file, str) else file.name)
         self.index_file = index_file
 
         # Open the tar file and keep it open
@@ -1,43 +1,237 @@
 import os
 import os.path as osp
-import tarfile
+import shutil
+import uuid
+from functools import partial
 
 import numpy as np
 
-from ...utils.io import load_pickle, save_pickle
 from ...utils.multiproc import map_async_with_thread
-from ...dist import get_rank, get_world_size, all_gather_object
-from ...utils.system import get_strhash, is_valid_file
+from ...dist import get_rank, get_world_size, all_gather_object, synchronize
+from ...utils.system import get_strhash
+from .wids_mmtar import find_mmindex_file, next_header, parse_member, parse_tar_header, sample_key
+from .wids_ztar import CompressedIndexedTar, compressed_codec
 
 
-def get_tarfile_keys(files, cache_dir=None):
+def tar_header_ok(block):
+    """Check the checksum of a 512-byte tar header block."""
+    try:
+        expected = int(block[148:156].rstrip(b" \x00").decode() or "-1", 8)
+    except ValueError:
+        return False
+    unsigned = sum(block[:148]) + 8 * 32 + sum(block[156:512])
+    signed = unsigned - 2 * sum(b for b in block[:148] + block[156:512] if b > 127)
+    return expected in (unsigned, signed)
+
+
+def scan_tar_members(path, read_size=1 << 22, strict=False, index_cache=None):
+    """Yield (name, offset, size) of the regular files in a tar file, reading headers only.
+
+    Headers are parsed out of large sequential reads; payloads that do not fit in
+    the read buffer are skipped with a seek instead of being read. For compressed
+    shards, offsets are in the uncompressed tar and come from its TarIndex, which
+    is looked up (or saved) in index_cache like LRUShards does.
+
+    With `strict`, raise ValueError after the last good member if a header is
+    corrupt, a payload runs past the end of the file, or the end-of-archive
+    block is missing (i.e. the shard is truncated).
+    """
+    if compressed_codec(path) is not None:
+        index_file = partial(find_mmindex_file, index_cache=index_cache)
+        reader = CompressedIndexedTar(path, index_file=index_file, verbose=False)
+        try:
+            index = reader.index
+            for i in range(len(index)):
+                yield index.name(i), int(index.offsets[i]), int(index.sizes[i])
+        finally:
+            reader.close()
+        return
+    with open(path, "rb", buffering=0) as stream:
+        filesize = os.fstat(stream.fileno()).st_size
+        buf, buf_start = b"", 0
+        offset = 0
+        while 0 <= offset < filesize:
+            if offset < buf_start or offset + 512 > buf_start + len(buf):
+                stream.seek(offset)
+                buf, buf_start = stream.read(read_size), offset
+                if len(buf) < 512:
+                    break
+            rel = offset - buf_start
+            if strict and buf[rel : rel + 512] != bytes(512) and not tar_header_ok(buf[rel : rel + 512]):
+                raise ValueError(f"{path}: corrupt tar header at offset {offset}")
+            header = parse_tar_header(buf[rel : rel + 500])
+            member = parse_member(header)
+            end = next_header(offset, header)
+            if strict and end > filesize:
+                raise ValueError(f"{path}: truncated member at offset {offset}")
+            if member is not None:
+                yield member[0], offset, member[1]
+            offset = end
+        if strict and offset >= 0:
+            raise ValueError(f"{path}: truncated, no end-of-archive block")
+
+
+def scan_tar_keys(path, read_size=1 << 22, index_cache=None):
+    """Return the sample keys of a tar file and the header offset of the first member of each sample.
+
+    Samples are ordered by first appearance, as in IndexedTarSamples.
+    """
+    keys, offsets = [], []
+    seen = set()
+    for name, offset, size in scan_tar_members(path, read_size=read_size, index_cache=index_cache):
+        key = sample_key(name)
+        if key is None or key in seen:
+            continue
+        seen.add(key)
+        keys.append(key)
+        offsets.append(offset)
+    return keys, offsets
+
+
+class TarKeys:
+    """Consolidated keys and sample offsets of all shards of a dataset.
 
-    keys_by_file = {}
+    Stored as a directory of .npy files (memory-mapped on load):
+
+        lengths   int64[nshards]     number of samples per shard
+        key_blob  uint8[m]           packed utf-8 keys
+        key_ptr   int64[nkeys + 1]   offsets of each key in key_blob
+        offsets   int64[nkeys]       tar header offset of the first member of each sample
+    """
+
+    FILES = ["lengths", "key_blob", "key_ptr", "offsets"]
+
+    def __init__(self, lengths, key_blob, key_ptr, offsets):
+        self.lengths = lengths
+        self.key_blob = key_blob
+        self.key_ptr = key_ptr
+        self.offsets = offsets
+        self.starts = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+
+    @classmethod
+    def from_scans(cls, scans):
+        """Build from a list of (keys, offsets) pairs, one per shard."""
+        encoded = [key.encode("utf-8") for keys, offsets in scans for key in keys]
+        key_ptr = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=key_ptr[1:])
+        return cls(
+            lengths=np.array([len(keys) for keys, offsets in scans], dtype=np.int64),
+            key_blob=np.frombuffer(b"".join(encoded), dtype=np.uint8),
+            key_ptr=key_ptr,
+            offsets=np.array([o for keys, offsets in scans for o in offsets], dtype=np.int64),
+        )
 
-    def _get_keys(file):
-        filehash = get_strhash(file)
-        file_index_cache = (
-            None if cache_dir is None else osp.join(cache_dir, f"{filehash}.pkl")
+    @classmethod
+    def concat(cls, parts):
+        blob_sizes = [len(part.key_blob) for part in parts]
+        blob_starts = np.concatenate([[0], np.cumsum(blob_sizes)]).astype(np.int64)
+        key_ptr = np.concatenate(
+            [part.key_ptr[:-1] + start for part, start in zip(parts, blob_starts)] + [blob_starts[-1:]]
         )
+        return cls(
+            lengths=np.concatenate([part.lengths for part in parts]).astype(np.int64),
+            key_blob=np.concatenate([part.key_blob for part in parts]).astype(np.uint8),
+            key_ptr=key_ptr.astype(np.int64),
+            offsets=np.concatenate([part.offsets for part in parts]).astype(np.int64),
+        )
+
+    def __getstate__(self):
+        # gather plain arrays (not memmaps) through the process group
+        return {name: np.asarray(getattr(self, name)) for name in self.FILES}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def save(self, index_dir):
+        """Atomically save the index as a directory of .npy files."""
+        temp_dir = f"{index_dir}.{uuid.uuid4().hex}.temp"
+        os.makedirs(temp_dir, exist_ok=True)
+        for name in self.FILES:
+            np.save(osp.join(temp_dir, name + ".npy"), getattr(self, name))
+        try:
+            os.rename(temp_dir, index_dir)
+        except OSError:
+            # another process saved the same index first
+            shutil.rmtree(temp_dir, ignore_errors=True)
+
+    @classmethod
+    def load(cls, index_dir):
+        """Memory-map a saved index, or return None if there is none."""
+        if index_dir is None or not all(osp.exists(osp.join(index_dir, name + ".npy")) for name in cls.FILES):
+            return None
+        return cls(*[np.load(osp.join(index_dir, name + ".npy"), mmap_mode="r") for name in cls.FILES])
+
+    def __len__(self):
+        return len(self.lengths)
+
+    def keys(self, shard_idx):
+        """Return the keys of a shard as a list of str."""
+        lo, hi = self.starts[shard_idx], self.starts[shard_idx + 1]
+        ptr = self.key_ptr[lo : hi + 1] - self.key_ptr[lo]
+        blob = self.key_blob[self.key_ptr[lo] : self.key_ptr[hi]].tobytes()
+        return [blob[ptr[i] : ptr[i + 1]].decode("utf-8") for i in range(hi - lo)]
+
+    def keys_by_shard(self):
+        return [self.keys(i) for i in range(len(self))]
+
 
-        if is_valid_file(file_index_cache):
-            return load_pickle(file_index_cache)
+def _gather_parts(part, index_dir):
+    """Share the per-rank parts of the index; through index_dir if all ranks can see it, else through the process group."""
+    rank, world_size = get_rank(), get_world_size()
+    part_dir = None
+    if index_dir is not None:
+        part_dir = f"{index_dir}.part{rank}"
+        shutil.rmtree(part_dir, ignore_errors=True)
+        part.save(part_dir)
+    synchronize()
 
-        with tarfile.open(file, "r") as tar:
-            keys = [_.name.split(".")[0] for _ in tar.getmembers()]
+    part_dirs = [f"{index_dir}.part{r}" for r in range(world_size)]
+    visible = index_dir is not None and all(osp.exists(d) for d in part_dirs)
+    if all(all_gather_object(visible)):
+        parts = [TarKeys.load(d) for d in part_dirs]
+    else:
+        # no shared filesystem, send the compact arrays instead
+        parts = all_gather_object(part)
+    index = TarKeys.concat(parts)
 
-        repeated = set()
-        unique_keys = []
-        for key in keys:
-            if key not in repeated:
-                repeated.add(key)
-                unique_keys.append(key)
+    synchronize()
+    if part_dir is not None:
+        shutil.rmtree(part_dir, ignore_errors=True)
+    return index
 
-        if file_index_cache is not None:
-            os.makedirs(osp.dirname(file_index_cache), exist_ok=True)
-            save_pickle(unique_keys, file_index_cache)
 
-        return unique_keys
+def get_files_hash(files):
+    """Fingerprint of a list of shards for cache names: their paths, and the size and mtime of local ones.
+
+    A shard rewritten in place then gets new cached indices instead of stale ones.
+    """
+    parts = []
+    for file in files:
+        try:
+            st = os.stat(file)
+            parts.append(f"{file}:{st.st_size}:{st.st_mtime_ns}")
+        except OSError:
+            parts.append(file)
+    return get_strhash("\n".join(parts))
+
+
+def get_tarfile_index(files, cache_dir=None, num_thread=64, read_size=1 << 22, scan_keys=scan_tar_keys):
+    """Return the consolidated TarKeys of a list of tar files.
+
+    The index is cached as a single index per dataset in cache_dir. On a miss,
+    each rank scans the headers of its partition of the files, and the parts are
+    combined through the filesystem (or the process group if cache_dir is not shared).
+    The TarIndex of compressed shards, built while scanning, is saved in cache_dir
+    too, where LRUShards (with the same index_cache) finds it.
+
+    scan_keys(file, read_size=, index_cache=) scans one file; the default reads
+    local paths, LRUShards.scan_keys downloads remote shards first.
+    """
+    index_dir = None if cache_dir is None else osp.join(cache_dir, "tarkeys_" + get_files_hash(files))
+    index = TarKeys.load(index_dir)
+    # the miss path is collective: with node-local cache dirs, only a hit on every rank may skip it
+    if all(all_gather_object(index is not None)):
+        return index
 
     num_parititons = min(len(files), get_world_size())
     partition_idx = get_rank()
@@ -48,19 +242,26 @@ def get_tarfile_keys(files, cache_dir=None):
         else []
     )
 
-    keys_by_file_at_rank = map_async_with_thread(
+    scans = map_async_with_thread(
         iterable=files_at_rank,
-        func=_get_keys,
+        func=lambda file: scan_keys(file, read_size=read_size, index_cache=cache_dir),
         verbose=True,
-        desc="Gathering keys from tar files",
-        num_thread=64,
+        desc="Scanning tar headers",
+        num_thread=num_thread,
     )
-    keys_by_file = all_gather_object(keys_by_file_at_rank)
-    keys_by_file = [keys for sublist in keys_by_file for keys in sublist]
+    part = TarKeys.from_scans(scans)
+    index = _gather_parts(part, index_dir) if get_world_size() > 1 else part
 
-    keys_by_file = {file: keys for file, keys in zip(files, keys_by_file)}
+    if index_dir is not None:
+        index.save(index_dir)
+        index = TarKeys.load(index_dir)
+    return index
 
-    return keys_by_file
+
+def get_tarfile_keys(files, cache_dir=None):
+    """Return a dict mapping each tar file to its list of sample keys."""
+    index = get_tarfile_index(files, cache_dir=cache_dir)
+    return {file: index.keys(i) for i, file in enumerate(files)}
 
 
 def get_shard_meta(shards, keys_by_shard):
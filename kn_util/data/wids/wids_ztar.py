@@ -0,0 +1,357 @@
+"""
+Random access to compressed tar shards (.tar.gz / .tgz / .tar.zst).
+
+A seekable compressed shard is a concatenation of independently compressed
+frames (gzip members or zstd frames), so it is still a valid .tar.gz/.tar.zst
+for standard tools. `compress_tar` cuts the frames at sample boundaries once a
+frame holds `frame_size` uncompressed bytes, and writes a frame table next to
+the shard:
+
+    <shard>.frames   int64[nframes + 1, 2]   (uncompressed offset, compressed offset)
+                                             of each frame, plus the end offsets
+
+together with the binary TarIndex of the uncompressed tar (see wids_mmtar), so
+reading a member decompresses only the frames it overlaps. Readers look for the
+TarIndex in their index_cache (see LRUShards) and then next to the shard, so the
+one written by `compress_tar` is found whatever index_cache the dataset uses. Decompressed frames
+are kept in a per-process LRU (FrameCache) since neighbouring samples share
+frames. Shards without a frame table (e.g. from `tar czf`, or downloaded
+without it) are decompressed as a whole on their first open, which also writes
+the table; single-frame shards stay decompressed in memory while open.
+
+    python -m kn_util.data.wids.wids_ztar shards/*.tar --codec gz --frame-size 4e6
+"""
+
+import argparse
+import io
+import mmap
+import os
+import zlib
+from collections import OrderedDict
+from functools import partial
+
+import numpy as np
+
+from .wids_mmtar import TarIndex, find_mmindex_file, sample_key
+
+CODEC_EXTENSIONS = {".tar.gz": "gz", ".tgz": "gz", ".tar.zst": "zst", ".tar.zstd": "zst"}
+
+
+def compressed_codec(path):
+    """Return the codec ("gz" or "zst") of a compressed shard name, or None for a plain tar."""
+    if not isinstance(path, str):
+        return None
+    for ext, codec in CODEC_EXTENSIONS.items():
+        if path.endswith(ext):
+            return codec
+    return None
+
+
+def find_frame_file(file):
+    return file + ".frames"
+
+
+def _zstd():
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("zstd compressed shards require the zstandard package (pip install zstandard)")
+    return zstandard
+
+
+def compress_frame(data, codec, level):
+    if codec == "gz":
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+        return compressor.compress(data) + compressor.flush()
+    return _zstd().ZstdCompressor(level=level).compress(data)
+
+
+def decompress_frame(data, codec):
+    if codec == "gz":
+        return zlib.decompress(data, 31)
+    return _zstd().ZstdDecompressor().decompress(data)
+
+
+def _decompressobj(codec):
+    if codec == "gz":
+        return zlib.decompressobj(31)
+    return _zstd().ZstdDecompressor().decompressobj()
+
+
+def scan_frames(stream, codec, chunk_size=1 << 20):
+    """Decompress a whole shard frame by frame.
+
+    Returns the uncompressed bytes and the frame table, so that shards converted
+    by other tools (or downloaded without their .frames file) get one on first open.
+    """
+    stream.seek(0)
+    parts = []
+    frames = [(0, 0)]
+    usize, csize = 0, 0
+    decompressor = _decompressobj(codec)
+    pending = b""
+    while True:
+        data = pending or stream.read(chunk_size)
+        pending = b""
+        if not data:
+            break
+        out = decompressor.decompress(data)
+        parts.append(out)
+        usize += len(out)
+        if decompressor.eof:
+            # the rest of the chunk belongs to the next frame
+            pending = decompressor.unused_data
+            csize += len(data) - len(pending)
+            frames.append((usize, csize))
+            decompressor = _decompressobj(codec)
+        else:
+            csize += len(data)
+    assert frames[-1][1] == csize, f"truncated compressed shard: {getattr(stream, 'name', stream)}"
+    return b"".join(parts), np.array(frames, dtype=np.int64)
+
+
+def save_frames(frame_file, frames):
+    np.save(frame_file + ".temp.npy", frames)
+    os.replace(frame_file + ".temp.npy", frame_file)
+
+
+class FrameCache:
+    """A per-process LRU of decompressed frames with a byte budget."""
+
+    def __init__(self, max_bytes=int(2.5e8)):
+        self.max_bytes = max_bytes
+        self.frames = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, load):
+        data = self.frames.get(key)
+        if data is not None:
+            self.frames.move_to_end(key)
+            self.hits += 1
+            return data
+        self.misses += 1
+        data = load()
+        if len(data) <= self.max_bytes:
+            self.frames[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.frames.popitem(last=False)
+                self.size -= len(evicted)
+        return data
+
+
+frame_cache = FrameCache(int(float(os.environ.get("WIDS_FRAME_CACHE", 2.5e8))))
+
+
+def compress_tar(src, dst=None, codec="gz", frame_size=1 << 22, level=None, index_file=find_mmindex_file):
+    """Convert a plain tar shard into a seekable compressed shard with its frame table and TarIndex.
+
+    Args:
+        src: the plain tar file
+        dst: the compressed shard (src + ".gz" / ".zst" by default)
+        codec: "gz" or "zst"
+        frame_size: uncompressed bytes per frame; frames end at sample boundaries
+        level: compression level (6 for gz, 3 for zst by default)
+        index_file: where to save the TarIndex (a path, or a callable of dst); next
+            to dst by default, where CompressedIndexedTar also looks whatever its index_file
+    Returns:
+        the path of the compressed shard
+    """
+    assert codec in ["gz", "zst"]
+    dst = dst or src + "." + codec
+    assert compressed_codec(dst) == codec, f"{dst} does not have a .tar.{codec} extension"
+    level = level if level is not None else (6 if codec == "gz" else 3)
+    with open(src, "rb") as stream, mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+        index = TarIndex.build(buf)
+        # cut at the first member of a sample once the frame is full
+        cuts = [0]
+        key = None
+        for i in range(len(index)):
+            k = sample_key(index.name(i))
+            offset = int(index.offsets[i])
+            if k != key and offset - cuts[-1] >= frame_size:
+                cuts.append(offset)
+            key = k
+        cuts.append(len(buf))
+
+        frames = [(0, 0)]
+        with open(dst + ".temp", "wb") as out:
+            for start, end in zip(cuts[:-1], cuts[1:]):
+                out.write(compress_frame(buf[start:end], codec, level))
+                frames.append((end, out.tell()))
+        os.replace(dst + ".temp", dst)
+
+    save_frames(find_frame_file(dst), np.array(frames, dtype=np.int64))
+    if callable(index_file):
+        index_file = index_file(dst)
+    if index_file is not None:
+        index.save(index_file, os.stat(dst))
+    return dst
+
+
+class CompressedIndexedTar:
+    """Random access to the members of a seekable compressed tar, with the interface of MMIndexedTar.
+
+    Args:
+        fname: path or open binary stream of the compressed shard
+        index_file: TarIndex location (a path, or a callable mapping the shard path to one);
+            the index next to the shard (written by compress_tar) is used if it is missing there
+        frame_cache: the FrameCache for decompressed frames (the module-level one by default)
+    """
+
+    def __init__(self, fname, index_file=None, verbose=True, cleanup_callback=None, advice=None, frame_cache=None):
+        self.verbose = verbose
+        if isinstance(fname, str):
+            self.stream = open(fname, "rb")
+            self.fname = fname
+        else:
+            self.stream = fname
+            self.fname = getattr(fname, "name", None)
+            if not isinstance(self.fname, str):
+                self.fname = None
+        self.codec = compressed_codec(self.fname)
+        assert self.codec is not None, f"unknown compressed shard format: {self.fname}"
+        self.frame_cache = frame_cache or globals()["frame_cache"]
+        st = os.fstat(self.stream.fileno())
+        self.cache_key = (self.fname, st.st_mtime_ns)
+
+        self.frames = None
+        self.whole = None
+        frame_file = find_frame_file(self.fname)
+        if os.path.exists(frame_file):
+            frames = np.load(frame_file, mmap_mode="r")
+            # stale if the shard was rewritten after the table
+            if frames[-1, 1] == st.st_size:
+                self.frames = frames
+        if self.frames is None:
+            if verbose:
+                print("No frame table for", self.fname, "decompressing the whole shard")
+            self.whole, frames = scan_frames(self.stream, self.codec)
+            try:
+                save_frames(frame_file, frames)
+            except OSError as exn:
+                if verbose:
+                    print("Could not save frame table to", frame_file, exn)
+        elif len(self.frames) == 2:
+            # a single frame (e.g. made by `tar czf`): not seekable, keep it decompressed
+            self.whole = decompress_frame(os.pread(self.stream.fileno(), st.st_size, 0), self.codec)
+
+        if callable(index_file):
+            index_file = index_file(self.fname)
+        self.index = TarIndex.load(index_file, st) if index_file is not None else None
+        sidecar = find_mmindex_file(self.fname) if self.fname is not None else None
+        if self.index is None and sidecar is not None and sidecar != index_file:
+            # the index written by compress_tar next to the shard
+            self.index = TarIndex.load(sidecar, st)
+        if self.index is None:
+            buf = self.whole if self.whole is not None else scan_frames(self.stream, self.codec)[0]
+            self.index = TarIndex.build(buf)
+            if index_file is not None:
+                try:
+                    os.makedirs(os.path.dirname(os.path.abspath(index_file)), exist_ok=True)
+                    self.index.save(index_file, st)
+                except OSError as exn:
+                    if verbose:
+                        print("Could not save tar index to", index_file, exn)
+
+    def close(self, dispose=False):
+        self.index = None
+        self.whole = None
+        self.stream.close()
+
+    def _frame(self, k):
+        def _load():
+            start, end = int(self.frames[k, 1]), int(self.frames[k + 1, 1])
+            return decompress_frame(os.pread(self.stream.fileno(), end - start, start), self.codec)
+
+        return self.frame_cache.get(self.cache_key + (k,), _load)
+
+    def read(self, start, size):
+        """Read `size` uncompressed bytes at uncompressed offset `start`."""
+        if self.whole is not None:
+            return self.whole[start : start + size]
+        end = start + size
+        first = int(np.searchsorted(self.frames[:, 0], start, side="right")) - 1
+        parts = []
+        k = first
+        while start < end:
+            frame_start = int(self.frames[k, 0])
+            data = self._frame(k)
+            parts.append(data[start - frame_start : end - frame_start])
+            start = frame_start + len(data)
+            k += 1
+        return parts[0] if len(parts) == 1 else b"".join(parts)
+
+    def advise(self, advice, start=0, length=None):
+        return 0
+
+    def willneed(self, indices):
+        return 0
+
+    def dontneed(self):
+        pass
+
+    def names(self):
+        return self.index.names()
+
+    def sample_groups(self):
+        return self.index.sample_groups()
+
+    def get_at_index(self, index):
+        offset = int(self.index.offsets[index])
+        size = int(self.index.sizes[index])
+        return self.index.name(index), self.read(offset + 512, size)
+
+    def get_buffer(self, index):
+        name, data = self.get_at_index(index)
+        return name, memoryview(data)
+
+    def get_by_name(self, name):
+        index = self.index.find(name)
+        if index < 0:
+            raise KeyError(name)
+        return self.get_at_index(index)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.get_at_index(i)
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            return self.get_at_index(key)
+        else:
+            return self.get_by_name(key)
+
+    def __len__(self):
+        return len(self.index)
+
+    def get_file(self, i):
+        fname, data = self.get_at_index(i)
+        return fname, io.BytesIO(data)
+
+
+if __name__ == "__main__":
+    from kn_util.utils.multiproc import map_async_with_thread
+
+    parser = argparse.ArgumentParser(description="convert tar shards to seekable compressed shards")
+    parser.add_argument("files", nargs="+", help="plain .tar shards")
+    parser.add_argument("--codec", default="gz", choices=["gz", "zst"])
+    parser.add_argument("--frame-size", type=float, default=1 << 22, help="uncompressed bytes per frame")
+    parser.add_argument("--level", type=int, default=None)
+    parser.add_argument("--index-cache", default=None, help="directory of the tar indices (next to the shards by default)")
+    parser.add_argument("--num-threads", type=int, default=8)
+    args = parser.parse_args()
+    index_file = partial(find_mmindex_file, index_cache=args.index_cache)
+
+    outputs = map_async_with_thread(
+        iterable=args.files,
+        func=lambda f: compress_tar(
+            f, codec=args.codec, frame_size=int(args.frame_size), level=args.level, index_file=index_file
+        ),
+        num_thread=args.num_threads,
+        desc="Compressing shards",
+    )
+    for src, dst in zip(args.files, outputs):
+        print(f"{src} ({os.path.getsize(src)} bytes) -> {dst} ({os.path.getsize(dst)} bytes)")
@@ -0,0 +1,84 @@
+import io
+import os.path as osp
+import tarfile
+
+import numpy as np
+import pytest
+
+# manual scripts that need a dataset on disk or a distributed launch
+collect_ignore = ["test_ddp.py", "test_wids.py"]
+
+
+def write_shard(path, samples):
+    """Write a webdataset tar shard; samples are dicts of {"__key__": key, ext: bytes}."""
+    with tarfile.open(path, "w", format=tarfile.GNU_FORMAT) as tar:
+        for sample in samples:
+            key = sample["__key__"]
+            for ext, data in sample.items():
+                if ext == "__key__":
+                    continue
+                info = tarfile.TarInfo(f"{key}.{ext}")
+                info.size = len(data)
+                tar.addfile(info, io.BytesIO(data))
+    return path
+
+
+def npy_bytes(array):
+    stream = io.BytesIO()
+    np.save(stream, array)
+    return stream.getvalue()
+
+
+def make_samples(shard_idx, nsamples):
+    samples = []
+    for i in range(nsamples):
+        key = f"s{shard_idx:03d}_{i:04d}"
+        samples.append(
+            {
+                "__key__": key,
+                "txt": key.encode(),
+                "cls": str(shard_idx * 1000 + i).encode(),
+                "npy": npy_bytes(np.full((4, 3), i, dtype=np.float32)),
+                "mp4": bytes([i % 256]) * (100 + i),
+            }
+        )
+    return samples
+
+
+@pytest.fixture
+def make_shards(tmp_path):
+    """Factory writing `num_shards` synthetic shards of `nsamples` samples into tmp_path."""
+
+    def _make(num_shards=3, nsamples=10, prefix="shard"):
+        return [
+            write_shard(osp.join(tmp_path, f"{prefix}-{i:06d}.tar"), make_samples(i, nsamples))
+            for i in range(num_shards)
+        ]
+
+    return _make
+
+
+def write_video(path, num_frames=120, width=64, height=48, fps=30, gop=30):
+    """Write an h264 mp4 whose frames differ in brightness, with a keyframe every `gop` frames."""
+    import av
+
+    with av.open(path, "w") as container:
+        stream = container.add_stream("libx264", rate=fps)
+        stream.width, stream.height = width, height
+        stream.pix_fmt = "yuv420p"
+        stream.codec_context.gop_size = gop
+        stream.codec_context.options = {"keyint_min": str(gop), "sc_threshold": "0", "bf": "0"}
+        for i in range(num_frames):
+            image = np.full((height, width, 3), (i * 2) % 256, dtype=np.uint8)
+            image[: height // 2, : width // 2] = (i * 7) % 256
+            for packet in stream.encode(av.VideoFrame.from_ndarray(image, format="rgb24")):
+                container.mux(packet)
+        for packet in stream.encode():
+            container.mux(packet)
+    return path
+
+
+@pytest.fixture(scope="session")
+def video_file(tmp_path_factory):
+    """A 120-frame, 30 fps video with keyframes at 0, 30, 60, 90."""
+    return write_video(str(tmp_path_factory.mktemp("video") / "video.mp4"))
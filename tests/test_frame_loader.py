@@ -0,0 +1,36 @@
+from concurrent.futures import Future
+
+import numpy as np
+import pytest
+
+from kn_util.data.video import VideoDecodePool
+
+# kn_util.data.processor imports its text processors (torchtext) as well
+frame_loader = pytest.importorskip("kn_util.data.processor.video.load")
+
+
+def test_submit_matches_direct_decode(video_file, tmp_path):
+    loader = frame_loader.DecordFrameLoader(stride=30, width=32, height=24, to_array=True, to_images=True)
+    expected = loader(video_file)
+    assert expected["array"].shape == (4, 24, 32, 3)
+    with VideoDecodePool(num_workers=2) as pool:
+        loader.decode_pool = pool
+        future = loader.submit(video_file)
+        missing = loader.submit(str(tmp_path / "missing.mp4"))
+        assert type(future) is Future
+        result = future.result()
+        np.testing.assert_array_equal(result["array"], expected["array"])
+        assert [image.size for image in result["images"]] == [(32, 24)] * 4
+        with pytest.raises(Exception):
+            missing.result()
+
+
+def test_call_with_decode_pool(video_file):
+    kwargs = dict(stride=10, width=32, height=24, to_array=True)
+    expected = frame_loader.DecordFrameLoader(**kwargs)(video_file)
+    with VideoDecodePool(num_workers=2) as pool:
+        loader = frame_loader.DecordFrameLoader(decode_pool=pool, **kwargs)
+        result = loader(video_file)
+        assert pool.get_stats()["completed"] == 1
+    assert list(result) == ["array"]
+    np.testing.assert_array_equal(result["array"], expected["array"])
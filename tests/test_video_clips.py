@@ -0,0 +1,29 @@
+import numpy as np
+import pytest
+
+from kn_util.data.video import read_clips, read_frames_decord
+
+
+def test_whole_video_clip_matches_read_frames_decord(video_file):
+    (clip,) = read_clips(video_file, [(None, None, 12)])
+    np.testing.assert_array_equal(np.asarray(clip), np.asarray(read_frames_decord(video_file, num_frames=12)))
+
+
+@pytest.mark.parametrize("keyframe_snap", [None, 4])
+def test_clips_match_read_frames_decord(video_file, keyframe_snap):
+    clips = [(0.0, 1.0, 8), (0.5, 2.0, 16), {"start": 3.0, "fps": 5}]
+    outputs, meta = read_clips(video_file, clips, keyframe_snap=keyframe_snap, return_meta=True)
+    assert len(outputs) == len(clips)
+    for frames, clip_meta in zip(outputs, meta["clips"]):
+        assert clip_meta["frame_indices"].max() < meta["vlen"]
+        expected = read_frames_decord(video_file, frame_indices=clip_meta["frame_indices"].tolist())
+        np.testing.assert_array_equal(np.asarray(frames), np.asarray(expected))
+    # frames shared by the overlapping clips are decoded once
+    all_indices = np.concatenate([clip_meta["frame_indices"] for clip_meta in meta["clips"]])
+    assert meta["unique_frames"] == len(np.unique(all_indices))
+
+
+def test_clips_reuse_a_reader(video_file):
+    first, reader = read_clips(video_file, [(0.0, 1.0, 4)], return_reader=True)
+    second = read_clips(video_file, [(0.0, 1.0, 4)], video_reader=reader)
+    np.testing.assert_array_equal(np.asarray(first[0]), np.asarray(second[0]))
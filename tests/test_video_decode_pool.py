@@ -0,0 +1,37 @@
+import numpy as np
+import pytest
+
+from kn_util.data.video import VideoDecodePool, read_frames_decord
+
+
+def fail_on(item):
+    if item == 3:
+        raise ValueError("bad video 3")
+    return item * 2
+
+
+def test_errors_reach_the_future():
+    with VideoDecodePool(num_workers=2) as pool:
+        futures = [pool.submit(fail_on, i) for i in range(6)]
+        with pytest.raises(ValueError, match="bad video 3"):
+            futures[3].result()
+        assert [futures[i].result() for i in [0, 1, 2, 4, 5]] == [0, 2, 4, 8, 10]
+        stats = pool.get_stats()
+    assert stats["completed"] == 5 and stats["failed"] == 1 and stats["pending"] == 0
+
+
+def test_map_keeps_order_and_raises():
+    with VideoDecodePool(num_workers=2, max_pending=2) as pool:
+        assert list(pool.map(fail_on, [0, 1, 2])) == [0, 2, 4]
+        with pytest.raises(ValueError):
+            list(pool.map(fail_on, range(6)))
+
+
+def test_pool_reads_match_direct_reads(video_file, tmp_path):
+    with VideoDecodePool(num_workers=2) as pool:
+        future = read_frames_decord(video_file, num_frames=8, decode_pool=pool)
+        missing = pool.read_frames(str(tmp_path / "missing.mp4"), num_frames=8)
+        expected = read_frames_decord(video_file, num_frames=8)
+        np.testing.assert_array_equal(np.asarray(future.result()), np.asarray(expected))
+        with pytest.raises(Exception):
+            missing.result()
@@ -0,0 +1,43 @@
+import numpy as np
+import pytest
+import torch
+
+from kn_util.data.video import frames_to_shared, read_frames_decord
+
+
+@pytest.mark.parametrize("output_format", ["tchw", "cthw", "thwc"])
+def test_frames_to_shared_layout_and_index(output_format):
+    frames = np.arange(4 * 3 * 2 * 3, dtype=np.uint8).reshape(4, 3, 2, 3)
+    out = frames_to_shared(frames, output_format, index=np.array([2, 2, 0]))
+    assert out.is_shared()
+    expected = frames[[2, 2, 0]].transpose(["thwc".index(d) for d in output_format])
+    np.testing.assert_array_equal(out.numpy(), expected)
+
+
+def test_buffers_are_not_reused():
+    frames = np.zeros((2, 3, 2, 3), dtype=np.uint8)
+    first = frames_to_shared(frames, "thwc")
+    outputs = [frames_to_shared(frames + i, "thwc") for i in range(1, 20)]
+    assert (first == 0).all()
+    assert len({out.untyped_storage().data_ptr() for out in outputs + [first]}) == 20
+
+
+class ClipDataset(torch.utils.data.Dataset):
+    def __init__(self, video_file):
+        self.video_file = video_file
+
+    def __len__(self):
+        return 24
+
+    def __getitem__(self, index):
+        frame_indices = [index * 4 + k for k in range(4)]
+        return read_frames_decord(self.video_file, frame_indices=frame_indices, output_buffer=True)
+
+
+def test_shared_clips_survive_deep_prefetch(video_file):
+    # unbatched samples reach the consumer as the worker's own tensors, none may be overwritten
+    loader = torch.utils.data.DataLoader(ClipDataset(video_file), batch_size=None, num_workers=1, prefetch_factor=8)
+    received = list(loader)
+    for index, clip in enumerate(received):
+        expected = read_frames_decord(video_file, frame_indices=[index * 4 + k for k in range(4)])
+        np.testing.assert_array_equal(clip.numpy(), np.asarray(expected))
@@ -0,0 +1,56 @@
+import numpy as np
+from kn_util.data.video import load, read_clips, read_frames_decord, snap_frame_indices
+
+
+def test_snap_stays_below_vlen():
+    assert snap_frame_indices([7, 8], [0, 9], 2, vlen=10) == [9, 9]
+    assert max(snap_frame_indices(list(range(90, 100)), [0, 50], 5, vlen=100)) <= 99
+
+
+def test_snap_repeats_when_targets_do_not_fit():
+    # more targets than frames (as get_frame_indices yields when num_frames > vlen)
+    targets = np.linspace(0, 9, 25).round().astype(int).tolist()
+    snapped = snap_frame_indices(targets, [0, 5], 3, vlen=10)
+    assert len(snapped) == len(targets)
+    assert all(0 <= s <= 9 and abs(s - t) <= 3 for s, t in zip(snapped, targets))
+    assert snapped == sorted(snapped)
+
+
+def test_snap_duplicates_and_input_order():
+    snapped = snap_frame_indices([3, 1, 1, 8], [0, 4, 8], 1, vlen=10)
+    assert snapped[1] == snapped[2]
+    assert snapped == [4, 0, 0, 8]
+    # distinct targets with room to spare stay distinct and within tolerance
+    targets = list(range(0, 100, 7))
+    snapped = snap_frame_indices(targets, [0, 30, 60, 90], 3, vlen=100)
+    assert len(set(snapped)) == len(targets)
+    assert all(abs(s - t) <= 3 for s, t in zip(snapped, targets))
+
+
+def test_read_more_frames_than_the_video_has(video_file):
+    frames = read_frames_decord(video_file, num_frames=400, keyframe_snap=5)
+    assert frames.shape[0] == 400
+
+
+def test_keyframe_snap_reads_requested_count(video_file):
+    frames, meta = read_frames_decord(video_file, num_frames=16, keyframe_snap=4, return_meta=True)
+    assert frames.shape[0] == 16
+    assert meta["decoded_frames"] <= 120
+
+
+def test_keyframes_only_read_when_needed(video_file, monkeypatch):
+    calls = []
+    get_key_indices = load.get_key_indices
+
+    def counting(video_reader, key=None):
+        calls.append(key)
+        return get_key_indices(video_reader, key=key)
+
+    monkeypatch.setattr(load, "get_key_indices", counting)
+    read_frames_decord(video_file, num_frames=4)
+    read_clips(video_file, [(0.0, 1.0, 4), (2.0, 3.0, 4)])
+    assert calls == []
+    read_frames_decord(video_file, num_frames=4, keyframe_snap=2)
+    read_frames_decord(video_file, num_frames=4, return_meta=True)
+    read_clips(video_file, [(0.0, 1.0, 4)], return_meta=True)
+    assert len(calls) == 3
@@ -0,0 +1,61 @@
+import shutil
+
+from kn_util.data.video import load
+from kn_util.data.video.load import VideoMetaCache, probe_meta_av, probe_meta_cached, read_frames_decord, video_cache_key
+
+
+def test_probe_meta_av(video_file):
+    meta = probe_meta_av(video_file)
+    assert (meta["width"], meta["height"]) == (64, 48)
+    assert meta["fps"] == 30
+    assert meta["num_frames"] == 120
+    assert abs(meta["duration"] - 4) < 0.1
+    with open(video_file, "rb") as f:
+        assert probe_meta_av(f) == meta
+        assert f.tell() == 0
+
+
+def test_meta_cache_env_read_at_construction(monkeypatch):
+    monkeypatch.setenv("KN_VIDEO_META_CACHE", "2")
+    cache = VideoMetaCache()
+    assert cache.max_entries == 2
+    for i in range(3):
+        cache.update(i, {"i": i})
+    assert list(cache.entries) == [1, 2]
+    assert VideoMetaCache(max_entries=5).max_entries == 5
+
+
+def counting_probe(monkeypatch):
+    calls = []
+
+    def probe(video_path):
+        calls.append(video_path)
+        return probe_meta_av(video_path)
+
+    monkeypatch.setattr(load, "probe_meta_av", probe)
+    monkeypatch.setattr(load, "video_meta_cache", VideoMetaCache())
+    return calls
+
+
+def test_probe_meta_cached(video_file, tmp_path, monkeypatch):
+    calls = counting_probe(monkeypatch)
+    meta = probe_meta_cached(video_file)
+    assert probe_meta_cached(video_file) is meta
+    assert calls == [video_file]
+    assert load.video_meta_cache.hits == 1
+    # a different file (another cache key) is probed again
+    copy = str(tmp_path / "copy.mp4")
+    shutil.copy(video_file, copy)
+    assert video_cache_key(copy) != video_cache_key(video_file)
+    assert probe_meta_cached(copy) == meta
+    assert calls == [video_file, copy]
+
+
+def test_resized_reads_probe_once(video_file, monkeypatch):
+    calls = counting_probe(monkeypatch)
+    frames = read_frames_decord(video_file, num_frames=4, size=24)
+    assert tuple(frames.shape[-2:]) == (24, 32)
+    assert calls == [video_file]
+    frames = read_frames_decord(video_file, num_frames=4, size=24)
+    assert tuple(frames.shape[-2:]) == (24, 32)
+    assert calls == [video_file]
@@ -0,0 +1,43 @@
+import json
+import os.path as osp
+import pickle
+
+from kn_util.data.wids.wids_anno import AnnotationStore
+
+
+def write_jsonl(path, rows):
+    with open(path, "w") as f:
+        for row in rows:
+            f.write(json.dumps(row) + "\n")
+    return path
+
+
+def make_jsonl_files(root, num_files=3, rows_per_file=5):
+    return [
+        write_jsonl(
+            osp.join(root, f"anno-{i}.jsonl"),
+            [{"key": f"s{i:03d}_{j:04d}", "caption": "é" * j, "score": j} for j in range(rows_per_file)],
+        )
+        for i in range(num_files)
+    ]
+
+
+def test_annotation_store_rows(tmp_path):
+    files = make_jsonl_files(str(tmp_path))
+    store = AnnotationStore(files, cache_dir=str(tmp_path / "cache"))
+    assert len(store) == 15
+    assert store.counts().tolist() == [5, 5, 5]
+    assert store[7] == {"key": "s001_0002", "caption": "éé", "score": 2}
+    assert store.locate(14) == (2, 4)
+
+
+def test_annotation_store_filter_and_cache(tmp_path):
+    files = make_jsonl_files(str(tmp_path))
+    kwargs = dict(cache_dir=str(tmp_path / "cache"), sample_filter=lambda row: row["score"] % 2 == 0, filter_hash="even")
+    store = AnnotationStore(files, **kwargs)
+    assert [row["score"] for row in (store[i] for i in range(len(store)))] == [0, 2, 4] * 3
+    # reloaded from the cache, and usable after pickling (DataLoader workers)
+    cached = pickle.loads(pickle.dumps(AnnotationStore(files, **kwargs)))
+    assert [cached[i] for i in range(len(cached))] == [store[i] for i in range(len(store))]
+    # a different filter does not reuse the index
+    assert len(AnnotationStore(files, cache_dir=str(tmp_path / "cache"))) == 15
@@ -0,0 +1,24 @@
+import os
+import tempfile
+
+import pytest
+
+from kn_util.data.wids.wids_bench import bench_config, make_synthetic_shards
+
+
+@pytest.mark.parametrize("reader", ["mmap", "tarfile"])
+def test_bench_config_without_index_cache(tmp_path, monkeypatch, reader):
+    monkeypatch.setattr(tempfile, "tempdir", str(tmp_path))
+    files = make_synthetic_shards(str(tmp_path / "shards"), num_shards=2, samples_per_shard=10, blobs={"npy": 500})
+    metrics = bench_config(
+        files, lru_size=2, reader=reader, sampler="ChunkedSampler", num_workers=0, batch_size=4, index_cache=None
+    )
+    assert metrics["samples"] == 20
+    assert metrics["cache_misses"] >= 2
+    # the temporary index is removed after the run
+    assert sorted(os.listdir(tmp_path)) == ["shards"]
+
+
+def test_bench_config_rejects_unknown_reader(tmp_path):
+    with pytest.raises(ValueError, match="Unknown reader"):
+        bench_config([], lru_size=2, reader="stream", sampler="ChunkedSampler", num_workers=0, index_cache=None)
@@ -0,0 +1,113 @@
+import os
+
+import numpy as np
+
+from kn_util.data.wids import ShardListDataset, wids_cache
+from kn_util.data.wids.wids import default_localname
+from kn_util.data.wids.wids_cache import SharedShardCache
+
+
+def file_urls(shards):
+    return ["file://" + os.path.abspath(f) for f in shards]
+
+
+def cached_files(cache_dir):
+    return sorted(f for f in os.listdir(cache_dir) if f.startswith("file"))
+
+
+def test_dataset_downloads_remote_shards_into_cache(make_shards, tmp_path):
+    shards = make_shards(3, 5)
+    cache_dir = str(tmp_path / "cache")
+    index_cache = str(tmp_path / "index")
+    dataset = ShardListDataset(file_urls(shards), index_cache=index_cache, cache_dir=cache_dir)
+    reference = ShardListDataset(shards, index_cache=index_cache, localname=lambda url: url)
+    assert len(dataset) == len(reference) == 15
+    for _ in range(2):
+        for i in range(len(dataset)):
+            a, b = dataset[i], reference[i]
+            assert a[".txt"] == b[".txt"]
+            np.testing.assert_array_equal(a[".npy"], b[".npy"])
+    opens, downloads, evictions = dataset.cache.shared_cache.get_stats()
+    # every shard was downloaded once (to scan its keys) and reused when reading
+    assert downloads == 3
+    assert opens == 6
+    assert evictions == 0
+    assert len(cached_files(cache_dir)) == 3
+
+
+def test_open_retries_shard_evicted_before_lock(make_shards, tmp_path, monkeypatch):
+    (shard,) = make_shards(1, 3)
+    url = file_urls([shard])[0]
+    cache = SharedShardCache(str(tmp_path / "cache"))
+    local = default_localname(cache.cache_dir)(url)
+    download_and_open = wids_cache.download_and_open
+    calls = []
+
+    def evicted_once(url, local, **kwargs):
+        stream = download_and_open(url, local, **kwargs)
+        calls.append(local)
+        if len(calls) == 1:
+            # another process evicts the shard before the lock is taken
+            os.unlink(local)
+        return stream
+
+    monkeypatch.setattr(wids_cache, "download_and_open", evicted_once)
+    stream = cache.open(url, local)
+    assert calls == [local, local]
+    assert os.fstat(stream.fileno()).st_nlink == 1
+    assert stream.read() == open(shard, "rb").read()
+    stream.close()
+    assert cache.get_stats() == (1, 1, 0)
+
+
+def test_byte_budget(make_shards, tmp_path):
+    shards = make_shards(4, 5)
+    size = os.path.getsize(shards[0])
+    cache = SharedShardCache(str(tmp_path / "cache"), max_bytes=2 * size)
+    localname = default_localname(cache.cache_dir)
+    for url in file_urls(shards):
+        cache.open(url, localname(url)).close()
+    # the two least recently used shards were evicted
+    assert cache.get_stats() == (4, 4, 2)
+    assert cached_files(cache.cache_dir) == sorted(os.path.basename(localname(url)) for url in file_urls(shards)[2:])
+
+
+def test_eviction_skips_locked_readers(make_shards, tmp_path):
+    shards = make_shards(4, 5)
+    urls = file_urls(shards)
+    size = os.path.getsize(shards[0])
+    cache = SharedShardCache(str(tmp_path / "cache"), max_bytes=2 * size)
+    localname = default_localname(cache.cache_dir)
+    # the least recently used shard is still being read
+    reader = cache.open(urls[0], localname(urls[0]))
+    for url in urls[1:]:
+        cache.open(url, localname(url)).close()
+    assert os.path.exists(localname(urls[0]))
+    assert not os.path.exists(localname(urls[1]))
+    reader.close()
+    cache.evict()
+    assert not os.path.exists(localname(urls[0]))
+    assert len(cached_files(cache.cache_dir)) == 2
+
+
+def test_dataset_keeps_cached_shards_locked(make_shards, tmp_path):
+    shards = make_shards(3, 5)
+    size = os.path.getsize(shards[0])
+    dataset = ShardListDataset(
+        file_urls(shards),
+        index_cache=str(tmp_path / "index"),
+        cache_dir=str(tmp_path / "cache"),
+        cache_size=2 * size - 1,
+        lru_size=1,
+    )
+    cache = dataset.cache.shared_cache
+    local = dataset.cache.localname(dataset.shards[0]["url"])
+    dataset[0]
+    # the shard held by the LRU cache is not evicted when another one comes in over budget
+    other = dataset.shards[1]["url"]
+    cache.open(other, dataset.cache.localname(other)).close()
+    assert os.path.exists(local)
+    # once it leaves the LRU cache, it can be
+    dataset[len(dataset) - 1]
+    cache.evict()
+    assert not os.path.exists(local)
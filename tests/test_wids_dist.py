@@ -0,0 +1,77 @@
+"""Collective code paths run in two gloo processes, with node-local (per-rank) cache dirs."""
+
+import json
+import multiprocessing as mp
+import os
+import os.path as osp
+import traceback
+
+import pytest
+import torch.distributed as torch_dist
+
+from kn_util.data.wids.wids_anno import AnnotationStore
+from kn_util.data.wids.wids_utils import get_tarfile_index
+from test_wids_anno import make_jsonl_files
+
+WORLD_SIZE = 2
+
+
+def _worker(rank, init_file, fn, args, errors):
+    try:
+        torch_dist.init_process_group("gloo", init_method=f"file://{init_file}", rank=rank, world_size=WORLD_SIZE)
+        fn(rank, *args)
+        torch_dist.destroy_process_group()
+    except Exception:
+        errors.put(traceback.format_exc())
+
+
+def run_distributed(tmp_path, fn, *args, timeout=120):
+    ctx = mp.get_context("fork")
+    errors = ctx.Queue()
+    init_file = osp.join(tmp_path, "dist_init")
+    procs = [ctx.Process(target=_worker, args=(rank, init_file, fn, args, errors)) for rank in range(WORLD_SIZE)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join(timeout)
+    hung = [proc for proc in procs if proc.is_alive()]
+    for proc in hung:
+        proc.kill()
+    assert not hung, "deadlock: a rank did not finish"
+    if not errors.empty():
+        pytest.fail(errors.get())
+    assert all(proc.exitcode == 0 for proc in procs)
+
+
+def _tarfile_index(rank, shards, cache_root, out_root):
+    index = get_tarfile_index(shards, cache_dir=osp.join(cache_root, f"node{rank}"))
+    with open(osp.join(out_root, f"rank{rank}.txt"), "w") as f:
+        f.write(" ".join(map(str, index.lengths.tolist())))
+
+
+def test_tarfile_index_cache_hit_on_one_node_only(make_shards, tmp_path):
+    shards = make_shards(3, 4)
+    cache_root = str(tmp_path / "cache")
+    # only node 0 has the index cached
+    get_tarfile_index(shards, cache_dir=osp.join(cache_root, "node0"))
+    run_distributed(tmp_path, _tarfile_index, shards, cache_root, str(tmp_path))
+    for rank in range(WORLD_SIZE):
+        with open(osp.join(tmp_path, f"rank{rank}.txt")) as f:
+            assert f.read() == "4 4 4"
+    assert os.path.exists(osp.join(cache_root, "node1"))
+
+
+def _annotation_store(rank, files, cache_root, out_root):
+    store = AnnotationStore(files, cache_dir=osp.join(cache_root, f"node{rank}"))
+    with open(osp.join(out_root, f"rank{rank}.json"), "w") as f:
+        json.dump([store[i] for i in range(len(store))], f)
+
+
+def test_annotation_store_cache_hit_on_one_node_only(tmp_path):
+    files = make_jsonl_files(str(tmp_path))
+    cache_root = str(tmp_path / "cache")
+    expected = [AnnotationStore(files, cache_dir=osp.join(cache_root, "node0"))[i] for i in range(15)]
+    run_distributed(tmp_path, _annotation_store, files, cache_root, str(tmp_path))
+    for rank in range(WORLD_SIZE):
+        with open(osp.join(tmp_path, f"rank{rank}.json")) as f:
+            assert json.load(f) == expected
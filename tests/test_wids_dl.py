@@ -0,0 +1,131 @@
+import hashlib
+import http.server
+import os
+import threading
+
+import httpx
+import pytest
+
+from kn_util.data.wids import wids_dl
+
+
+@pytest.fixture
+def checksum_calls(monkeypatch):
+    calls = []
+    file_checksum = wids_dl.file_checksum
+
+    def counting(local, remote=None):
+        calls.append(local)
+        return file_checksum(local, remote=remote)
+
+    monkeypatch.setattr(wids_dl, "file_checksum", counting)
+    return calls
+
+
+def test_download_without_md5_skips_checksum(tmp_path, checksum_calls):
+    remote = tmp_path / "remote.tar"
+    remote.write_bytes(b"x" * 1000)
+    local = str(tmp_path / "cache" / "local.tar")
+    (tmp_path / "cache").mkdir()
+    wids_dl.download_file_no_log(str(remote), local, filesize=1000)
+    assert open(local, "rb").read() == b"x" * 1000
+    assert checksum_calls == []
+
+
+def test_download_with_md5_is_verified(tmp_path, checksum_calls):
+    data = b"y" * 1000
+    remote = tmp_path / "remote.tar"
+    remote.write_bytes(data)
+    (tmp_path / "cache").mkdir()
+    local = str(tmp_path / "cache" / "local.tar")
+    wids_dl.download_file_no_log(str(remote), local, md5sum=hashlib.md5(data).hexdigest())
+    assert checksum_calls == [local]
+    # validating the cached copy again reads the recorded checksum
+    wids_dl.verify_file(local, md5sum=hashlib.md5(data).hexdigest())
+
+    bad = str(tmp_path / "cache" / "bad.tar")
+    with pytest.raises(ValueError):
+        wids_dl.download_file_no_log(str(remote), bad, md5sum="0" * 32)
+    assert not (tmp_path / "cache" / "bad.tar").exists()
+
+
+class RangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves DATA at /data (honouring a single `bytes=N-` range unless server.ranges is False)."""
+
+    def do_GET(self):
+        server = self.server
+        server.requests.append(self.headers.get("Range"))
+        if self.path != "/data":
+            self.send_error(404)
+            return
+        data = server.data
+        byte_range = self.headers.get("Range")
+        if byte_range and server.ranges:
+            start = int(byte_range[len("bytes=") : -1])
+            if start >= len(data):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", f"bytes {start}-{len(data) - 1}/{len(data)}")
+            data = data[start:]
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), RangeHandler)
+    server.data = bytes(range(256)) * 1000
+    server.ranges = True
+    server.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def url(server, path="/data"):
+    return f"http://127.0.0.1:{server.server_address[1]}{path}"
+
+
+def test_http_download(http_server, tmp_path):
+    local = str(tmp_path / "local.tar")
+    wids_dl.download_file_no_log(url(http_server), local, filesize=len(http_server.data))
+    assert open(local, "rb").read() == http_server.data
+    assert http_server.requests == [None]
+
+
+def test_http_download_error_raises(http_server, tmp_path):
+    local = str(tmp_path / "local.tar")
+    with pytest.raises(httpx.HTTPStatusError):
+        wids_dl.download_file_no_log(url(http_server, "/missing"), local)
+    assert not os.path.exists(local)
+
+
+@pytest.mark.parametrize("ranges", [True, False])
+def test_http_download_resumes_temp_file(http_server, tmp_path, ranges):
+    http_server.ranges = ranges
+    local = str(tmp_path / "local.tar")
+    # left behind by an interrupted download
+    with open(local + ".temp", "wb") as f:
+        f.write(http_server.data[:1000])
+    wids_dl.download_file_no_log(url(http_server), local)
+    assert open(local, "rb").read() == http_server.data
+    assert http_server.requests == ["bytes=1000-"]
+    assert not os.path.exists(local + ".temp")
+
+
+def test_http_download_restarts_oversized_temp_file(http_server, tmp_path):
+    local = str(tmp_path / "local.tar")
+    with open(local + ".temp", "wb") as f:
+        f.write(b"z" * (len(http_server.data) + 10))
+    wids_dl.download_file_no_log(url(http_server), local)
+    assert open(local, "rb").read() == http_server.data
+    assert http_server.requests == [f"bytes={len(http_server.data) + 10}-", None]
@@ -0,0 +1,139 @@
+import argparse
+import json
+import os
+import tarfile
+
+import pytest
+
+from kn_util.data.wids import wids_index
+from kn_util.data.wids.wids_index import main_validate, repair_shard, validate_shard
+
+from conftest import make_samples, write_shard
+
+
+def names(path):
+    with tarfile.open(path) as tar:
+        return [m.name for m in tar.getmembers()]
+
+
+def member_offsets(path):
+    with tarfile.open(path) as tar:
+        return {m.name: (m.offset, m.size) for m in tar.getmembers()}
+
+
+def test_validate_clean_shard(make_shards):
+    (shard,) = make_shards(1, 5)
+    result = validate_shard(shard)
+    assert result["errors"] == [] and result["duplicates"] == []
+    assert result["nsamples"] == 5
+    assert result["md5sum"] is not None
+
+
+def test_truncated_shard(make_shards):
+    (shard,) = make_shards(1, 5)
+    before = names(shard)
+    # cut inside the payload of the first member of the last sample
+    offset, size = member_offsets(shard)["s000_0004.txt"]
+    with open(shard, "r+b") as f:
+        f.truncate(offset + 512 + size - 2)
+    assert validate_shard(shard)["errors"]
+    original = os.path.getsize(shard)
+
+    members, nbytes = repair_shard(shard)
+    # only the truncated member of the last sample is left in the file
+    assert members == 1
+    assert nbytes == size
+    assert os.path.getsize(shard + ".bak") == original
+    assert names(shard) == [name for name in before if not name.startswith("s000_0004")]
+    result = validate_shard(shard)
+    assert result["errors"] == [] and result["nsamples"] == 4
+
+
+def test_duplicate_key_shard(tmp_path):
+    samples = make_samples(0, 4)
+    shard = write_shard(str(tmp_path / "dup.tar"), samples + [samples[1]])
+    result = validate_shard(shard)
+    assert len(result["duplicates"]) == 4
+    assert result["errors"] == []
+
+    members, nbytes = repair_shard(shard, backup=False)
+    assert members == 4
+    assert nbytes == sum(len(v) for k, v in samples[1].items() if k != "__key__")
+    assert not os.path.exists(shard + ".bak")
+    assert names(shard) == names(write_shard(str(tmp_path / "ref.tar"), samples))
+    assert validate_shard(shard)["duplicates"] == []
+
+
+@pytest.mark.parametrize("member", ["s000_0003.txt", "s000_0003.cls"])
+def test_corrupt_header(make_shards, member):
+    (shard,) = make_shards(1, 5)
+    before = member_offsets(shard)
+    offset, size = before[member]
+    with open(shard, "r+b") as f:
+        f.seek(offset)
+        f.write(b"\xff" * 100)
+    assert validate_shard(shard)["errors"]
+
+    members, nbytes = repair_shard(shard)
+    # samples 0-2 are complete and kept, sample 3 (hit by the corrupt header) and 4 are dropped
+    kept = [name for name in before if name < "s000_0003"]
+    assert names(shard) == kept
+    assert members == len(before) - len(kept)
+    dropped = [name for name in before if name not in kept and name != member]
+    assert nbytes == sum(before[name][1] for name in dropped) + 512 + (size + 511) // 512 * 512
+    result = validate_shard(shard)
+    assert result["errors"] == []
+    assert result["nsamples"] == 3
+
+
+def validate_args(files, output, **kwargs):
+    args = dict(files=files, output=output, name=None, base=None, workers=2, no_md5=False, force=False)
+    args.update(repair=False, no_backup=False)
+    args.update(kwargs)
+    return argparse.Namespace(**args)
+
+
+def test_main_validate_skips_unchanged_shards(make_shards, tmp_path, monkeypatch):
+    monkeypatch.setenv("DISABLE_PARALLEL", "1")
+    shards = make_shards(3, 4)
+    output = str(tmp_path / "shardindex.json")
+    assert main_validate(validate_args(shards, output)) == 0
+    with open(output) as f:
+        index = json.load(f)
+    assert [shard["nsamples"] for shard in index["shardlist"]] == [4, 4, 4]
+
+    calls = []
+    validate = wids_index.validate_shard
+
+    def counting(path, **kwargs):
+        calls.append(path)
+        return validate(path, **kwargs)
+
+    monkeypatch.setattr(wids_index, "validate_shard", counting)
+    assert main_validate(validate_args(shards, output)) == 0
+    assert calls == []
+    with open(output) as f:
+        assert json.load(f) == index
+
+    # a rewritten shard is validated again
+    write_shard(shards[1], make_samples(1, 6))
+    assert main_validate(validate_args(shards, output)) == 0
+    assert calls == [shards[1]]
+    with open(output) as f:
+        assert [shard["nsamples"] for shard in json.load(f)["shardlist"]] == [4, 6, 4]
+
+    assert main_validate(validate_args(shards, output, force=True)) == 0
+    assert calls == [shards[1]] + shards
+
+
+def test_main_validate_repairs(make_shards, tmp_path, monkeypatch):
+    monkeypatch.setenv("DISABLE_PARALLEL", "1")
+    shards = make_shards(2, 4)
+    offset, size = member_offsets(shards[0])["s000_0003.npy"]
+    with open(shards[0], "r+b") as f:
+        f.truncate(offset + 100)
+    output = str(tmp_path / "shardindex.json")
+    assert main_validate(validate_args(shards, output)) == 1
+    assert main_validate(validate_args(shards, output, repair=True)) == 0
+    with open(output) as f:
+        assert [shard["nsamples"] for shard in json.load(f)["shardlist"]] == [3, 4]
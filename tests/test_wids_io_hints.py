@@ -0,0 +1,96 @@
+import pytest
+
+from kn_util.data.wids import ShardListDataset
+from kn_util.data.wids.wids_mmtar import MMIndexedTar
+
+from conftest import write_shard
+
+
+@pytest.fixture
+def advice_calls(monkeypatch):
+    calls = []
+    advise = MMIndexedTar.advise
+
+    def recording(self, advice, start=0, length=None):
+        nbytes = advise(self, advice, start, length)
+        calls.append((self.fname, advice, nbytes))
+        return nbytes
+
+    monkeypatch.setattr(MMIndexedTar, "advise", recording)
+    return calls
+
+
+def make_dataset(make_shards, tmp_path, **kwargs):
+    shards = make_shards(3, 6)
+    dataset = ShardListDataset(shards, index_cache=str(tmp_path / "index"), localname=lambda url: url, **kwargs)
+    return shards, dataset
+
+
+def test_mmap_advice(make_shards, tmp_path, advice_calls):
+    shards, dataset = make_dataset(make_shards, tmp_path, mmap_advice="random")
+    reference = ShardListDataset(shards, index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    for i in range(len(dataset)):
+        assert dataset[i][".txt"] == reference[i][".txt"]
+    # the whole mapping of every shard is advised once, when it is opened
+    random = [(fname, nbytes) for fname, advice, nbytes in advice_calls if advice == "random"]
+    assert sorted(fname for fname, nbytes in random) == shards
+    assert all(nbytes > 0 for fname, nbytes in random)
+
+
+def test_willneed(make_shards, tmp_path, advice_calls):
+    shards, dataset = make_dataset(make_shards, tmp_path, willneed=True)
+    batch = dataset.__getitems__([0, 2, 7])
+    assert [sample["__index__"] for sample in batch] == [0, 2, 7]
+    willneed = [(fname, nbytes) for fname, advice, nbytes in advice_calls if advice == "willneed"]
+    # one hint per member of the batch's samples, in the shards they belong to
+    assert sorted(fname for fname, nbytes in willneed) == [shards[0]] * 8 + [shards[1]] * 4
+    assert dataset.get_io_stats()["willneed_bytes"] == sum(nbytes for fname, nbytes in willneed) > 0
+
+    _, plain = make_dataset(make_shards, tmp_path)
+    plain.__getitems__([0, 2, 7])
+    assert plain.get_io_stats()["willneed_bytes"] == 0
+
+
+def test_dontneed_on_lru_eviction(make_shards, tmp_path, advice_calls):
+    shards, dataset = make_dataset(make_shards, tmp_path, lru_size=1)
+
+    def dropped():
+        # (datasets of other tests may be garbage collected meanwhile)
+        return [fname for fname, advice, nbytes in advice_calls if advice == "dontneed" and fname in shards]
+
+    dataset[0]
+    assert dropped() == []
+    dataset[6]
+    dataset[7]
+    assert dropped() == [shards[0]]
+    dataset[12]
+    assert dropped() == shards[:2]
+
+
+def touch(sample):
+    # a decoder that reads every byte of the sample, like the image/array decoders do
+    return {k: bytes(v) if isinstance(v, memoryview) else v for k, v in sample.items()}
+
+
+@pytest.mark.parametrize("zero_copy", [False, True])
+def test_io_stats_count_faults(tmp_path, zero_copy):
+    nsamples, size = 8, 1 << 20
+    samples = [{"__key__": f"s{i:04d}", "bin": bytes([i]) * size} for i in range(nsamples)]
+    shards = [write_shard(str(tmp_path / "big.tar"), samples)]
+    kwargs = dict(index_cache=str(tmp_path / "index"), localname=lambda url: url, zero_copy=zero_copy)
+    dataset = ShardListDataset(shards, transformations=[touch], **kwargs)
+    for i in range(nsamples):
+        dataset[i]
+    assert dataset.get_io_stats() == dict(major_faults=0, minor_faults=0, willneed_bytes=0)
+
+    counted = ShardListDataset(shards, transformations=[touch], count_faults=True, **kwargs)
+    for i in range(nsamples):
+        sample = counted[i]
+        data = sample[".bin"] if zero_copy else sample[".bin"].read()
+        assert data == bytes([i]) * size
+    stats = counted.get_io_stats()
+    # every sample maps at least 1 MB of new pages (the kernel maps up to 64 kB per fault),
+    # with zero_copy these faults are taken by the decoder
+    assert stats["minor_faults"] + stats["major_faults"] >= nsamples * size // (64 << 10)
+    counted.reset_io_stats()
+    assert counted.get_io_stats()["minor_faults"] == 0
@@ -0,0 +1,51 @@
+import numpy as np
+
+from kn_util.data.wids import ShardListDataset
+from kn_util.data.wids import wids_keyindex
+from kn_util.data.wids.wids_keyindex import KeyIndex, hash_keys
+
+from conftest import make_samples, write_shard
+
+
+def test_lookup():
+    index = KeyIndex.build([["a", "b", "c"], ["d", "b"], []])
+    shard_idx, inner_idx = index.lookup(["a", "b", "d", "zz", "c"])
+    assert shard_idx.tolist() == [0, 1, 1, -1, 0]
+    assert inner_idx.tolist() == [0, 1, 0, -1, 2]
+    assert index["c"] == (0, 2)
+    assert "zz" not in index and index.get("zz") is None
+
+
+def test_save_and_load(tmp_path):
+    keys_by_shard = [[f"k{i}_{j}" for j in range(50)] for i in range(4)]
+    index = KeyIndex.load_or_build(str(tmp_path / "keyindex"), lambda: keys_by_shard)
+    assert isinstance(index.hashes, np.memmap)
+    assert index["k3_7"] == (3, 7)
+    assert index.lookup(["k2_49", "é"])[0].tolist() == [2, -1]
+
+
+def test_hash_keys_in_chunks():
+    keys = [f"key-{i}" * (i % 5 + 1) for i in range(1000)]
+    assert np.array_equal(hash_keys(keys, chunk_size=7), hash_keys(keys, chunk_size=1 << 16))
+
+
+def test_lookup_confirms_colliding_keys(monkeypatch):
+    # a hash with many collisions: only the length of the key
+    monkeypatch.setattr(wids_keyindex, "hash_keys", lambda keys: np.array([len(k) for k in keys], dtype=np.uint64))
+    index = KeyIndex.build([["ab", "cd", "x"], ["ef", "cd"]])
+    shard_idx, inner_idx = index.lookup(["ab", "cd", "ef", "gh", "x", "y"])
+    assert shard_idx.tolist() == [0, 1, 1, -1, 0, -1]
+    assert inner_idx.tolist() == [0, 1, 0, -1, 2, -1]
+
+
+def test_rewritten_shard_gets_a_new_index(make_shards, tmp_path):
+    shards = make_shards(2, 4)
+    kwargs = dict(index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    assert ShardListDataset(shards, **kwargs).lookup(["s001_0003"])[0].tolist() == [1]
+    samples = make_samples(1, 6)
+    for sample in samples:
+        sample["__key__"] = "new_" + sample["__key__"]
+    write_shard(shards[1], samples)
+    dataset = ShardListDataset(shards, **kwargs)
+    assert len(dataset) == 10
+    assert dataset.lookup(["s001_0003", "new_s001_0005"])[0].tolist() == [-1, 1]
@@ -0,0 +1,47 @@
+import os
+import tarfile
+
+from kn_util.data.wids.wids_mmtar import MMIndexedTar, TarIndex, find_mmindex_file
+
+from conftest import make_samples, write_shard
+
+
+def test_index_matches_tarfile(make_shards):
+    (shard,) = make_shards(1, 5)
+    reader = MMIndexedTar(shard, index_file=find_mmindex_file, verbose=False)
+    with tarfile.open(shard) as tar:
+        expected = {m.name: tar.extractfile(m).read() for m in tar.getmembers()}
+    assert reader.names() == list(expected)
+    assert {name: bytes(data) for name, data in reader} == expected
+    assert bytes(reader["s000_0003.txt"][1]) == b"s000_0003"
+    # one group of member indices per sample, in order of first appearance
+    assert [len(group) for group in reader.sample_groups()] == [4] * 5
+    reader.close()
+
+
+def test_index_is_persisted_and_reused(make_shards, tmp_path, monkeypatch):
+    (shard,) = make_shards(1, 5)
+    index_cache = str(tmp_path / "index")
+    index_file = find_mmindex_file(shard, index_cache=index_cache)
+    MMIndexedTar(shard, index_file=index_file, verbose=False).close()
+    assert os.path.exists(index_file)
+
+    def fail(buf):
+        raise AssertionError("index rebuilt")
+
+    monkeypatch.setattr(TarIndex, "build", fail)
+    reader = MMIndexedTar(shard, index_file=index_file, verbose=False)
+    assert len(reader) == 20
+    reader.close()
+
+
+def test_stale_index_is_rebuilt(make_shards, tmp_path):
+    (shard,) = make_shards(1, 5)
+    index_file = str(tmp_path / "shard.mmidx")
+    MMIndexedTar(shard, index_file=index_file, verbose=False).close()
+    write_shard(shard, make_samples(0, 3))
+    assert TarIndex.load(index_file, os.stat(shard)) is None
+    reader = MMIndexedTar(shard, index_file=index_file, verbose=False)
+    assert len(reader) == 12
+    reader.close()
+    assert TarIndex.load(index_file, os.stat(shard)) is not None
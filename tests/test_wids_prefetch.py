@@ -0,0 +1,43 @@
+import os
+
+import numpy as np
+
+from kn_util.data.wids import ChunkedSampler, ShardListDataset, ShardPrefetcher, compress_tar
+from kn_util.data.wids.wids_mmtar import find_mmindex_file
+
+
+def test_prefetcher_on_compressed_shards(make_shards, tmp_path):
+    plain = make_shards(3, 8)
+    # no TarIndex anywhere, the prefetcher has to build it
+    shards = [compress_tar(f, codec="gz", frame_size=1024, index_file=None) for f in plain]
+    index_cache = str(tmp_path / "index")
+    dataset = ShardListDataset(shards, index_cache=index_cache, localname=lambda url: url)
+    for f in shards:
+        os.unlink(find_mmindex_file(f, index_cache=index_cache))
+
+    prefetcher = ShardPrefetcher(dataset, num_threads=2, num_shards=3)
+    prefetcher.prefetch(shards)
+    for f in shards:
+        assert prefetcher.wait(f)
+        assert os.path.exists(find_mmindex_file(f, index_cache=index_cache))
+    prefetcher.close()
+
+    reference = ShardListDataset(plain, index_cache=index_cache, localname=lambda url: url)
+    for i in range(len(dataset)):
+        a, b = dataset[i], reference[i]
+        assert a[".txt"] == b[".txt"]
+        np.testing.assert_array_equal(a[".npy"], b[".npy"])
+
+
+def test_prefetcher_follows_sampler(make_shards, tmp_path):
+    shards = make_shards(4, 5)
+    dataset = ShardListDataset(shards, index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    prefetcher = ShardPrefetcher(dataset, num_threads=2, num_shards=2)
+    sampler = ChunkedSampler(dataset, chunksize=5, shuffle=True, seed=1, prefetcher=prefetcher)
+    indices = list(sampler)
+    assert sorted(indices) == list(range(len(dataset)))
+    submitted, hits, waits = prefetcher.get_stats()
+    assert submitted >= 2
+    for index in indices:
+        dataset[index]
+    prefetcher.close()
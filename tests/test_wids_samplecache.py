@@ -0,0 +1,37 @@
+import random
+
+from kn_util.data.wids import ShardListDataset
+from kn_util.data.wids.wids import default_decoder
+
+
+class CountingDecoder:
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self, sample):
+        self.calls += 1
+        return default_decoder(sample, format="PIL")
+
+
+def augment(sample):
+    sample["noise"] = random.random()
+    return sample
+
+
+def test_cache_keeps_decoded_samples_and_reruns_augmentations(make_shards, tmp_path):
+    shards = make_shards(2, 5)
+    decoder = CountingDecoder()
+    dataset = ShardListDataset(
+        shards,
+        index_cache=str(tmp_path / "index"),
+        localname=lambda url: url,
+        transformations=[decoder],
+        decoded_cache_size=int(1e7),
+    )
+    dataset.add_transform(augment)
+    first = [dataset[i] for i in range(len(dataset))]
+    second = dataset.__getitems__(list(range(len(dataset))))
+    assert decoder.calls == len(dataset)
+    assert [s[".txt"] for s in first] == [s[".txt"] for s in second]
+    assert all(a["noise"] != b["noise"] for a, b in zip(first, second))
+    assert dataset.get_stats(detail=True)["decoded_mem_hits"] == len(dataset)
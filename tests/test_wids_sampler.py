@@ -0,0 +1,229 @@
+import random
+
+import numpy as np
+import pytest
+import torch
+
+from kn_util.data.wids import ChunkedSampler, ShardListDataset
+from kn_util.data.wids.wids_sampler import (
+    ChunkedPermutation,
+    ChunkedSamplerV2,
+    MixtureChunkedSampler,
+    ShardAffineBatchSampler,
+    iterate_lengths,
+    predict_shard_opens,
+    shard_affine_worker_init_fn,
+    shuffle_quality,
+)
+
+
+def make_dataset(make_shards, tmp_path, num_shards=4, nsamples=10, **kwargs):
+    return ShardListDataset(
+        make_shards(num_shards, nsamples),
+        index_cache=str(tmp_path / "index"),
+        localname=lambda url: url,
+        **kwargs,
+    )
+
+
+def test_shard_affine_batches_through_workers(make_shards, tmp_path):
+    dataset = make_dataset(make_shards, tmp_path, lru_size=8)
+    sampler = ChunkedSampler(dataset, chunksize=20, shuffle=True, seed=0)
+    batch_sampler = ShardAffineBatchSampler(dataset, sampler, batch_size=4, num_workers=2)
+    loader = torch.utils.data.DataLoader(
+        dataset,
+        batch_sampler=batch_sampler,
+        num_workers=2,
+        worker_init_fn=shard_affine_worker_init_fn,
+        collate_fn=lambda batch: [sample["__index__"] for sample in batch],
+    )
+    indices = [index for batch in loader for index in batch]
+    assert sorted(indices) == list(range(len(dataset)))
+
+
+def test_chunked_permutation_is_a_permutation_of_chunks():
+    sampler = ChunkedSampler(range(103), chunksize=10, shuffle=True, shufflefirst=True, seed=3)
+    indices = list(sampler)
+    assert sorted(indices) == list(range(103))
+    # every chunk is visited as a whole, shuffled within
+    pos = 0
+    while pos < len(indices):
+        lo = indices[pos] // 10 * 10
+        length = min(10, 103 - lo)
+        assert sorted(indices[pos : pos + length]) == list(range(lo, lo + length))
+        pos += length
+    assert indices != sorted(indices)
+
+
+def test_chunked_permutation_depends_on_seed_and_epoch():
+    first = list(ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=0))
+    again = list(ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=0))
+    assert first == again
+    sampler = ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=0)
+    sampler.set_epoch(1)
+    assert list(sampler) != first
+    assert list(ChunkedSampler(range(100), chunksize=10, shuffle=False)) == list(range(100))
+
+
+def test_chunked_permutation_random_access():
+    perm = ChunkedPermutation([10, 10, 7], seed=5, start_offset=100)
+    full = list(perm.iter_from(0))
+    assert sorted(full) == list(range(100, 127))
+    assert perm.slice(8, 23).tolist() == full[8:23]
+    assert list(perm.iter_from(13)) == full[13:]
+
+
+def consume(sampler, n):
+    it = iter(sampler)
+    return [next(it) for _ in range(n)]
+
+
+def test_resume_from_state_dict():
+    full = list(ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=7))
+    sampler = ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=7)
+    head = consume(sampler, 37)
+    resumed = ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=0)
+    resumed.load_state_dict(sampler.state_dict())
+    assert head + list(resumed) == full
+    # the following epoch is unaffected by the resume
+    reference = ChunkedSampler(range(100), chunksize=10, shuffle=True, seed=7)
+    reference.set_epoch(1)
+    assert list(resumed) == list(reference)
+
+
+def test_elastic_resume_on_another_world_size():
+    # two ranks consumed part of their halves of an epoch
+    ranks = [
+        ChunkedSampler(range(100), num_samples=(r * 50, r * 50 + 50), chunksize=10, shuffle=True, seed=1)
+        for r in range(2)
+    ]
+    consumed = consume(ranks[0], 12) + consume(ranks[1], 30)
+    # what elastic_state_dict gathers over the ranks
+    state = {"epoch": 0, "seed": 1, "segments": [seg for sampler in ranks for seg in sampler.remaining_segments()]}
+    # resumed on three ranks
+    remaining = []
+    for rank in range(3):
+        sampler = ChunkedSampler(range(100), chunksize=10, shuffle=True)
+        sampler.load_elastic_state_dict(state, rank=rank, num_replicas=3, drop_last=True)
+        assert len(sampler) == 58 // 3
+        remaining += list(sampler)
+    assert len(set(remaining)) == len(remaining)
+    assert not set(remaining) & set(consumed)
+    assert len(set(consumed) | set(remaining)) == 100 - 58 % 3
+
+
+def mixture(sizes):
+    return torch.utils.data.ConcatDataset([range(size) for size in sizes])
+
+
+def source_of(dataset, indices):
+    return np.searchsorted(dataset.cumulative_sizes, indices, side="right")
+
+
+def test_mixture_window_quotas():
+    dataset = mixture([100, 30, 40])
+    sampler = MixtureChunkedSampler(dataset, [0.5, 0.3, 0.2], chunksize=8, window=20, seed=1, num_replicas=1, rank=0)
+    indices = list(sampler)
+    assert len(indices) == len(sampler) == 170
+    sources = source_of(dataset, indices)
+    # every full window holds exactly its quota of each source
+    for k in range(len(indices) // 20):
+        assert np.bincount(sources[k * 20 : (k + 1) * 20], minlength=3).tolist() == [10, 6, 4]
+    assert sampler.source_counts(170, epoch=0).tolist() == np.bincount(sources, minlength=3).tolist()
+    # the small sources are repeated, every pass is a permutation of the source
+    offsets = [0] + dataset.cumulative_sizes[:-1]
+    for source, size in [(1, 30), (2, 40)]:
+        taken = np.asarray(indices)[sources == source] - offsets[source]
+        for start in range(0, len(taken) - size + 1, size):
+            assert sorted(taken[start : start + size].tolist()) == list(range(size))
+
+
+def test_mixture_resume_from_state_dict():
+    dataset = mixture([100, 30])
+    kwargs = dict(chunksize=8, window=16, seed=3, num_replicas=1, rank=0)
+    full = list(MixtureChunkedSampler(dataset, [0.6, 0.4], **kwargs))
+    for n in [1, 16, 37]:
+        sampler = MixtureChunkedSampler(dataset, [0.6, 0.4], **kwargs)
+        head = consume(sampler, n)
+        resumed = MixtureChunkedSampler(dataset, [0.6, 0.4], **kwargs)
+        resumed.load_state_dict(sampler.state_dict())
+        assert head + list(resumed) == full
+    # the next epoch is a different mixture
+    assert list(resumed) != full
+
+
+def test_mixture_splits_by_rank_with_wraparound():
+    # the small source has fewer samples than num_replicas * chunksize
+    dataset = mixture([5, 50])
+    ranks = [
+        MixtureChunkedSampler(dataset, [0.5, 0.5], chunksize=4, window=10, seed=0, num_replicas=2, rank=rank)
+        for rank in range(2)
+    ]
+    assert [len(sampler) for sampler in ranks] == [28, 28]
+    small, large = [], []
+    for sampler in ranks:
+        indices = np.asarray(list(sampler))
+        sources = source_of(dataset, indices)
+        small.append(set(indices[sources == 0].tolist()))
+        large.append(indices[sources == 1] - 5)
+    # each rank reads its own part of the small source, padded by wrapping around
+    assert small == [{0, 1, 2}, {3, 4, 0}]
+    # and its contiguous half of the large source, without repeats within a pass
+    assert set(large[0].tolist()) <= set(range(25))
+    assert set(large[1].tolist()) <= set(range(25, 50))
+    assert all(len(set(part.tolist())) == len(part) for part in large)
+
+
+@pytest.mark.parametrize("group_shards", ["consecutive", "random"])
+@pytest.mark.parametrize("window_chunks", [1, 3])
+@pytest.mark.parametrize("shuffle", [False, True])
+def test_chunked_sampler_v2_modes_are_permutations(make_shards, tmp_path, group_shards, window_chunks, shuffle):
+    dataset = make_dataset(make_shards, tmp_path, num_shards=7, nsamples=5, lru_size=2)
+    sampler = ChunkedSamplerV2(
+        dataset, shuffle=shuffle, seed=2, group_shards=group_shards, window_chunks=window_chunks
+    )
+    for epoch in range(2):
+        indices = list(sampler)
+        assert sorted(indices) == list(range(len(dataset)))
+        assert (indices == list(range(len(dataset)))) == (not shuffle)
+
+
+def test_chunked_sampler_v2_default_mode_is_unchanged(make_shards, tmp_path):
+    dataset = make_dataset(make_shards, tmp_path, num_shards=7, nsamples=5, lru_size=3)
+    sampler = ChunkedSamplerV2(dataset, shuffle=True, seed=4)
+    for epoch in range(2):
+        # the order of the sampler before group_shards/window_chunks existed
+        rng = random.Random(4 + 1289738273 * epoch)
+        expected = list(iterate_lengths([15, 15, 5], rng, indexshuffle=True, shardshuffle=True, total_size=35))
+        assert list(sampler) == expected
+
+
+@pytest.mark.parametrize("group_shards, window_chunks", [("consecutive", 1), ("random", 1), ("random", 3)])
+def test_shard_opens_match_lru(make_shards, tmp_path, group_shards, window_chunks):
+    dataset = make_dataset(make_shards, tmp_path, num_shards=8, nsamples=6, lru_size=2)
+    sampler = ChunkedSamplerV2(dataset, shuffle=True, seed=5, group_shards=group_shards, window_chunks=window_chunks)
+    stats = sampler.shuffle_stats(batch_size=8)
+    for index in sampler:
+        dataset[index]
+    assert stats["num_samples"] == len(dataset)
+    assert stats["shard_opens"] == dataset.get_stats()[1]
+    assert stats["opens_per_shard"] == stats["shard_opens"] / 8
+    assert stats["shard_opens"] == predict_shard_opens(
+        np.searchsorted(np.cumsum(dataset.lengths), list(sampler.iterate_epoch(0)), side="right"), 2
+    )
+    assert 0 < stats["batch_shard_entropy"] <= stats["batch_shard_entropy_max"] == 3.0
+    assert len(stats["label_autocorrelation"]) == 10
+
+
+def test_shuffle_quality_extremes():
+    cum_lengths = np.cumsum([10] * 10)
+    ordered = shuffle_quality(np.arange(100), cum_lengths, batch_size=10, lru_size=1)
+    assert ordered["shard_opens"] == 10
+    assert ordered["batch_shard_entropy"] == 0.0
+    assert ordered["label_autocorrelation"][0] > 0.8
+    # round robin over the shards: every batch holds all of them, every access opens a shard
+    round_robin = np.arange(100).reshape(10, 10).T.ravel()
+    spread = shuffle_quality(round_robin, cum_lengths, batch_size=10, lru_size=1)
+    assert spread["shard_opens"] == 100
+    assert spread["batch_shard_entropy"] == pytest.approx(np.log2(10))
+    assert predict_shard_opens(np.searchsorted(cum_lengths, round_robin, side="right"), 10) == 10
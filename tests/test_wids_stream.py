@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+
+from kn_util.data.wids import ShardListDataset, ShardListStream
+
+
+def comparable(sample):
+    return (
+        sample["__key__"],
+        sample["__index__"],
+        sample["__shardindex__"],
+        sample[".txt"],
+        sample[".cls"],
+        sample[".npy"].tolist(),
+        sample[".mp4"].read(),
+    )
+
+
+def test_stream_matches_indexed(make_shards, tmp_path):
+    shards = make_shards(3, 7)
+    indexed = ShardListDataset(shards, index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    stream = ShardListStream(indexed.shards, shuffle_buffer=0, shuffle_shards=False)
+    streamed = [comparable(sample) for sample in stream]
+    assert streamed == [comparable(indexed[i]) for i in range(len(indexed))]
+
+
+def test_shuffled_stream_through_workers(make_shards, tmp_path):
+    shards = make_shards(4, 5)
+    stream = ShardListStream(shards, shuffle_buffer=8, seed=3)
+    loader = torch.utils.data.DataLoader(stream, batch_size=None, num_workers=2)
+    keys = [sample["__key__"] for sample in loader]
+    assert sorted(keys) == sorted(f"s{i:03d}_{j:04d}" for i in range(4) for j in range(5))
+    assert keys != sorted(keys)
+    # without nsamples there is no global index
+    assert all(sample["__index__"] is None for sample in ShardListStream(shards[:1], shuffle_buffer=0))
+    np.testing.assert_array_equal(next(iter(ShardListStream(shards[:1], shuffle_buffer=0)))[".npy"], np.zeros((4, 3)))
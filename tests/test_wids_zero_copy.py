@@ -0,0 +1,52 @@
+import io
+import pickle
+
+import numpy as np
+import torch
+
+from kn_util.data.wids import ShardListDataset
+from kn_util.data.wids.wids import default_decoder, detach_views
+
+
+def test_default_decoder_detaches_undecoded_views():
+    sample = {"__key__": "a", ".mp4": memoryview(b"video"), ".txt": memoryview(b"caption")}
+    sample = default_decoder(sample, format="PIL")
+    assert sample[".txt"] == "caption"
+    assert isinstance(sample[".mp4"], io.BytesIO)
+    assert sample[".mp4"].read() == b"video"
+    pickle.dumps(sample)
+
+
+def test_detach_views_nested():
+    samples = ({"a": memoryview(b"xy")}, [{"b": memoryview(b"z")}])
+    samples = detach_views(samples)
+    assert samples[0]["a"].getvalue() == b"xy"
+    assert samples[1][0]["b"].getvalue() == b"z"
+
+
+def test_zero_copy_matches_copy(make_shards, tmp_path):
+    shards = make_shards(2, 6)
+    kwargs = dict(index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    copied = ShardListDataset(shards, **kwargs)
+    viewed = ShardListDataset(shards, zero_copy=True, **kwargs)
+    for i in range(len(copied)):
+        a, b = copied[i], viewed[i]
+        assert a[".txt"] == b[".txt"]
+        np.testing.assert_array_equal(a[".npy"], b[".npy"])
+        assert a[".mp4"].read() == b[".mp4"].read()
+
+
+def test_zero_copy_through_dataloader_workers(make_shards, tmp_path):
+    shards = make_shards(2, 6)
+    dataset = ShardListDataset(
+        shards, index_cache=str(tmp_path / "index"), localname=lambda url: url, zero_copy=True
+    )
+    loader = torch.utils.data.DataLoader(
+        dataset, batch_size=None, num_workers=2, collate_fn=lambda x: x, timeout=60
+    )
+    samples = list(loader)
+    assert len(samples) == len(dataset)
+    for i, sample in enumerate(samples):
+        assert sample["__index__"] == i
+        assert sample[".mp4"].read() == bytes([i % 6 % 256]) * (100 + i % 6)
+        np.testing.assert_array_equal(sample[".npy"], np.full((4, 3), i % 6, dtype=np.float32))
@@ -0,0 +1,72 @@
+import os
+import tarfile
+
+import numpy as np
+import pytest
+
+from kn_util.data.wids import CompressedIndexedTar, ShardListDataset, compress_tar
+from kn_util.data.wids import wids_ztar
+from kn_util.data.wids.wids_mmtar import find_mmindex_file
+from kn_util.data.wids.wids_utils import scan_tar_members
+
+
+def members(path):
+    with tarfile.open(path) as tar:
+        return {m.name: tar.extractfile(m).read() for m in tar.getmembers() if m.isfile()}
+
+
+def forbid_rebuild(monkeypatch):
+    def fail(*args, **kwargs):
+        raise AssertionError("the shard was decompressed again")
+
+    monkeypatch.setattr(wids_ztar, "scan_frames", fail)
+    monkeypatch.setattr(wids_ztar.TarIndex, "build", fail)
+
+
+@pytest.mark.parametrize("frame_size", [512, 1 << 22])
+def test_compressed_round_trip(make_shards, frame_size):
+    (plain,) = make_shards(1, 12)
+    shard = compress_tar(plain, codec="gz", frame_size=frame_size)
+    # a valid .tar.gz for standard tools
+    assert members(shard) == members(plain)
+    reader = CompressedIndexedTar(shard, verbose=False)
+    expected = members(plain)
+    assert sorted(reader.names()) == sorted(expected)
+    for name, data in expected.items():
+        assert bytes(reader.get_by_name(name)[1]) == data
+    reader.close()
+
+
+def test_shard_without_frame_table(make_shards):
+    (plain,) = make_shards(1, 6)
+    shard = compress_tar(plain, codec="gz", frame_size=512, index_file=None)
+    os.unlink(shard + ".frames")
+    reader = CompressedIndexedTar(shard, verbose=False)
+    assert os.path.exists(shard + ".frames")
+    assert {name: bytes(data) for name, data in reader} == members(plain)
+
+
+def test_index_written_by_compress_tar_is_found(make_shards, tmp_path, monkeypatch):
+    plain = make_shards(2, 6)
+    shards = [compress_tar(f, codec="gz", frame_size=512) for f in plain]
+    reference = ShardListDataset(plain, index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    expected = [reference[i] for i in range(len(reference))]
+    forbid_rebuild(monkeypatch)
+    # a dataset with its own index_cache still finds the index next to the shards
+    dataset = ShardListDataset(shards, index_cache=str(tmp_path / "index"), localname=lambda url: url)
+    for i in range(len(dataset)):
+        assert dataset[i][".txt"] == expected[i][".txt"]
+        np.testing.assert_array_equal(dataset[i][".npy"], expected[i][".npy"])
+
+
+def test_scan_and_reader_share_index_cache(make_shards, tmp_path, monkeypatch):
+    (plain,) = make_shards(1, 6)
+    shard = compress_tar(plain, codec="gz", frame_size=512, index_file=None)
+    index_cache = str(tmp_path / "index")
+    list(scan_tar_members(shard, index_cache=index_cache))
+    assert os.path.exists(find_mmindex_file(shard, index_cache=index_cache))
+    assert not os.path.exists(find_mmindex_file(shard))
+    # the scan built the index once, opening the shard through the dataset does not
+    forbid_rebuild(monkeypatch)
+    dataset = ShardListDataset([shard], index_cache=index_cache, localname=lambda url: url)
+    assert dataset[0]["__key__"] == "s000_0000"